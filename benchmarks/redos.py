@@ -0,0 +1,142 @@
+"""
+Adversarial input benchmark of the IOC rule set.
+
+Times every rule on inputs crafted to make backtracking regexes retry long
+runs from every start position (filename characters without extension,
+alphanumeric runs just below the base64 length, ...) at two sizes, and
+fails when a rule is not linear: the time per MB of a linear rule stays
+flat from a quarter of the size to the full size, that of a quadratic one
+grows fourfold. The verdict only depends on this ratio, not on how fast
+the machine is. Small inputs stay in the CPU caches and are scanned a bit
+faster per MB, so linear rules can show a growth of up to about 2. Rules
+are timed on bytes, the way streams are scanned. Rules with a linear time
+finder are also fuzzed against their plain pattern, on str and on UTF-8
+bytes, to verify both find the same matches, also for non-ASCII
+filenames.
+
+    python -m benchmarks.redos [--size 1M] [--max-growth 3] [--repeat 3] [--fuzz 2000] [--backtracking]
+"""
+import argparse
+import random
+import sys
+import time
+from benchmarks.corpus import parse_size
+from pipeline.file_pipelines import RULES
+
+ADVERSARIAL = {
+    'filename_run': lambda n: 'a' * n,
+    'filename_words': lambda n: ('word ' * (n // 5 + 1))[:n],
+    'filename_dots': lambda n: ('a.' * (n // 2 + 1))[:n],
+    'filename_near_ext': lambda n: ('x.ex ' * (n // 5 + 1))[:n],
+    'base64_short_runs': lambda n: (('Ab1+' * 10)[:39] + ' ') * (n // 40),
+    'base64_blob_padding': lambda n: ('A' * 39 + '=') * (n // 40),
+    'url_prefixes': lambda n: ('http://a ' * (n // 9 + 1))[:n],
+    'ip_digits': lambda n: ('1.2.3.' * (n // 6 + 1))[:n],
+    'js_escapes': lambda n: ('\\x4' * (n // 3 + 1))[:n],
+}
+
+# runs shorter than this are too noisy to judge growth on
+MIN_SECONDS = 0.02
+
+FUZZ_ALPHABET = 'aZ09./-_ =+\n"<>' + 'exdlsrbtpjv'
+FUZZ_FRAGMENTS = ['.exe', '.dll', '.js', '.vbs', '.ps1', '.EXE', '==', 'A' * 40, 'http://', ' ']
+# letters only, other non-ASCII characters are filename characters in bytes but not in str
+FUZZ_UNICODE = ['résumé', 'Übersicht', 'naïve', 'счёт', '报告']
+
+def time_rule(name: str, text: str, repeat: int = 1) -> float:
+    # fastest of `repeat` runs, other load on the machine only ever adds time
+    data = text.encode('ascii')
+    fastest = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        RULES.scan_bytes(data, [name])
+        fastest = min(fastest, time.perf_counter() - start)
+    return fastest
+
+def time_pattern(name: str, text: str) -> float:
+    start = time.perf_counter()
+    for _ in RULES[name].pattern.finditer(text):
+        pass
+    return time.perf_counter() - start
+
+def fuzz_text(rng: random.Random) -> str:
+    parts = []
+    for _ in range(rng.randint(1, 40)):
+        if rng.random() < 0.2:
+            parts.append(rng.choice(FUZZ_FRAGMENTS))
+        elif rng.random() < 0.1:
+            parts.append(rng.choice(FUZZ_UNICODE))
+        else:
+            parts.append(''.join(rng.choice(FUZZ_ALPHABET) for _ in range(rng.randint(1, 60))))
+    return ''.join(parts)
+
+def fuzz_finders(iterations: int, seed: int = 1) -> list:
+    """ Inputs on which a linear finder and the plain pattern disagree. """
+    rng = random.Random(seed)
+    failures = []
+    finder_rules = [rule for rule in RULES.rules.values() if rule.finder]
+
+    for _ in range(iterations):
+        text = fuzz_text(rng)
+        data = text.encode('utf-8')
+        for rule in finder_rules:
+            expected = [(m.span(), rule.value(m)) for m in rule.pattern.finditer(text)]
+            actual = [(m.span(), rule.value(m)) for m in rule.finditer(text)]
+            # offsets of UTF-8 bytes differ from str ones, the matched text does not
+            matched = [(m.group(0), rule.value(m)) for m in rule.pattern.finditer(text)]
+            matched_bytes = [(m.group(0).decode('utf-8'), rule.value(m)) for m in rule.finditer(data)]
+            if expected != actual or matched != matched_bytes:
+                failures.append((rule.name, text))
+    return failures
+
+def main():
+    parser = argparse.ArgumentParser(description='Adversarial input benchmark of the IOC rules')
+    parser.add_argument('--size', type=str, default='1M', help='largest input size')
+    parser.add_argument('--max-growth', type=float, default=3.0, help='fail when the time per MB of a rule grows more than this from 1/4 of the size to the full size (linear: 1, quadratic: 4)')
+    parser.add_argument('--repeat', type=int, default=3, help='runs per input, the fastest is kept')
+    parser.add_argument('--fuzz', type=int, default=2000, help='random inputs to compare linear finders against their patterns')
+    parser.add_argument('--backtracking', action='store_true', help='also time plain patterns of rules with a linear finder (slow)')
+    args = parser.parse_args()
+
+    size = parse_size(args.size)
+    failed = False
+
+    # worst input per rule
+    print(f'{"rule":<18} {"worst input":<22} {"ms/MB @1/4":>11} {"ms/MB":>9} {"growth":>7}')
+    for name in RULES.rules:
+        worst = None
+        for label, make in ADVERSARIAL.items():
+            small, large = make(size // 4), make(size)
+            large_seconds = time_rule(name, large, args.repeat)
+            small_rate = time_rule(name, small, args.repeat) * 1000 / (len(small) / 1024 ** 2)
+            large_rate = large_seconds * 1000 / (len(large) / 1024 ** 2)
+            # per MB cost of a linear rule stays flat as the input grows
+            growth = large_rate / max(small_rate, 1e-3)
+
+            slow = growth > args.max_growth and large_seconds >= MIN_SECONDS
+            failed = failed or slow
+            if worst is None or slow or large_rate > worst[2]:
+                worst = (label, small_rate, large_rate, growth, slow)
+            if slow:
+                break
+
+        label, small_rate, large_rate, growth, slow = worst
+        print(f'{name:<18} {label:<22} {small_rate:>11.1f} {large_rate:>9.1f} {growth:>7.2f}{"  SLOW" if slow else ""}')
+
+    if args.backtracking:
+        # quadratic patterns, measured on a small input only
+        sample = 16 * 1024
+        for rule in RULES.rules.values():
+            if rule.finder:
+                worst = max(time_pattern(rule.name, make(sample)) for make in ADVERSARIAL.values())
+                print(f'{rule.name:<18} plain pattern worst case on {sample // 1024} KiB: {worst * 1000:.1f} ms')
+
+    failures = fuzz_finders(args.fuzz)
+    for name, text in failures[:10]:
+        print(f'finder mismatch in {name}: {text!r}', file=sys.stderr)
+    print(f'fuzzed {args.fuzz} inputs, {len(failures)} finder mismatches')
+
+    sys.exit(1 if failed or failures else 0)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+"""
+Cold start benchmark of the JSON-only `sdat analyze` path.
+
+Checks that `sdat analyze` on a document does not import the PDF report
+renderer (reportlab, matplotlib), parser libraries of other formats or
+multiprocessing, and times full `sdat analyze` invocations in fresh
+interpreters.
+
+    python -m benchmarks.startup [--runs N] [--max-ms MS]
+"""
+import argparse
+import json
+import os
+from pathlib import Path
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT = Path(__file__).resolve().parent.parent
+
+SAMPLES = {
+    'CFBF': ROOT / 'malicious-files' / 'cfbf' / 'macro_shell_cfbf.doc',
+    'OOXML': ROOT / 'malicious-files' / 'ooxml' / 'clean_ooxml.xlsx',
+    'PDF': ROOT / 'malicious-files' / 'pdf' / 'sample-local-pdf.pdf',
+}
+
+# modules that must stay unloaded when analyzing a file of the given type,
+# multiprocessing is only needed by scan, watch, serve and large documents
+FORBIDDEN = {
+    'CFBF': {'reportlab', 'matplotlib', 'pypdf', 'multiprocessing'},
+    'OOXML': {'reportlab', 'matplotlib', 'pypdf', 'olefile', 'multiprocessing'},
+    'PDF': {'reportlab', 'matplotlib', 'olefile', 'multiprocessing'},
+}
+
+# runs the sdat entry point itself, so imports of the command line module are checked too
+PROBE = '''
+import json, os, runpy, sys
+sdat, sample = sys.argv[1:]
+sys.argv = [sdat, 'analyze', sample, '--out', os.devnull]
+runpy.run_path(sdat, run_name='__main__')
+print(json.dumps(sorted({m.split('.')[0] for m in sys.modules})))
+'''
+
+def loaded_modules(sample: Path) -> set:
+    out = subprocess.run(
+        [sys.executable, '-c', PROBE, str(ROOT / 'sdat'), str(sample)],
+        cwd=ROOT, capture_output=True, text=True, check=True
+    ).stdout
+    return set(json.loads(out.splitlines()[-1]))
+
+def time_cold_start(sample: Path, runs: int) -> list:
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run(
+            [sys.executable, str(ROOT / 'sdat'), 'analyze', str(sample), '--out', os.devnull],
+            cwd=ROOT, capture_output=True, check=True
+        )
+        timings.append((time.perf_counter() - start) * 1000)
+    return timings
+
+def main():
+    parser = argparse.ArgumentParser(description='Cold start benchmark of sdat analyze')
+    parser.add_argument('--runs', type=int, default=5, help='cold starts per sample')
+    parser.add_argument('--max-ms', type=float, help='fail when median cold start of any sample exceeds this')
+    args = parser.parse_args()
+
+    failed = False
+    print(f'{"type":<6} {"min ms":>8} {"median ms":>10}  unexpected imports')
+    for file_type, sample in SAMPLES.items():
+        unexpected = sorted(loaded_modules(sample) & FORBIDDEN[file_type])
+        timings = time_cold_start(sample, args.runs)
+        median = statistics.median(timings)
+
+        print(f'{file_type:<6} {min(timings):>8.1f} {median:>10.1f}  {", ".join(unexpected) or "-"}')
+        if unexpected or (args.max_ms and median > args.max_ms):
+            failed = True
+
+    sys.exit(1 if failed else 0)
+
+if __name__ == '__main__':
+    main()
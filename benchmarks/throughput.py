@@ -0,0 +1,153 @@
+"""
+Throughput benchmark of the format pipelines and the PDF report renderer.
+
+Generates a synthetic corpus (see benchmarks.corpus), analyzes every
+document with its format pipeline and renders the report with
+GeneratePdfPipeline. Every pipeline runs in a fresh interpreter so peak RSS
+is measured per pipeline. Reports can be saved as golden files and later
+compared byte by byte to verify optimizations do not change results.
+
+    python -m benchmarks.throughput [--sizes 64K,1M] [--density 20] [--runs 3]
+                                    [--corpus-dir DIR] [--save-golden DIR | --check-golden DIR]
+"""
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import json
+import multiprocessing
+import os
+from pathlib import Path
+import resource
+import sys
+import tempfile
+import time
+from benchmarks.corpus import generate_corpus, parse_size
+
+ROOT = Path(__file__).resolve().parent.parent
+
+PIPELINES = {
+    '.doc': 'CfbfPipeline',
+    '.docx': 'OoxmlPipeline',
+    '.pdf': 'PdfPipeline',
+}
+
+def create_pipeline(name: str, path: Path):
+    if name == 'CfbfPipeline':
+        from pipeline.file_pipelines.cfbf import CfbfPipeline
+        return CfbfPipeline(path)
+    if name == 'OoxmlPipeline':
+        from pipeline.file_pipelines.ooxml import OoxmlPipeline
+        return OoxmlPipeline(path)
+    from pipeline.file_pipelines.pdf import PdfPipeline
+    return PdfPipeline(path)
+
+def peak_rss_mb() -> float:
+    # ru_maxrss is in KiB on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def bench_analysis(name: str, files: list, runs: int) -> dict:
+    """ Runs in a child process, returns timings and serialized reports. """
+    sys.path.insert(0, str(ROOT))
+    reports = {}
+    elapsed = 0.0
+    for _ in range(runs):
+        for path in files:
+            start = time.perf_counter()
+            report = create_pipeline(name, path).run()
+            elapsed += time.perf_counter() - start
+            reports[path.name] = json.dumps(report.to_dict(), indent=4)
+
+    return { 'elapsed': elapsed, 'reports': reports, 'peak_rss_mb': peak_rss_mb() }
+
+def bench_render(reports: dict, runs: int) -> dict:
+    sys.path.insert(0, str(ROOT))
+    from pipeline import IocReport
+    from pipeline.pdf import GeneratePdfPipeline
+
+    elapsed = 0.0
+    failed = set()
+    with tempfile.TemporaryDirectory() as tmp:
+        for _ in range(runs):
+            for name, serialized in reports.items():
+                content = IocReport.from_dict(json.loads(serialized))
+                start = time.perf_counter()
+                try:
+                    GeneratePdfPipeline(Path(tmp) / f'{name}.pdf', content=content).run()
+                except Exception as e:
+                    # reportlab gives up on tables that do not fit a page
+                    failed.add(f'{name}: {type(e).__name__}')
+                elapsed += time.perf_counter() - start
+
+    return { 'elapsed': elapsed, 'failed': sorted(failed), 'peak_rss_mb': peak_rss_mb() }
+
+def in_fresh_process(func, *args):
+    # deterministic hashing in the child, set reprs end up in report descriptions
+    os.environ['PYTHONHASHSEED'] = '0'
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+        return executor.submit(func, *args).result()
+
+def check_golden(reports: dict, golden_dir: Path) -> list:
+    mismatched = []
+    for name, serialized in sorted(reports.items()):
+        golden = golden_dir / f'{name}.report.json'
+        if not golden.exists() or golden.read_text() != serialized:
+            mismatched.append(name)
+    return mismatched
+
+def save_golden(reports: dict, golden_dir: Path):
+    golden_dir.mkdir(parents=True, exist_ok=True)
+    for name, serialized in reports.items():
+        (golden_dir / f'{name}.report.json').write_text(serialized)
+
+def main():
+    parser = argparse.ArgumentParser(description='Throughput benchmark of sdat pipelines')
+    parser.add_argument('--sizes', type=str, default='64K,1M', help='comma separated approximate document sizes')
+    parser.add_argument('--density', type=int, default=20, help='IOCs per 64 KiB of content')
+    parser.add_argument('--seed', type=int, default=1, help='corpus random seed')
+    parser.add_argument('--runs', type=int, default=3, help='passes over the corpus per pipeline')
+    parser.add_argument('--corpus-dir', type=str, help='keep the generated corpus in this directory')
+    golden = parser.add_mutually_exclusive_group()
+    golden.add_argument('--save-golden', type=str, help='store reports in this directory')
+    golden.add_argument('--check-golden', type=str, help='fail when reports differ from the ones in this directory')
+    args = parser.parse_args()
+
+    sizes = [parse_size(s) for s in args.sizes.split(',')]
+    with tempfile.TemporaryDirectory() as tmp:
+        files = generate_corpus(args.corpus_dir or tmp, sizes, args.density, args.seed)
+
+        by_pipeline = {}
+        for path in files:
+            by_pipeline.setdefault(PIPELINES[path.suffix], []).append(path)
+
+        reports = {}
+        print(f'{"pipeline":<20} {"docs":>5} {"MB":>8} {"docs/s":>9} {"MB/s":>8} {"peak RSS MB":>12}')
+        for name, group in by_pipeline.items():
+            result = in_fresh_process(bench_analysis, name, group, args.runs)
+            reports.update(result['reports'])
+
+            docs = len(group) * args.runs
+            mb = sum(p.stat().st_size for p in group) * args.runs / 1024 ** 2
+            print(f'{name:<20} {docs:>5} {mb:>8.1f} {docs / result["elapsed"]:>9.2f} '
+                  f'{mb / result["elapsed"]:>8.2f} {result["peak_rss_mb"]:>12.1f}')
+
+        result = in_fresh_process(bench_render, reports, args.runs)
+        docs = len(reports) * args.runs
+        print(f'{"GeneratePdfPipeline":<20} {docs:>5} {"-":>8} {docs / result["elapsed"]:>9.2f} '
+              f'{"-":>8} {result["peak_rss_mb"]:>12.1f}')
+        for failure in result['failed']:
+            print(f'render failed: {failure}', file=sys.stderr)
+
+    if args.save_golden:
+        save_golden(reports, Path(args.save_golden))
+        print(f'saved {len(reports)} golden reports to {args.save_golden}')
+
+    if args.check_golden:
+        mismatched = check_golden(reports, Path(args.check_golden))
+        for name in mismatched:
+            print(f'report differs from golden: {name}', file=sys.stderr)
+        if mismatched:
+            sys.exit(1)
+        print(f'all {len(reports)} reports match golden files')
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,8 @@
 from abc import ABC, abstractmethod
-from dataclasses import dataclass, asdict
-from typing import List, Literal, Optional, Union
+from dataclasses import dataclass, field
+import os
+from pathlib import Path
+from typing import Callable, Dict, List, Literal, Optional, Union
 
 @dataclass
 class IocHit:
@@ -8,39 +10,141 @@ class IocHit:
     hits: int
     name: str
     description: Optional[str]
+    # embedded document the hit was found in, e.g. 'word/embeddings/oleObject1.bin > WordDocument'
+    path: Optional[str] = None
+    # stream and matched values, not serialized, compact reports are built from them
+    stream: Optional[str] = None
+    evidence: Optional[List[str]] = None
     
     def to_dict(self):
-        return {
+        d = {
             'name': self.name,
             'description': self.description,
             'score': self.score,
             'hits': self.hits
         }
+        if self.path:
+            d['path'] = self.path
+        return d
 
     @classmethod
     def from_dict(cls, d):
         return cls(**d)
 
+@dataclass
+class CompactHit(IocHit):
+    """ All hits of one rule merged, with bounded deduplicated evidence and hit counts per stream. """
+    streams: Dict[str, int] = field(default_factory=dict)
+
+    def to_dict(self):
+        d = super().to_dict()
+        if self.evidence is not None:
+            d['evidence'] = self.evidence
+        d['streams'] = self.streams
+        return d
+
 @dataclass
 class IocReport:
     hits: List[IocHit]
     total_score: int
     verdict: Union[Literal['low_risk'], Literal['medium_risk'], Literal['high_risk']]
+    # per stage/stream/rule wall time, only present when timings were requested
+    timings: Optional[dict] = None
+    # triage stopped early or skipped checks, hits and total_score are incomplete
+    partial: bool = False
+    # SHA-256 of the document is allowlisted, it was not analyzed
+    allowlisted: bool = False
+    # type from detect_file_type, not serialized, cached reports keep it for metrics
+    file_type: Optional[str] = None
     
     def to_dict(self):
-        return {
+        d = {
             'verdict': self.verdict,
             'total_score': self.total_score,
             'hits': [ hit.to_dict() for hit in self.hits ]
         }
+        if self.partial:
+            d['partial'] = True
+        if self.allowlisted:
+            d['allowlisted'] = True
+        if self.timings is not None:
+            d['timings'] = self.timings
+        return d
 
     @classmethod
     def from_dict(cls, d):
-        d['hits'] = [IocHit.from_dict(hit) for hit in d['hits']]
+        d['hits'] = [CompactHit.from_dict(hit) if 'streams' in hit else IocHit.from_dict(hit) for hit in d['hits']]
         return cls(**d)
 
+@dataclass
+class AnalysisOptions:
+    # windowed entropy map, reports offsets of high entropy regions per stream
+    entropy_map: bool = False
+    entropy_window: int = 4096
+    # decompression budgets for archive members (OOXML)
+    max_member_bytes: int = 64 * 1024 * 1024
+    max_total_bytes: int = 512 * 1024 * 1024
+    max_compression_ratio: float = 100.0
+    # PDF object walker budgets
+    pdf_max_objects: int = 100_000
+    pdf_max_stream_bytes: int = 32 * 1024 * 1024
+    pdf_max_total_bytes: int = 256 * 1024 * 1024
+    # worker processes analyzing the streams of one large document, 0 or 1 analyzes them in-process
+    stream_workers: int = 0
+    # streams above this size are scanned in chunks, by the workers when parallel, in one pass otherwise
+    stream_chunk_bytes: int = 8 * 1024 * 1024
+    # how far a chunk end may move back to a safe cut, and the context shared by
+    # neighbouring chunks when there is none; only then matches longer than this may be cut
+    stream_chunk_overlap: int = 64 * 1024
+    # embedded OLE, OOXML and PDF documents are analyzed recursively up to this depth, 0 disables
+    max_nesting_depth: int = 3
+    # total bytes of embedded documents analyzed per top-level document
+    max_nested_bytes: int = 128 * 1024 * 1024
+    # seconds one IOC rule may spend on one stream before it is cut off
+    rule_time_budget: float = 10.0
+    # wall-clock seconds and anonymous resident bytes one document may take, analyzed in a
+    # watchdog worker that is killed at either limit (see limits.py); None disables
+    document_time_limit: Optional[float] = None
+    document_memory_limit: Optional[int] = None
+    # only establish the verdict, cheapest checks first, stop once it can not change
+    triage: bool = False
+    # one hit per rule with bounded evidence instead of one per stream and rule
+    compact: bool = False
+    # distinct values and streams kept per rule in compact reports
+    max_evidence: int = 10
+    # file of known-benign URL prefixes, domains and SHA-256 of clean documents (see allowlist.py)
+    allowlist: Optional[str] = None
+    # built-in OOXML/XML namespace domains are allowlisted unless disabled
+    default_allowlist: bool = True
+    # record wall time of detection, extraction, streams and rules in the report
+    timings: bool = False
+
 class Pipeline(ABC):
     @abstractmethod
     def run(self) -> IocReport:
         ...
-        
\ No newline at end of file
+        
+def output_paths(files: List[Path], out_dir: Optional[Path], rename: Callable[[str], str]) -> List[Path]:
+    """
+    Output file of every input, named `rename(name)`: next to the input or,
+    with an `out_dir`, at the input's path relative to the common parent of
+    all inputs. Raises ValueError when two inputs map to the same output.
+    """
+    if out_dir:
+        parents = [os.path.dirname(os.path.abspath(f)) for f in files]
+        root = os.path.commonpath(parents) if parents else ''
+        outputs = [out_dir / os.path.relpath(parent, root) / rename(f.name) for f, parent in zip(files, parents)]
+    else:
+        outputs = [f.with_name(rename(f.name)) for f in files]
+
+    seen: Dict[str, Path] = {}
+    for f, output in zip(files, outputs):
+        key = os.path.normpath(os.path.abspath(output))
+        if key in seen:
+            raise ValueError(f'{seen[key]} and {f} would both be written to {output}')
+        seen[key] = f
+
+    if out_dir:
+        for output in outputs:
+            output.parent.mkdir(parents=True, exist_ok=True)
+    return outputs
@@ -0,0 +1,135 @@
+from functools import lru_cache
+import re
+from typing import Dict, Iterable, List, Optional, Set
+from urllib.parse import urlsplit
+from . import AnalysisOptions, IocReport
+
+# namespace and schema hosts of OOXML, XML and XMP. URLs on them are identifiers
+# written by every office suite and are never fetched
+DEFAULT_DOMAINS = (
+    'schemas.openxmlformats.org',
+    'schemas.microsoft.com',
+    'www.w3.org',
+    'ns.adobe.com',
+)
+
+RE_SHA256 = re.compile(r'[0-9a-fA-F]{64}')
+RE_URL_START = re.compile(r'(?:https?|ftp)://', re.IGNORECASE)
+RE_SCHEME = re.compile(r'(?:https?|ftp)$', re.IGNORECASE)
+# characters ending an URL (see RE_URL)
+RE_URL_BREAK = re.compile(r'[\s\'"<>]')
+RE_URL_QUERY = re.compile(r'[?#]')
+# how far back from a match its URL may start
+URL_LOOKBACK = 512
+
+def url_host(url: str) -> Optional[str]:
+    """ Lowercase host of an URL at the start of `url`, after any userinfo and without the port. """
+    if not RE_URL_START.match(url):
+        return None
+    end = RE_URL_BREAK.search(url)
+    try:
+        # http://schemas.microsoft.com:x@evil.example/ is on evil.example
+        return urlsplit(url[:end.start()] if end else url).hostname
+    except ValueError:
+        # unbalanced IPv6 brackets
+        return None
+
+class Allowlist:
+    """
+    Known-benign URLs and documents. URLs on an allowlisted domain (or one
+    of its subdomains) or starting with an allowlisted prefix are dropped
+    from rule matches as soon as they are found, together with the base64
+    candidates that are only part of the path of such an URL (or run into
+    it from the end of its host), never the ones in its query string.
+    Documents whose SHA-256 is listed are not analyzed at all. Every lookup
+    is a probe of a hash set, hashes are kept as raw 32 byte digests.
+    """
+    def __init__(self, domains: Iterable[str] = (), prefixes: Iterable[str] = (), hashes: Iterable[str] = ()):
+        self.domains: Set[str] = { domain.lower().strip('.') for domain in domains }
+        # prefixes are grouped by host, only the ones of the URL's host are compared
+        self.prefixes: Dict[str, List[str]] = {}
+        for prefix in prefixes:
+            self.prefixes.setdefault(url_host(prefix), []).append(prefix.lower())
+        self.hashes: Set[bytes] = { bytes.fromhex(digest) for digest in hashes }
+
+    @classmethod
+    def load(cls, path = None, defaults: bool = True) -> 'Allowlist':
+        """
+        Built-in namespace domains plus the entries of a file with one entry
+        per line: SHA-256 of a clean document, URL prefix (with scheme) or
+        domain. Empty lines and lines starting with '#' are skipped.
+        """
+        domains, prefixes, hashes = list(DEFAULT_DOMAINS if defaults else ()), [], []
+        if path:
+            with open(path, 'r') as f:
+                for line in f:
+                    entry = line.strip()
+                    if not entry or entry.startswith('#'):
+                        continue
+                    if RE_SHA256.fullmatch(entry):
+                        hashes.append(entry)
+                    elif '://' in entry:
+                        prefixes.append(entry)
+                    else:
+                        domains.append(entry)
+        return cls(domains, prefixes, hashes)
+
+    def __bool__(self) -> bool:
+        return bool(self.domains or self.prefixes or self.hashes)
+
+    def known_clean(self, digest: str) -> bool:
+        return bool(self.hashes) and bytes.fromhex(digest) in self.hashes
+
+    def allows_url(self, url: str) -> bool:
+        host = url_host(url)
+        if host is None:
+            return False
+
+        # the domain itself and all of its subdomains
+        labels = host.split('.')
+        if any('.'.join(labels[i:]) in self.domains for i in range(len(labels))):
+            return True
+
+        prefixes = self.prefixes.get(host)
+        return bool(prefixes) and url.lower().startswith(tuple(prefixes))
+
+    def allows(self, text, match: re.Match) -> bool:
+        """ Whether the rule match is (part of) an allowlisted URL in text (str or bytes). """
+        lo = max(0, match.start() - URL_LOOKBACK)
+        window = text[lo:match.end()]
+        if not isinstance(window, str):
+            # URLs are ASCII, latin-1 keeps every byte at its offset
+            window = bytes(window).decode('latin-1')
+        start = match.start() - lo
+        if RE_URL_START.match(window, start):
+            return self.allows_url(window[start:])
+
+        # a fragment: find the scheme of the URL it continues, within the same run of URL characters
+        separator = window.rfind('://', 0, start)
+        if separator < 0 or RE_URL_BREAK.search(window, separator, start):
+            return False
+        # part of the path, or cut from the host into it (e.g. 'org/officeDocument/...'),
+        # query strings and fragments carry arbitrary data. The window ends with the match
+        authority = separator + 3
+        path = window.find('/', authority)
+        if path < 0 or RE_URL_QUERY.search(window, authority, max(path, start)):
+            return False
+        # an URL nested in another one, e.g. in its query string, is data of the outer URL
+        outer = window.rfind('://', 0, separator)
+        if outer >= 0 and not RE_URL_BREAK.search(window, outer, separator):
+            return False
+        scheme = RE_SCHEME.search(window, max(0, separator - 5), separator)
+        return scheme is not None and self.allows_url(window[scheme.start():])
+
+@lru_cache(maxsize=8)
+def load_allowlist(path: Optional[str], defaults: bool) -> Allowlist:
+    # loaded once per process, workers receive only the options
+    return Allowlist.load(path, defaults)
+
+def allowlist_for(options: AnalysisOptions) -> Optional[Allowlist]:
+    allowlist = load_allowlist(options.allowlist, options.default_allowlist)
+    return allowlist if allowlist else None
+
+def allowlisted_report() -> IocReport:
+    # report of a known-clean document, which is never analyzed
+    return IocReport(hits=[], total_score=0, verdict='low_risk', allowlisted=True)
@@ -1,44 +1,136 @@
+import hashlib
 import json
-from pathlib import Path
 import zipfile
-from . import Pipeline
-from .file_pipelines.cfbf import CfbfPipeline
-from .file_pipelines.pdf import PdfPipeline
-from .file_pipelines.ooxml import OoxmlPipeline
-from .pdf import GeneratePdfPipeline
+from typing import Optional
+from . import AnalysisOptions, IocReport, Pipeline
+from .allowlist import allowlist_for, allowlisted_report
+from .cache import ResultCache, file_digest
+from .limits import enforced, exceeded, run_limited
+from .source import DocumentSource
+from .timings import Timings
+
+# file types selected by the `hint` of analyze_bytes, by name or file extension
+HINT_TYPES = {
+    'pdf': 'PDF',
+    'cfbf': 'CFBF', 'doc': 'CFBF', 'dot': 'CFBF', 'xls': 'CFBF', 'xlt': 'CFBF', 'ppt': 'CFBF', 'pot': 'CFBF', 'msg': 'CFBF',
+    'ooxml': 'OOXML', 'docx': 'OOXML', 'docm': 'OOXML', 'dotx': 'OOXML', 'dotm': 'OOXML',
+    'xlsx': 'OOXML', 'xlsm': 'OOXML', 'xltx': 'OOXML', 'xltm': 'OOXML',
+    'pptx': 'OOXML', 'pptm': 'OOXML', 'potx': 'OOXML', 'potm': 'OOXML', 'ppsx': 'OOXML', 'ppsm': 'OOXML',
+}
+
+def hinted_type(hint: Optional[str]) -> Optional[str]:
+    # 'OOXML', 'docx', '.docx' and 'invoice.docx' all name the same type
+    if not hint:
+        return None
+    return HINT_TYPES.get(str(hint).lower().rsplit('.', 1)[-1])
+
+def analyze_bytes(data, hint: Optional[str] = None, options: Optional[AnalysisOptions] = None) -> IocReport:
+    """
+    Analyze a document held in memory, e.g. a mail attachment, without a
+    temporary file. The type is detected from the content. `hint` is a type
+    name ('PDF', 'CFBF', 'OOXML') or a filename/extension and is only used
+    when the content does not identify the type. Never exits the process,
+    unsupported types raise NotImplementedError and parser failures their
+    own exceptions. Document limits of the options are enforced as in
+    AnalyzePipeline.
+    """
+    options = options or AnalysisOptions()
+    if enforced(options):
+        return run_limited(options, analyze_bytes, data, hint, options)
+
+    allowlist = allowlist_for(options)
+    if allowlist and allowlist.hashes and allowlist.known_clean(hashlib.sha256(data).hexdigest()):
+        return allowlisted_report()
+
+    with DocumentSource.from_bytes(data) as source:
+        return AnalyzePipeline(None, None, False, options).analyze_source(source, hint=hint)
+
+def analyze_path(filename, options: AnalysisOptions) -> IocReport:
+    # executed inside watchdog worker
+    return AnalyzePipeline(filename, None, False, options).analyze_file()
 
 class AnalyzePipeline(Pipeline):
-    def __init__(self, filename, output, pdf):
+    def __init__(self, filename, output, pdf, options: Optional[AnalysisOptions] = None, cache: Optional[ResultCache] = None):
         self.filename = filename
         self.output = output
         self.pdf = pdf
+        self.options = options or AnalysisOptions()
+        self.cache = cache
     
     def run(self):
-        calculated_type = self.detect_file_type(self.filename)
+        report = self.analyze()
+        self.write_report(report)
+            
+        return report    
+    
+    def analyze(self) -> IocReport:
+        digest = None
+        allowlist = allowlist_for(self.options)
+        if allowlist and allowlist.hashes:
+            # known-clean documents are not analyzed at all
+            digest = file_digest(self.filename)
+            if allowlist.known_clean(digest):
+                return allowlisted_report()
+
+        # a cached report would carry the timings of the run that produced it
+        if not self.cache or self.options.timings:
+            return self.analyze_file()
+
+        digest = digest or file_digest(self.filename)
+        report = self.cache.get(digest)
+        if report is None:
+            report = self.analyze_file()
+            if not exceeded(report):
+                self.cache.put(digest, report)
+        return report
+    
+    def analyze_file(self) -> IocReport:
+        if enforced(self.options):
+            # parsers run in a watchdog worker, a document over the limits gets a partial report
+            return run_limited(self.options, analyze_path, self.filename, self.options)
+
+        # file is mapped once, detector and pipeline share the mapping and parsed handles
+        with DocumentSource(self.filename) as source:
+            return self.analyze_source(source)
+    
+    def analyze_source(self, source: DocumentSource, nesting = None, hint: Optional[str] = None) -> IocReport:
+        timings = Timings(self.options.timings)
+        with timings.stage('detect'):
+            calculated_type = self.detect_file_type(source)
+        if calculated_type in ('ZIP', 'Unknown'):
+            calculated_type = hinted_type(hint) or calculated_type
         
-        report = None
+        # format pipelines are imported on demand, so only the parser library
+        # of the detected format (pypdf, olefile) gets loaded
         match calculated_type:
             case "PDF":
-                report = PdfPipeline(self.filename).run()
+                from .file_pipelines.pdf import PdfPipeline
+                report = PdfPipeline(self.filename, self.options, source, timings, nesting).run()
             case "CFBF":
-                report = CfbfPipeline(self.filename).run()
+                from .file_pipelines.cfbf import CfbfPipeline
+                report = CfbfPipeline(self.filename, self.options, source, timings, nesting).run()
             case "OOXML":
-                report = OoxmlPipeline(self.filename).run()
+                from .file_pipelines.ooxml import OoxmlPipeline
+                report = OoxmlPipeline(self.filename, self.options, source, timings, nesting).run()
             case _:
                 raise NotImplementedError('SDAT does not support this file type, aborting...')
-        
+
+        report.file_type = calculated_type
+        return report
+    
+    def write_report(self, report: IocReport):
         if self.pdf:
+            from .pdf import GeneratePdfPipeline
             GeneratePdfPipeline(self.output, content=report).run()
         else:
             with open(self.output, 'w') as f:
-                json.dump(report.to_dict(), f, indent=4)
-            
-        return report    
+                if self.options.compact:
+                    json.dump(report.to_dict(), f, separators=(',', ':'))
+                else:
+                    json.dump(report.to_dict(), f, indent=4)
     
-    def detect_file_type(self, path: str) -> str:
-        path = Path(path)
-        with open(path, "rb") as f:
-            header = f.read(8)
+    def detect_file_type(self, source: DocumentSource) -> str:
+        header = source.header(8)
 
         # Check PDF
         if header.startswith(b"%PDF-"):
@@ -49,17 +141,17 @@ class AnalyzePipeline(Pipeline):
         # Check ZIP / OOXML
         elif header.startswith(b"PK\x03\x04"):
             # further check internal files to ensure it's OOXML
-            if zipfile.is_zipfile(path):
-                with zipfile.ZipFile(path) as zf:
-                    names = zf.namelist()
-                    if any(n.startswith("word/") for n in names):
-                        return "OOXML"
-                    elif any(n.startswith("xl/") for n in names):
-                        return "OOXML"
-                    elif any(n.startswith("ppt/") for n in names):
-                        return "OOXML"
-                    else:
-                        return "ZIP"
-            return "ZIP"
+            try:
+                names = source.zip().namelist()
+            except zipfile.BadZipFile:
+                return "ZIP"
+            if any(n.startswith("word/") for n in names):
+                return "OOXML"
+            elif any(n.startswith("xl/") for n in names):
+                return "OOXML"
+            elif any(n.startswith("ppt/") for n in names):
+                return "OOXML"
+            else:
+                return "ZIP"
         else:
             return "Unknown"
\ No newline at end of file
@@ -0,0 +1,193 @@
+from collections import deque
+from concurrent.futures import BrokenExecutor, Future
+from contextlib import contextmanager
+from dataclasses import dataclass
+import glob
+import json
+import os
+from pathlib import Path
+import sys
+import time
+from typing import Iterable, Iterator, List, Optional, Tuple
+from . import AnalysisOptions, IocReport, Pipeline, output_paths
+from .analyze import AnalyzePipeline
+from .cache import ResultCache
+
+@dataclass
+class BatchResult:
+    filename: str
+    report: Optional[IocReport]
+    error: Optional[str]
+    # wall time of the analysis and size of the file, for metrics
+    seconds: float = 0.0
+    size: int = 0
+
+    def to_dict(self):
+        if self.error:
+            return { 'error': self.error }
+        return self.report.to_dict()
+
+    def to_json_line(self) -> str:
+        return json.dumps({ 'file': self.filename, **self.to_dict() }, separators=(',', ':'))
+
+def collect_files(target: str) -> List[Path]:
+    """
+    Expand scan target into list of files: directory (walked recursively),
+    glob pattern or '-' for newline separated paths on stdin.
+    """
+    if target == '-':
+        return [Path(line.strip()) for line in sys.stdin if line.strip()]
+
+    path = Path(target)
+    if path.is_dir():
+        return sorted(p for p in path.rglob('*') if p.is_file() and not is_report(p))
+    if path.is_file():
+        return [path]
+
+    return sorted(Path(p) for p in glob.glob(target, recursive=True) if os.path.isfile(p) and not is_report(Path(p)))
+
+def is_report(path: Path) -> bool:
+    # skip reports produced by previous runs over the same directory
+    return path.name.endswith(('.report.json', '.report.pdf'))
+
+def analyze_file(filename: Path, output: Optional[Path], pdf: bool, options: Optional[AnalysisOptions] = None,
+                 cache: Optional[ResultCache] = None) -> BatchResult:
+    # executed inside worker process, must stay importable at module level
+    start = time.perf_counter()
+    try:
+        size = os.path.getsize(filename)
+    except OSError:
+        size = 0
+    try:
+        pipeline = AnalyzePipeline(filename, output, pdf, options, cache)
+        report = pipeline.analyze()
+        if output:
+            pipeline.write_report(report)
+        return BatchResult(str(filename), report, None, time.perf_counter() - start, size)
+    except (Exception, SystemExit) as e:
+        return BatchResult(str(filename), None, f'{type(e).__name__}: {e}', time.perf_counter() - start, size)
+
+class BatchPipeline(Pipeline):
+    def __init__(self, files: Iterable[Path], out_dir = None, combined = None, workers = None, pdf = False,
+                 options: Optional[AnalysisOptions] = None, cache: Optional[ResultCache] = None, jsonl = None,
+                 metrics = None):
+        if sum(1 for output in (out_dir, combined, jsonl) if output) > 1:
+            raise ValueError('Provide only one of out_dir, combined and jsonl')
+
+        self.files = list(files)
+        self.out_dir = Path(out_dir) if out_dir else None
+        self.combined = combined
+        self.workers = workers or os.cpu_count() or 1
+        self.pdf = pdf
+        self.options = options or AnalysisOptions()
+        self.cache = cache
+        self.jsonl = jsonl
+        self.metrics = metrics
+        self.executor = None
+
+    def run(self) -> List[BatchResult]:
+        outputs = self.outputs()
+        results = []
+
+        with self.open_jsonl() as jsonl:
+            for result in self.analyze(outputs):
+                if result.error:
+                    print('ERROR analyzing', result.filename + ':', result.error, file=sys.stderr)
+                if self.metrics:
+                    self.metrics.record_result(result)
+                if jsonl:
+                    # written as soon as it is done, only the outcome is kept in memory
+                    jsonl.write(result.to_json_line() + '\n')
+                    jsonl.flush()
+                    result = BatchResult(result.filename, None, result.error)
+                results.append(result)
+
+        if self.combined:
+            self.write_combined(results)
+        if self.metrics:
+            self.metrics.flush()
+
+        return results
+
+    def analyze(self, outputs: List[Optional[Path]]) -> Iterator[BatchResult]:
+        """ Results in input order, yielded as soon as they are available. """
+        if self.workers == 1 or len(self.files) <= 1:
+            for f, o in zip(self.files, outputs):
+                yield analyze_file(f, o, self.pdf, self.options, self.cache)
+            return
+
+        # a few files per worker in flight, results are collected in input order
+        self.executor = self.start_executor()
+        pending = deque()
+        try:
+            for filename, output in zip(self.files, outputs):
+                pending.append(self.submit(filename, output))
+                if len(pending) >= self.workers * 4:
+                    yield self.collect(pending)
+            while pending:
+                yield self.collect(pending)
+        finally:
+            self.executor.shutdown(cancel_futures=True)
+
+    def start_executor(self, workers: Optional[int] = None):
+        # multiprocessing is only imported when files are analyzed in parallel
+        from concurrent.futures import ProcessPoolExecutor
+        return ProcessPoolExecutor(max_workers=workers or self.workers)
+
+    def submit(self, filename: Path, output: Optional[Path]) -> Tuple[Path, Optional[Path], Future, object]:
+        """ Pending entry of the file: (filename, output, future, executor it was submitted to). """
+        executor = self.executor
+        try:
+            future = executor.submit(analyze_file, filename, output, self.pdf, self.options, self.cache)
+        except Exception as e:
+            # a broken pool refuses new work, handled like its failed futures
+            future = Future()
+            future.set_exception(e)
+        return filename, output, future, executor
+
+    def collect(self, pending: deque) -> BatchResult:
+        filename, output, future, executor = pending.popleft()
+        try:
+            return future.result()
+        except BrokenExecutor:
+            # a worker died (e.g. killed by the OOM killer) and every file in flight failed with it
+            if executor is self.executor:
+                print('ERROR analysis worker died, restarting the worker pool', file=sys.stderr)
+                executor.shutdown(wait=False, cancel_futures=True)
+                self.executor = self.start_executor()
+            return self.retry(filename, output)
+
+    def retry(self, filename: Path, output: Optional[Path]) -> BatchResult:
+        # in a worker of its own, so a file that kills its worker again fails alone
+        try:
+            with self.start_executor(1) as executor:
+                return executor.submit(analyze_file, filename, output, self.pdf, self.options, self.cache).result()
+        except Exception as e:
+            return BatchResult(str(filename), None, f'{type(e).__name__}: {e}')
+
+    @contextmanager
+    def open_jsonl(self):
+        if not self.jsonl:
+            yield None
+        elif str(self.jsonl) == '-':
+            yield sys.stdout
+        else:
+            with open(self.jsonl, 'w') as f:
+                yield f
+
+    def outputs(self) -> List[Optional[Path]]:
+        if self.combined or self.jsonl:
+            return [None] * len(self.files)
+        # x.doc and x.docx get x.doc.report.json and x.docx.report.json
+        suffix = ".report.pdf" if self.pdf else ".report.json"
+        return output_paths(self.files, self.out_dir, lambda name: name + suffix)
+
+    def write_combined(self, results: List[BatchResult]):
+        combined = { r.filename: r.to_dict() for r in results }
+
+        if str(self.combined) == '-':
+            json.dump(combined, sys.stdout, indent=4)
+            sys.stdout.write('\n')
+        else:
+            with open(self.combined, 'w') as f:
+                json.dump(combined, f, indent=4)
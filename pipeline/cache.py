@@ -0,0 +1,141 @@
+from dataclasses import asdict
+import hashlib
+import json
+import os
+from pathlib import Path
+import re
+import shutil
+import tempfile
+import time
+from typing import Optional
+from . import AnalysisOptions, IocReport
+
+# bump when report semantics change in a way source hashing can not see
+ENGINE_VERSION = '1'
+DEFAULT_CACHE_DIR = Path(os.environ.get('XDG_CACHE_HOME', Path.home() / '.cache')) / 'sdat'
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+DEFAULT_MAX_AGE = 7 * 24 * 3600
+RE_VERSION_DIR = re.compile(r'[0-9a-f]{16}')
+# eviction walks the whole cache directory, so it only runs every N writes
+EVICT_EVERY = 64
+
+def file_digest(path) -> str:
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+def rules_version() -> str:
+    """
+    Fingerprint of the IOC rules and pipeline sources. Any change produces
+    a new cache namespace and entries of older versions are dropped.
+    """
+    from .file_pipelines import RULES
+
+    sha = hashlib.sha256(ENGINE_VERSION.encode())
+    for rule in RULES.rules.values():
+        sha.update(f'{rule.name}:{rule.score}:{rule.pattern.flags}:{rule.pattern.pattern}'.encode())
+
+    package = Path(__file__).parent
+    for source in sorted(package.rglob('*.py')):
+        sha.update(source.relative_to(package).as_posix().encode())
+        sha.update(source.read_bytes())
+
+    return sha.hexdigest()[:16]
+
+# complete reports do not depend on these, reports cut off at a limit are never cached
+UNKEYED_OPTIONS = ('document_time_limit', 'document_memory_limit')
+
+def options_digest(options: AnalysisOptions) -> str:
+    keyed = { name: value for name, value in asdict(options).items() if name not in UNKEYED_OPTIONS }
+    sha = hashlib.sha256(json.dumps(keyed, sort_keys=True, default=str).encode())
+    if options.allowlist:
+        # entries change the reports, the path alone does not identify them
+        sha.update(file_digest(options.allowlist).encode())
+    return sha.hexdigest()[:8]
+
+class ResultCache:
+    """
+    Content addressed on-disk cache of serialized IocReports, keyed by file
+    SHA-256 and analysis options inside a directory per rules version.
+    Entries are evicted by age and, oldest access first, when the cache
+    grows above max_bytes.
+    """
+    def __init__(self, directory = None, options: Optional[AnalysisOptions] = None,
+                 max_bytes: int = DEFAULT_MAX_BYTES, max_age: float = DEFAULT_MAX_AGE):
+        self.root = Path(directory) if directory else DEFAULT_CACHE_DIR
+        self.version = rules_version()
+        self.options = options_digest(options or AnalysisOptions())
+        self.directory = self.root / self.version
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.writes = 0
+
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.drop_stale_versions()
+
+    def entry(self, digest: str) -> Path:
+        return self.directory / digest[:2] / f'{digest}-{self.options}.json'
+
+    def get(self, digest: str) -> Optional[IocReport]:
+        path = self.entry(digest)
+        try:
+            if time.time() - path.stat().st_mtime > self.max_age:
+                path.unlink(missing_ok=True)
+                return None
+            with open(path, 'r') as f:
+                report = IocReport.from_dict(json.load(f))
+            # mtime doubles as last access time for eviction
+            os.utime(path)
+            return report
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+
+    def put(self, digest: str, report: IocReport):
+        path = self.entry(digest)
+        path.parent.mkdir(parents=True, exist_ok=True)
+
+        # write to temp file first, concurrent workers may store the same entry
+        fd, tmp = tempfile.mkstemp(dir=path.parent, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                entry = report.to_dict()
+                if report.file_type:
+                    # not part of reports, but metrics of cache hits need it
+                    entry['file_type'] = report.file_type
+                json.dump(entry, f)
+            os.replace(tmp, path)
+        except OSError:
+            Path(tmp).unlink(missing_ok=True)
+            return
+
+        self.writes += 1
+        if self.writes % EVICT_EVERY == 1:
+            self.evict()
+
+    def evict(self):
+        now = time.time()
+        entries = []
+        for path in self.directory.glob('*/*.json'):
+            try:
+                stat = path.stat()
+            except OSError:
+                continue
+            if now - stat.st_mtime > self.max_age:
+                path.unlink(missing_ok=True)
+            else:
+                entries.append((stat.st_mtime, stat.st_size, path))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries, key=lambda e: e[0]):
+            if total <= self.max_bytes:
+                break
+            path.unlink(missing_ok=True)
+            total -= size
+
+    def drop_stale_versions(self):
+        # entries produced by other rule versions can never be hit again
+        for path in self.root.iterdir():
+            if path.is_dir() and path.name != self.version and RE_VERSION_DIR.fullmatch(path.name):
+                shutil.rmtree(path, ignore_errors=True)
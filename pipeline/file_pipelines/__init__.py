@@ -1,8 +1,8 @@
-from collections import Counter
 import math
 import re
-from typing import List
-from .. import IocHit, IocReport
+from typing import Dict, Iterator, List
+from .. import CompactHit, IocHit, IocReport
+from .rules import Rule, RuleMatch, RuleSet, pattern_for
 
 RE_AUTO_MACRO = re.compile(r'\b(AutoOpen|AutoExec|Document_Open|Workbook_Open|Auto_Open)\b', re.IGNORECASE)
 RE_SHELL_CALL = re.compile(r'\b(CreateObject|ShellExecute|Shell\(|WScript\.|Run\(|cmd\.exe|powershell|mshta|osascript)\b', re.IGNORECASE)
@@ -12,97 +12,308 @@ RE_BASE64_CAND = re.compile(r'(?:[a-z0-9+/]{40,}={0,2})', re.IGNORECASE)
 RE_JS_EXEC = re.compile(r'eval|Function|this\.submitForm|app\.launchURL|util\.streamFromString', re.IGNORECASE)
 RE_JS_OBFUSCATION = re.compile(r'(String\.fromCharCode|\\x[0-9a-f]{2}|atob\(|btoa\(|unescape|charCodeAt)', re.IGNORECASE)
 RE_JS_TRIGGERS = re.compile(r'\b(mouseDown|pageOpen|OpenAction|/JavaScript)\b', re.IGNORECASE)
+RE_EMBED_EXE = re.compile(r'[\w\-\./ ]+\.(exe|dll|scr|bat|ps1|js|vbs)', re.IGNORECASE)
 
+# maximal runs of the character classes above, matched without backtracking
+RE_FILENAME_RUN = re.compile(r'[\w\-\./ ]+', re.IGNORECASE)
+RE_EXE_EXTENSION = re.compile(r'\.(exe|dll|scr|bat|ps1|js|vbs)', re.IGNORECASE)
+RE_BASE64_RUN = re.compile(r'([a-z0-9+/]+)={0,2}', re.IGNORECASE)
+# bytes versions of the filename patterns, ASCII \w plus every non-ASCII byte so UTF-8 names
+# (e.g. résumé.exe) match whole as they do in decoded text
+RE_EMBED_EXE_BYTES = re.compile(rb'[\w\-\./ \x80-\xff]+\.(exe|dll|scr|bat|ps1|js|vbs)', re.IGNORECASE)
+RE_FILENAME_RUN_BYTES = re.compile(rb'[\w\-\./ \x80-\xff]+', re.IGNORECASE)
+
+def find_embedded_filenames(text) -> Iterator[re.Match]:
+    """
+    RE_EMBED_EXE.finditer in linear time. The backtracking engine retries a
+    run of filename characters without extension from every position of the
+    run. A match can only start at the start of a run and greedily ends at the
+    last extension in it, so each run is searched for that extension once and
+    RE_EMBED_EXE is matched only on the span found.
+    """
+    if isinstance(text, str):
+        embed_exe, filename_run = RE_EMBED_EXE, RE_FILENAME_RUN
+    else:
+        embed_exe, filename_run = RE_EMBED_EXE_BYTES, RE_FILENAME_RUN_BYTES
+    extension = pattern_for(RE_EXE_EXTENSION, text)
+    for run in filename_run.finditer(text):
+        last = None
+        for last in extension.finditer(text, run.start(), run.end()):
+            pass
+        # at least one filename character has to precede the extension
+        if last is not None and last.start() > run.start():
+            yield embed_exe.match(text, run.start(), last.end())
+
+def find_base64_candidates(text) -> Iterator[re.Match]:
+    """ RE_BASE64_CAND.finditer without rescanning runs shorter than 40 characters. """
+    candidate = pattern_for(RE_BASE64_CAND, text)
+    for run in pattern_for(RE_BASE64_RUN, text).finditer(text):
+        if run.end(1) - run.start(1) >= 40:
+            yield candidate.match(text, run.start(), run.end())
+
+RULES = RuleSet([
+    Rule('auto_macro', RE_AUTO_MACRO, score=50),
+    Rule('shell_call', RE_SHELL_CALL, score=20),
+    Rule('url', RE_URL, score=15, allowlisted=True),
+    Rule('ip', RE_IP, score=15),
+    Rule('base64_candidate', RE_BASE64_CAND, score=15, finder=find_base64_candidates, allowlisted=True),
+    Rule('js_exec', RE_JS_EXEC, score=40),
+    Rule('js_obfuscation', RE_JS_OBFUSCATION, score=30),
+    Rule('js_triggers', RE_JS_TRIGGERS, score=25),
+    Rule('embedded_filename', RE_EMBED_EXE, score=40, finder=find_embedded_filenames),
+])
+
+# hit scores at which aggregate_report raises the verdict
+HIGH_RISK_SCORE = 50
+MEDIUM_RISK_SCORE = 25
+
+# longer matched values (e.g. base64 blobs) are cut in compact report evidence
+EVIDENCE_MAX_CHARS = 256
+
+# streams and archive members most likely to carry a payload, triage looks at them first
+RE_TRIAGE_FIRST = re.compile(r'vba|macros|embeddings|objectpool|ole10native|activex|\.bin$', re.IGNORECASE)
+
+# rule names consumed by each scanner
+MACRO_RULES = ('auto_macro', 'shell_call')
+JS_RULES = ('js_exec', 'js_obfuscation', 'js_triggers')
+NETWORK_RULES = ('url', 'ip')
+OBFUSCATION_RULES = ('base64_candidate',)
+EMBEDDED_FILENAME_RULES = ('embedded_filename',)
+
+def risk_level(score: float) -> int:
+    if score >= HIGH_RISK_SCORE:
+        return 2
+    if score >= MEDIUM_RISK_SCORE:
+        return 1
+    return 0
+
+def triage_order(name: str, size: int):
+    """ Sort key of streams in triage, likely payload carriers first, then smallest first. """
+    return (0 if RE_TRIAGE_FIRST.search(name) else 1, size)
+
+# highest MAX_SCORE of the pipelines (embedded_executable of OOXML), the most an embedded document can add
+MAX_PIPELINE_SCORE = 80
+
+class Triage:
+    """
+    Verdict tracking for triage mode. The verdict only depends on the highest
+    hit score, so a check is skipped when its score could not raise the
+    verdict reached so far, and a pipeline stops once not even its highest
+    scoring check, or a document embedded in it, could. A disabled instance needs every check, so pipelines
+    can use it unconditionally.
+    """
+    def __init__(self, enabled: bool, max_score: int):
+        self.enabled = enabled
+        # highest score any check of the pipeline or an embedded document can produce
+        self.max_score = max_score
+        self.score = 0
+
+    def needed(self, score: int) -> bool:
+        return not self.enabled or risk_level(score) > risk_level(self.score)
+
+    def add(self, hits: List[IocHit]) -> List[IocHit]:
+        for hit in hits:
+            self.score = max(self.score, hit.score)
+        return hits
+
+    @property
+    def done(self) -> bool:
+        return self.enabled and not self.needed(self.max_score)
+
+    def rules(self, names) -> tuple:
+        return tuple(name for name in names if self.needed(RULES[name].score))
+
+def attribute(hits: List[IocHit], stream: str) -> List[IocHit]:
+    # hits of nested documents keep the stream of the nested document
+    for hit in hits:
+        hit.stream = hit.stream or stream
+    return hits
+
+def signature_count(data, signature: bytes) -> int:
+    # bytes.count is fastest, other buffers (mmap slices) go through re which accepts any buffer
+    if isinstance(data, (bytes, bytearray)):
+        return data.count(signature)
+    return sum(1 for _ in re.finditer(re.escape(signature), data))
+
+# numpy is imported with the entropy engine on first use, cached reports never need it
 def entrophy_scan(data: bytes):
-    if not data:
-        return 0.0
-    
-    counts = Counter(data)
-    length = len(data)
-    ent = -sum((c/length) * math.log2(c/length) for c in counts.values())
-    return ent
+    from .entropy import shannon_entropy
+    return shannon_entropy(data)
 
-def macro_scan(text: str) -> List[IocHit]:
+def entropy_region_scan(data: bytes, location: str, threshold: float, window: int) -> List[IocHit]:
+    from .entropy import entropy_profile
+    return entropy_region_hits(entropy_profile(data, threshold, window), location)
+
+def entropy_region_hits(profile, location: str) -> List[IocHit]:
+    hits = []
+    window = profile.window
+
+    if profile.regions:
+        hits.append(IocHit(
+            name='high_entropy_region',
+            description=f'High entropy regions (window {window} bytes) in {location} at offsets {profile.regions}, which can indicate embedded payload',
+            score=10,
+            hits=len(profile.regions)
+        ))
+        
+    return hits
+
+def macro_scan(matches: Dict[str, RuleMatch]) -> List[IocHit]:
     hits = []
     
-    if RE_AUTO_MACRO.search(text):
+    if 'auto_macro' in matches:
         hits.append(IocHit(
             name='auto_macro',
             description='Suspisious macros are detected',
-            score=50,
-            hits=len(RE_AUTO_MACRO.findall(text))
+            score=RULES['auto_macro'].score,
+            hits=matches['auto_macro'].count,
+            evidence=matches['auto_macro'].evidence()
         ))
-    if RE_SHELL_CALL.search(text):
+    if 'shell_call' in matches:
         hits.append(IocHit(
             name='shell_call',
             description='Shell calls are detected',
-            score=20,
-            hits=len(RE_SHELL_CALL.findall(text))
+            score=RULES['shell_call'].score,
+            hits=matches['shell_call'].count,
+            evidence=matches['shell_call'].evidence()
         ))
         
     return hits
 
-def js_scan(text: str) -> List[IocHit]:
+def vba_module_scan(module: str, matches: Dict[str, RuleMatch]) -> List[IocHit]:
+    hits = []
+
+    if 'auto_macro' in matches:
+        hits.append(IocHit(
+            name='auto_macro',
+            description=f'Auto-run macros {matches["auto_macro"].unique()} in VBA module {module}',
+            score=RULES['auto_macro'].score,
+            hits=matches['auto_macro'].count,
+            evidence=matches['auto_macro'].evidence()
+        ))
+    if 'shell_call' in matches:
+        hits.append(IocHit(
+            name='shell_call',
+            description=f'Shell calls {matches["shell_call"].unique()} in VBA module {module}',
+            score=RULES['shell_call'].score,
+            hits=matches['shell_call'].count,
+            evidence=matches['shell_call'].evidence()
+        ))
+
+    return hits
+
+def js_scan(matches: Dict[str, RuleMatch]) -> List[IocHit]:
     hits = []
     
-    if RE_JS_EXEC.search(text):
+    if 'js_exec' in matches:
         hits.append(IocHit(
             name='js_exec',
             description='Suspicious JS execution primitives detected',
-            score=40,
-            hits=len(RE_JS_EXEC.findall(text))
+            score=RULES['js_exec'].score,
+            hits=matches['js_exec'].count,
+            evidence=matches['js_exec'].evidence()
         ))
         
-    if RE_JS_OBFUSCATION.search(text):
+    if 'js_obfuscation' in matches:
         hits.append(IocHit(
             name='js_obfuscation',
-            description=f'Obfuscation patterns detected in JavaScript: {RE_JS_OBFUSCATION.findall(text)}',
-            score=30,
-            hits=len(RE_JS_OBFUSCATION.findall(text))
+            description=f'Obfuscation patterns detected in JavaScript: {matches["js_obfuscation"].values}',
+            score=RULES['js_obfuscation'].score,
+            hits=matches['js_obfuscation'].count,
+            evidence=matches['js_obfuscation'].evidence()
         ))
         
-    if RE_JS_TRIGGERS.search(text):
+    if 'js_triggers' in matches:
         hits.append(IocHit(
             name='js_triggers',
-            description=f'PDF-triggered JavaScript hooks detected, {RE_JS_TRIGGERS.findall(text)}',
-            score=25,
-            hits=len(RE_JS_TRIGGERS.findall(text))
+            description=f'PDF-triggered JavaScript hooks detected, {matches["js_triggers"].values}',
+            score=RULES['js_triggers'].score,
+            hits=matches['js_triggers'].count,
+            evidence=matches['js_triggers'].evidence()
         ))
         
     return hits
 
-def network_scan(text: str) -> List[IocHit]:
+def network_scan(matches: Dict[str, RuleMatch]) -> List[IocHit]:
     hits = []
     
-    if RE_URL.search(text) or RE_IP.search(text):
-        urls = list(set(RE_URL.findall(text)))
-        ips = list(set(RE_IP.findall(text)))
+    if 'url' in matches or 'ip' in matches:
+        urls = matches.get('url', RuleMatch())
+        ips = matches.get('ip', RuleMatch())
         
         hits.append(IocHit(
             name='network_indicator',
-            description=f'Network indicators are detected: URLs: {urls}, IPs: {ips}',
-            score=15,
-            hits=len(RE_URL.findall(text)) + len(RE_IP.findall(text))
+            description=f'Network indicators are detected: URLs: {urls.unique()}, IPs: {ips.unique()}',
+            score=RULES['url'].score,
+            hits=urls.count + ips.count,
+            evidence=urls.evidence() + ips.evidence()
         ))
         
     return hits
 
-def obfuscation_scan(text: str) -> List[IocHit]:
+def obfuscation_scan(matches: Dict[str, RuleMatch]) -> List[IocHit]:
     hits = []
     
-    if RE_BASE64_CAND.search(text):
-        b64s = list(set(RE_BASE64_CAND.findall(text)))[:3]  # cap for brevity
+    if 'base64_candidate' in matches:
+        b64s = matches['base64_candidate'].unique()[:3]  # cap for brevity
 
         hits.append(IocHit(
             name='base64_candidate',
             description=f'Base64 candidates found (which could be a way to obfuscate content): {b64s}, ...',
-            score=15,
-            hits=len(RE_BASE64_CAND.findall(text))
+            score=RULES['base64_candidate'].score,
+            hits=matches['base64_candidate'].count,
+            evidence=matches['base64_candidate'].evidence()
         ))
         
     return hits
 
-def aggregate_report(stream_results: List[IocHit]) -> IocReport:
+def embedded_filename_scan(matches: Dict[str, RuleMatch]) -> List[IocHit]:
+    hits = []
+    
+    if 'embedded_filename' in matches:
+        hits.append(IocHit(
+            name='embedded_filename',
+            description=f'Embedded filenames are detected: {matches["embedded_filename"].unique()}',
+            score=RULES['embedded_filename'].score,
+            hits=matches['embedded_filename'].count,
+            evidence=matches['embedded_filename'].evidence()
+        ))
+        
+    return hits
+
+def budget_hit(description: str) -> IocHit:
+    return IocHit(
+        name='decompression_budget_exceeded',
+        description=description,
+        score=25,
+        hits=1
+    )
+
+def decode_error_hit(description: str) -> IocHit:
+    # content that could not be decoded was not analyzed, malformed streams also hide payloads from scanners
+    return IocHit(
+        name='stream_decode_error',
+        description=description,
+        score=10,
+        hits=1
+    )
+
+def rule_budget_scan(matches: Dict[str, RuleMatch], time_budget: float) -> List[IocHit]:
+    hits = []
+
+    for name, match in matches.items():
+        if match.truncated:
+            hits.append(IocHit(
+                name='rule_budget_exceeded',
+                description=f'IOC rule {name} exceeded time budget of {time_budget}s after {match.count} matches, scan truncated',
+                score=25,
+                hits=1
+            ))
+
+    return hits
+
+def aggregate_report(stream_results: List[IocHit], partial: bool = False, compact: bool = False,
+                     max_evidence: int = 10) -> IocReport:
     compressed_results = compress_hits(stream_results)
     
     total_score = 0
@@ -110,20 +321,58 @@ def aggregate_report(stream_results: List[IocHit]) -> IocReport:
         total_score += s.score * (math.log10(s.hits) + 1)
         
     report = {
-        'hits': stream_results,
+        'hits': compact_report_hits(stream_results, max_evidence) if compact else stream_results,
         'total_score': total_score,
-        'verdict': 'unknown'
+        'verdict': 'unknown',
+        'partial': partial
     }
     
-    if any(s.score >= 50 for s in stream_results):
+    if any(s.score >= HIGH_RISK_SCORE for s in stream_results):
         report['verdict'] = 'high_risk'
-    elif any(s.score >= 25 for s in stream_results):
+    elif any(s.score >= MEDIUM_RISK_SCORE for s in stream_results):
         report['verdict'] = 'medium_risk'
     else:
         report['verdict'] = 'low_risk'
         
     return IocReport(**report)
 
+def compact_report_hits(stream_results: List[IocHit], max_evidence: int) -> List[CompactHit]:
+    """
+    One hit per rule: hits summed, max score, at most max_evidence distinct
+    values and streams in order of first appearance. Description is kept for
+    hits without evidence only, the others repeat their evidence in it.
+    """
+    merged: Dict[str, CompactHit] = {}
+
+    for hit in stream_results:
+        compact = merged.get(hit.name)
+        if compact is None:
+            compact = merged[hit.name] = CompactHit(
+                name=hit.name,
+                description=None if hit.evidence is not None else hit.description,
+                score=hit.score,
+                hits=0
+            )
+        compact.hits += hit.hits
+        compact.score = max(compact.score, hit.score)
+
+        if hit.evidence is not None:
+            compact.description = None
+            compact.evidence = compact.evidence or []
+            for value in hit.evidence:
+                if len(compact.evidence) >= max_evidence:
+                    break
+                if isinstance(value, str) and len(value) > EVIDENCE_MAX_CHARS:
+                    value = value[:EVIDENCE_MAX_CHARS] + '...'
+                if value not in compact.evidence:
+                    compact.evidence.append(value)
+
+        location = ' > '.join(part for part in (hit.path, hit.stream) if part)
+        if location and (location in compact.streams or len(compact.streams) < max_evidence):
+            compact.streams[location] = compact.streams.get(location, 0) + hit.hits
+
+    return list(merged.values())
+
 def compress_hits(stream_results: List[IocHit]) -> List[IocHit]:
     """
     Merge hits of the same type into one, summing `hits` and taking max score.
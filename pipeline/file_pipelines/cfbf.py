@@ -1,112 +1,163 @@
-from typing import List
-from .. import IocHit, IocReport, Pipeline
-import sys, os, re
-from . import aggregate_report, entrophy_scan, macro_scan, network_scan, obfuscation_scan
-import olefile
+from typing import Dict, List, Optional
+from .. import AnalysisOptions, IocHit, IocReport, Pipeline
+import errno
+import sys, os
+from . import MACRO_RULES, NETWORK_RULES, OBFUSCATION_RULES, EMBEDDED_FILENAME_RULES
+from . import aggregate_report, embedded_filename_scan, macro_scan, network_scan, obfuscation_scan, rule_budget_scan
+from . import Triage, triage_order
+from .chunked import StreamChecks
+from .rules import RuleMatch
+from .nested import Nesting
+from .parallel import StreamPool
+from .vba import read_vba_modules, scan_vba_modules
+from ..allowlist import allowlist_for
+from ..source import DocumentSource, open_source
+from ..timings import Timings
 
 
 class CfbfPipeline(Pipeline):
     ENTROPY_THRESHHOLD = 7.5
-    RE_EMBED_EXE = re.compile(r'[\w\-\./ ]+\.(exe|dll|scr|bat|ps1|js|vbs)', re.IGNORECASE)
-    RE_MZ = re.compile(br'MZ')   # binary search
+    RULE_NAMES = MACRO_RULES + NETWORK_RULES + OBFUSCATION_RULES + EMBEDDED_FILENAME_RULES
+    # auto_macro
+    MAX_SCORE = 50
     
-    def __init__(self, filename):
+    def __init__(self, filename, options: Optional[AnalysisOptions] = None, source: Optional[DocumentSource] = None,
+                 timings: Optional[Timings] = None, nesting: Optional[Nesting] = None):
         self.filename = filename
+        self.options = options or AnalysisOptions()
+        self.source = source
+        self.timings = timings or Timings(self.options.timings)
+        self.nesting = nesting or Nesting(self.options)
+        # embedded documents can score above the checks of this pipeline
+        self.triage = Triage(self.options.triage, self.nesting.max_score(self.MAX_SCORE))
+        self.pool = StreamPool(self.options, self.timings)
+        # module streams, scanned as decompressed source instead of raw bytes
+        self.vba_streams = set()
     
     def run(self) -> IocReport:
-        if not os.path.isfile(self.filename):
-            print('ERROR: file not found:', self.filename, file=sys.stderr); sys.exit(2)
-
-        try:
-            streams = self.list_streams_with_ole(self.filename)
-        except Exception as e:
-            print('ERROR reading OLE file with olefile:', e, file=sys.stderr)
-            streams = self.list_streams_fallback(self.filename)
+        if self.source is None and not os.path.isfile(self.filename):
+            raise FileNotFoundError(errno.ENOENT, 'file not found', str(self.filename))
 
         stream_results = []
-        for data in streams:
-            res = self.analyze_stream(data, entropy_threshold=CfbfPipeline.ENTROPY_THRESHHOLD)
-            stream_results += res
+        with open_source(self.filename, self.source) as source, self.timings.stage('analyze', source.size):
+            self.nesting.enter(source)
+            modules = []
+            try:
+                with self.timings.stage('extract', source.size):
+                    streams = self.list_streams_with_ole(source)
+            except Exception as e:
+                print('ERROR reading OLE file with olefile:', e, file=sys.stderr)
+                streams = self.list_streams_fallback(source)
+            else:
+                # a broken VBA project must not cost the streams listed above
+                try:
+                    with self.timings.stage('vba'):
+                        modules = read_vba_modules(source.ole(), self.options.max_member_bytes, self.nesting.budget.vba)
+                except Exception as e:
+                    print('ERROR reading VBA project:', e, file=sys.stderr)
+                    modules = []
+
+            # macro source is the cheapest and most decisive check, it goes first
+            self.vba_streams = { module.stream for module in modules }
+            stream_results += self.triage.add(scan_vba_modules(
+                modules, self.triage.rules(self.RULE_NAMES), self.timings, self.options.rule_time_budget,
+                allowlist_for(self.options)
+            ))
+
+            self.pool = StreamPool.for_document(self.options, self.timings, source.size)
+            with self.pool:
+                analyzed = self.pool.map(self, 'analyze_stream', streams,
+                                         lambda s: (s[0], len(s[1]), (s[1], CfbfPipeline.ENTROPY_THRESHHOLD, s[0], s[0] not in self.vba_streams)))
+                for (name, data), res in (() if self.triage.done else analyzed):
+                    stream_results += self.triage.add(res)
+                    if not self.triage.done:
+                        with self.timings.stage('nested', len(data)):
+                            stream_results += self.triage.add(self.nesting.scan(name, data))
+                    if self.triage.done:
+                        break
 
-        report = aggregate_report(stream_results)
+        report = aggregate_report(stream_results, self.triage.enabled, self.options.compact, self.options.max_evidence)
+        if self.timings.enabled:
+            report.timings = self.timings.to_dict()
 
         return report
 
     
-    def analyze_stream(self, data: bytes, entropy_threshold: int) -> List[IocHit]:
+    def analyze_stream(self, data: bytes, entropy_threshold: int, name: str = '', scan_text: bool = True) -> List[IocHit]:
         hits = []
+        signatures = tuple(s for s, score in ((b'MZ', 40), (b'PK\x03\x04', 20)) if self.triage.needed(score))
+        rule_names = self.triage.rules(self.RULE_NAMES) if scan_text else ()
+        # streams larger than a chunk are read once for all checks below
+        checks = StreamChecks(data, self.pool, signatures, self.triage.needed(10), rule_names)
 
         # binary checks
-        if CfbfPipeline.RE_MZ.search(data):
+        mz_count = checks.signature_count(b'MZ') if self.triage.needed(40) else 0
+        if mz_count:
             hit = {}
             hit['name'] = 'embedded_MZ'
             hit['description'] = 'Document likely contains embedded MZ'
-            hit['hits'] = len(CfbfPipeline.RE_MZ.findall(data))
+            hit['hits'] = mz_count
             hit['score'] = 40
             hits.append(IocHit(**hit))
 
         # look for PK (zip) signatures (embedded docx/zip)
-        if b'PK\x03\x04' in data:
+        pk_count = checks.signature_count(b'PK\x03\x04') if self.triage.needed(20) else 0
+        if pk_count:
             hit = {}
             hit['name'] = 'embedded_PK_zip'
             hit['description'] = 'Document likely contains embedded CFBF/zip'
-            hit['hits'] = len(re.compile(b'PK\x03\x04').findall(data))
+            hit['hits'] = pk_count
             hit['score'] = 20
             hits.append(IocHit(**hit))
             
         # high entropy
-        ent = entrophy_scan(data)
-        if ent >= entropy_threshold:
-            hit = {}
-            hit['name'] = 'high_entropy'
-            hit['description'] = f'High entropy of {ent} detected in one of CFBF streams which can indicate raw binary data embedded into the document'
-            hit['hits'] = 1
-            hit['score'] = 10
-            hits.append(IocHit(**hit))
-                        
-        # try to decode as text for regex scanning
-        try:
-            text = data.decode('utf-8', errors='replace')
-        except Exception:
-            text = data.decode('latin-1', errors='replace')
+        if self.triage.needed(10):
+            ent = checks.entropy()
+            if ent >= entropy_threshold:
+                hit = {}
+                hit['name'] = 'high_entropy'
+                hit['description'] = f'High entropy of {ent} detected in one of CFBF streams which can indicate raw binary data embedded into the document'
+                hit['hits'] = 1
+                hit['score'] = 10
+                hits.append(IocHit(**hit))
+            elif self.options.entropy_map:
+                hits += checks.entropy_regions(f'CFBF stream {name}', entropy_threshold)
+
+        if not rule_names:
+            return hits
 
-        hits += self.score_stream_texts(text)
+        hits += self.score_matches(checks.matches(rule_names))
                    
         return hits
 
-    def list_streams_with_ole(self, path: str):
-        ole = olefile.OleFileIO(path)
-        streams = []
-        for entry in ole.listdir(streams=True, storages=False):
+    def list_streams_with_ole(self, source: DocumentSource):
+        ole = source.ole()
+        entries = ole.listdir(streams=True, storages=False)
+        if self.triage.enabled:
+            # read lazily, streams after the one settling the verdict are never read
+            entries.sort(key=lambda entry: triage_order('/'.join(entry), ole.get_size(entry)))
+            return self.timings.iterate('extract', self.read_streams(ole, entries), lambda s: len(s[1]))
+        return list(self.read_streams(ole, entries))
+
+    def read_streams(self, ole, entries):
+        for entry in entries:
             try:
                 data = ole.openstream(entry).read()
             except Exception:
                 data = b''
-            streams.append(data)
-        ole.close()
-        return streams
+            yield '/'.join(entry), data
     
-    def list_streams_fallback(self, path: str):
+    def list_streams_fallback(self, source: DocumentSource):
         # Very limited fallback: returns a single "Raw" stream containing whole file.
-        with open(path, 'rb') as f:
-            data = f.read()
-        return [data]
+        return [('<raw>', source.view)]
 
     
-    def score_stream_texts(self, text: str) -> List[IocHit]:
+    def score_matches(self, matches: Dict[str, RuleMatch]) -> List[IocHit]:
         hits = []
-        hits += macro_scan(text)
-        hits += network_scan(text)
-        hits += obfuscation_scan(text)
-        
-        if CfbfPipeline.RE_EMBED_EXE.search(text):
-            fnames = list(set(CfbfPipeline.RE_EMBED_EXE.findall(text)))
-
-            hits.append(IocHit(
-                name='embedded_filename',
-                description=f'Embedded filenames are detected: {fnames}',
-                score=40,
-                hits=len(CfbfPipeline.RE_EMBED_EXE.findall(text))
-            ))
+        hits += macro_scan(matches)
+        hits += network_scan(matches)
+        hits += obfuscation_scan(matches)
+        hits += embedded_filename_scan(matches)
+        hits += rule_budget_scan(matches, self.options.rule_time_budget)
             
-        return hits
\ No newline at end of file
+        return hits
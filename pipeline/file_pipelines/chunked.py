@@ -0,0 +1,130 @@
+from typing import Dict, Iterator, List, Tuple
+from .. import AnalysisOptions, IocHit
+from ..allowlist import allowlist_for
+from ..timings import Timings
+from . import RULES, entrophy_scan, entropy_region_hits, entropy_region_scan, signature_count
+from .rules import RuleMatch
+
+# bytes no rule can match across: every pattern stops at line breaks, quotes and
+# angle brackets. Chunks cut right after one scan exactly like the whole stream
+CHUNK_SEPARATORS = b'\n"\'<>'
+
+def chunk_bounds(data, size: int, overlap: int) -> Iterator[Tuple[int, int, int, int]]:
+    """
+    Yields (left, lo, hi, right) for consecutive chunks data[lo:hi] of about
+    `size` bytes. A chunk ends after the last separator within `overlap`
+    bytes of its nominal end, no match crosses such a cut. Without a
+    separator both neighbours are scanned with `overlap` bytes of context
+    data[left:lo] and data[hi:right], only matches longer than that may then
+    differ from the whole stream.
+    """
+    size = max(size, overlap * 2, 1)
+    lo, clean = 0, True
+    while lo < len(data):
+        hi = min(lo + size, len(data))
+        left, cut = lo, True
+        if not clean:
+            left = max(0, lo - overlap)
+
+        if hi < len(data):
+            window = bytes(data[hi - overlap:hi])
+            last = max(window.rfind(separator) for separator in CHUNK_SEPARATORS)
+            if last >= 0:
+                hi = hi - overlap + last + 1
+            else:
+                cut = False
+
+        right = hi if cut else min(len(data), hi + overlap)
+        yield left, lo, hi, right
+        lo, clean = hi, cut
+
+def scan_chunk_task(chunk: bytes, start: int, stop: int, names: tuple, options: AnalysisOptions):
+    """
+    Scans a chunk with its context and keeps matches starting in
+    chunk[start:stop], matches starting in the context belong to the
+    neighbouring chunks. Executed inside worker processes too.
+    """
+    timings = Timings(options.timings)
+    matches = RULES.scan_bytes(chunk, names, timings, options.rule_time_budget, span=(start, stop),
+                               allowlist=allowlist_for(options))
+    return matches, timings
+
+def merge_matches(merged: Dict[str, RuleMatch], matches: Dict[str, RuleMatch]):
+    for name, match in matches.items():
+        merged.setdefault(name, RuleMatch()).merge(match)
+
+class StreamChecks:
+    """
+    Signature counts, entropy and rule matches of one stream. Streams up to
+    `stream_chunk_bytes` are checked in memory when asked. Larger ones are
+    read once in chunks (see chunk_bounds) and every check requested up
+    front is computed on the way, so no second pass over the stream is
+    needed and results match the in-memory checks. Rules run on the bytes,
+    nothing but matched values is decoded.
+    """
+    def __init__(self, data, pool, signatures: Tuple[bytes, ...] = (), entropy: bool = False, rule_names: tuple = ()):
+        self.data = data
+        self.pool = pool
+        self.options = pool.options
+        self.timings = pool.timings
+        self.counts: Dict[bytes, int] = {}
+        self.incremental = None
+        self.scanned = None
+
+        # chunked text of parallel pools is scanned by the workers
+        if len(data) > self.options.stream_chunk_bytes and not pool.parallel:
+            self.scan_chunks(signatures, entropy, rule_names)
+
+    def scan_chunks(self, signatures: Tuple[bytes, ...], entropy: bool, rule_names: tuple):
+        from .entropy import IncrementalEntropy
+
+        window = self.options.entropy_window if self.options.entropy_map else 0
+        self.incremental = IncrementalEntropy(window) if entropy else None
+        self.counts = { signature: 0 for signature in signatures }
+        self.scanned = {} if rule_names else None
+        # signatures starting in a chunk may end in the next one
+        pad = max((len(s) - 1 for s in signatures), default=0)
+
+        for left, lo, hi, right in chunk_bounds(self.data, self.options.stream_chunk_bytes, self.options.stream_chunk_overlap):
+            block = bytes(self.data[left:max(right, min(len(self.data), hi + pad))])
+            for signature in signatures:
+                # signatures are not self-overlapping, so counting from lo is exact
+                self.counts[signature] += block.count(signature, lo - left, hi - left + len(signature) - 1)
+            if self.incremental is not None:
+                with self.timings.stage('entropy', hi - lo):
+                    self.incremental.update(memoryview(block)[lo - left:hi - left])
+            if rule_names:
+                matches, timings = scan_chunk_task(block[:right - left], lo - left, hi - left, rule_names, self.options)
+                self.timings.merge(timings)
+                merge_matches(self.scanned, matches)
+
+        if self.scanned is not None:
+            # same key order as a single RULES.scan
+            self.scanned = { name: self.scanned[name] for name in rule_names if name in self.scanned }
+
+    def signature_count(self, signature: bytes) -> int:
+        if signature not in self.counts:
+            self.counts[signature] = signature_count(self.data, signature)
+        return self.counts[signature]
+
+    def entropy(self) -> float:
+        if self.incremental is not None:
+            return self.incremental.entropy()
+        with self.timings.stage('entropy', len(self.data)):
+            return entrophy_scan(self.data)
+
+    def entropy_regions(self, location: str, threshold: float) -> List[IocHit]:
+        if self.incremental is not None and self.incremental.window:
+            return entropy_region_hits(self.incremental.profile(threshold), location)
+        return entropy_region_scan(self.data, location, threshold, self.options.entropy_window)
+
+    def matches(self, rule_names: tuple) -> Dict[str, RuleMatch]:
+        if self.scanned is not None:
+            return self.scanned
+        if self.pool.chunked(len(self.data)):
+            # large streams are scanned in chunks by the workers
+            return self.pool.scan(self.data, rule_names)
+
+        # straight on the buffer, no decoded copy of the stream
+        return RULES.scan_bytes(self.data, rule_names, self.timings, self.options.rule_time_budget,
+                                allowlist=allowlist_for(self.options))
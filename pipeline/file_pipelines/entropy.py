@@ -0,0 +1,129 @@
+from dataclasses import dataclass, field
+from typing import List, Tuple
+import numpy as np
+
+# number of windows histogrammed per numpy call, bounds temporary memory
+WINDOW_BATCH = 1024
+# bincount casts its input to intp, histogram large buffers slice by slice
+HISTOGRAM_SLICE = 1 << 22
+
+@dataclass
+class EntropyProfile:
+    window: int
+    entropies: np.ndarray
+    regions: List[Tuple[int, int]] = field(default_factory=list)
+
+def byte_histogram(data) -> np.ndarray:
+    arr = np.frombuffer(data, dtype=np.uint8)
+    counts = np.zeros(256, dtype=np.int64)
+    for start in range(0, len(arr), HISTOGRAM_SLICE):
+        counts += np.bincount(arr[start:start + HISTOGRAM_SLICE], minlength=256)
+    return counts
+
+def histogram_entropy(counts: np.ndarray) -> float:
+    length = counts.sum()
+    if not length:
+        return 0.0
+
+    p = counts[counts > 0] / length
+    return float(-(p * np.log2(p)).sum())
+
+def shannon_entropy(data) -> float:
+    if not len(data):
+        return 0.0
+
+    return histogram_entropy(byte_histogram(data))
+
+def window_entropies(data, window: int) -> np.ndarray:
+    """
+    Entropy of every consecutive `window` sized block of data. Trailing block
+    shorter than the window is measured on its own length.
+    """
+    arr = np.frombuffer(data, dtype=np.uint8)
+    full = len(arr) // window
+    entropies = np.empty(full + (1 if len(arr) % window else 0), dtype=np.float64)
+
+    for start in range(0, full, WINDOW_BATCH):
+        stop = min(full, start + WINDOW_BATCH)
+        block = arr[start * window:stop * window].reshape(stop - start, window)
+
+        # offset every row into its own 256 bucket range so one bincount
+        # histograms the whole batch
+        rows = np.arange(stop - start, dtype=np.int64)[:, None] * 256
+        counts = np.bincount((block + rows).ravel(), minlength=(stop - start) * 256).reshape(-1, 256)
+
+        p = counts / window
+        with np.errstate(divide='ignore', invalid='ignore'):
+            terms = np.where(counts > 0, p * np.log2(p), 0.0)
+        entropies[start:stop] = -terms.sum(axis=1)
+
+    if len(arr) % window:
+        entropies[-1] = shannon_entropy(arr[full * window:])
+
+    return entropies
+
+def entropy_profile(data, threshold: float, window: int = 4096) -> EntropyProfile:
+    """
+    Windowed entropy of data with offsets of contiguous high entropy regions,
+    so small payloads are not averaged away by the rest of the stream.
+    """
+    return regions_profile(window_entropies(data, window), threshold, window, len(data))
+
+def regions_profile(entropies: np.ndarray, threshold: float, window: int, length: int) -> EntropyProfile:
+    profile = EntropyProfile(window=window, entropies=entropies)
+
+    above = entropies >= threshold
+    if not above.any():
+        return profile
+
+    # rising/falling edges of the above-threshold mask give region boundaries
+    edges = np.diff(np.concatenate(([0], above.astype(np.int8), [0])))
+    starts = np.flatnonzero(edges == 1)
+    ends = np.flatnonzero(edges == -1)
+    profile.regions = [
+        (int(s) * window, min(int(e) * window, length)) for s, e in zip(starts, ends)
+    ]
+
+    return profile
+
+class IncrementalEntropy:
+    """
+    shannon_entropy and entropy_profile of data fed piece by piece, with the
+    same results as on the whole data. Only the byte histogram, one entropy
+    per window and the bytes of an incomplete window are kept.
+    """
+    def __init__(self, window: int = 0):
+        self.counts = np.zeros(256, dtype=np.int64)
+        self.length = 0
+        # windowed entropies are only computed with a window
+        self.window = window
+        self.entropies: List[np.ndarray] = []
+        self.carry = b''
+
+    def update(self, data):
+        self.counts += byte_histogram(data)
+        self.length += len(data)
+        if not self.window:
+            return
+
+        if self.carry:
+            # complete the window left over from the previous piece first
+            missing = self.window - len(self.carry)
+            self.carry += bytes(data[:missing])
+            data = memoryview(data)[missing:]
+            if len(self.carry) < self.window:
+                return
+            self.entropies.append(window_entropies(self.carry, self.window))
+            self.carry = b''
+
+        full = len(data) // self.window * self.window
+        if full:
+            self.entropies.append(window_entropies(memoryview(data)[:full], self.window))
+        self.carry = bytes(data[full:])
+
+    def entropy(self) -> float:
+        return histogram_entropy(self.counts) if self.length else 0.0
+
+    def profile(self, threshold: float) -> EntropyProfile:
+        entropies = self.entropies + ([np.array([shannon_entropy(self.carry)])] if self.carry else [])
+        return regions_profile(np.concatenate(entropies or [np.empty(0)]), threshold, self.window, self.length)
@@ -0,0 +1,107 @@
+from dataclasses import replace
+import hashlib
+import re
+import sys
+from typing import List, Optional, Set
+from .. import AnalysisOptions, IocHit
+from ..allowlist import allowlist_for
+from ..source import DocumentSource
+from . import MAX_PIPELINE_SCORE, budget_hit
+from .vba import DecompressCache
+
+# headers of the documents SDAT can analyze (zip/OOXML, CFBF, PDF), searched for inside every stream
+RE_CONTAINER = re.compile(rb'PK\x03\x04|\xD0\xCF\x11\xE0\xA1\xB1\x1A\xE1|%PDF-')
+
+def container_offset(data) -> int:
+    """ Offset of the first embedded document header in data, -1 if there is none. """
+    # re accepts any buffer, mmap slices included
+    match = RE_CONTAINER.search(data)
+    return match.start() if match else -1
+
+class NestingBudget:
+    """ State shared by all levels of one top-level document. """
+    def __init__(self, options: AnalysisOptions):
+        self.remaining = options.max_nested_bytes
+        self.seen: Set[str] = set()
+        # top-level document, hashed on the first embedded candidate
+        self.root = None
+        # VBA containers decompressed at any level
+        self.vba = DecompressCache()
+
+class Nesting:
+    """
+    Recursive analysis of documents embedded in streams (OLE objects in
+    OOXML, zips in Ole10Native, PDF attachments, ...). The embedded document
+    is handed to the pipeline of its type in memory, its hits are returned
+    with `path` set to where it was found. Bounded by nesting depth and a
+    total byte budget, identical payloads are analyzed once.
+    """
+    def __init__(self, options: AnalysisOptions, path: str = '', depth: int = 0,
+                 budget: Optional[NestingBudget] = None):
+        # nested hits are compacted with the hits of the top-level document
+        self.options = replace(options, compact=False)
+        self.path = path
+        self.depth = depth
+        self.budget = budget or NestingBudget(options)
+
+    def max_score(self, own: int) -> int:
+        """
+        Highest score a pipeline whose own checks reach `own` can report,
+        hits of embedded documents included. Triage must not settle below it.
+        """
+        if not self.options.max_nesting_depth or self.depth >= self.options.max_nesting_depth:
+            return own
+        return max(own, MAX_PIPELINE_SCORE)
+
+    def enter(self, source: DocumentSource):
+        # the document itself must never be analyzed as its own embedded document
+        if self.depth == 0:
+            self.budget.root = source.view
+
+    def scan(self, name: str, data) -> List[IocHit]:
+        if not self.options.max_nesting_depth or not len(data):
+            return []
+        offset = container_offset(data)
+        if offset < 0:
+            return []
+
+        path = f'{self.path} > {name}' if self.path else name
+        # hashed in place, the payload is only copied once it is within budget
+        payload = memoryview(data)[offset:]
+        if self.budget.root is not None:
+            self.budget.seen.add(hashlib.sha256(self.budget.root).hexdigest())
+            self.budget.root = None
+        digest = hashlib.sha256(payload).hexdigest()
+        if digest in self.budget.seen:
+            return []
+        allowlist = allowlist_for(self.options)
+        if allowlist and allowlist.known_clean(digest):
+            return []
+        self.budget.seen.add(digest)
+
+        if self.depth >= self.options.max_nesting_depth:
+            return [budget_hit(f'Embedded document in {path} exceeds nesting depth of {self.options.max_nesting_depth}, not analyzed')]
+        if len(payload) > self.budget.remaining:
+            return [budget_hit(
+                f'Embedded document in {path} ({len(payload)} bytes) exceeds remaining nested analysis budget '
+                f'of {self.budget.remaining} bytes, not analyzed'
+            )]
+        self.budget.remaining -= len(payload)
+        payload = bytes(payload)
+
+        from ..analyze import AnalyzePipeline
+        nested = Nesting(self.options, path, self.depth + 1, self.budget)
+        try:
+            with DocumentSource.from_bytes(payload) as source:
+                report = AnalyzePipeline(None, None, False, self.options).analyze_source(source, nested)
+        except NotImplementedError:
+            # plain zip or a false positive header, nothing SDAT can analyze
+            return []
+        except Exception as e:
+            print('ERROR analyzing embedded document in', path + ':', e, file=sys.stderr)
+            return []
+
+        # hits of deeper levels already carry their full path
+        for hit in report.hits:
+            hit.path = hit.path or path
+        return report.hits
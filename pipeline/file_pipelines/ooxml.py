@@ -1,36 +1,85 @@
-import math
+import errno
 import os
-import re
 import sys
-from typing import List
-from .. import IocHit, IocReport, Pipeline
+from typing import Dict, Iterator, List, Optional, Tuple
+from .. import AnalysisOptions, IocHit, IocReport, Pipeline
 import zipfile
-from . import aggregate_report, entrophy_scan, macro_scan, network_scan, obfuscation_scan
+import zlib
+from . import MACRO_RULES, NETWORK_RULES, OBFUSCATION_RULES, EMBEDDED_FILENAME_RULES
+from . import aggregate_report, budget_hit, embedded_filename_scan, macro_scan, network_scan, obfuscation_scan, rule_budget_scan
+from . import Triage, triage_order
+from .chunked import StreamChecks
+from .rules import RuleMatch
+from .nested import Nesting
+from .parallel import StreamPool
+from .vba import is_vba_project, read_vba_project, scan_vba_modules
+from ..allowlist import allowlist_for
+from ..source import DocumentSource, open_source
+from ..timings import Timings
 
 class OoxmlPipeline(Pipeline):
     ENTROPY_THRESHHOLD = 7.5
-    RE_EMBED_EXE = re.compile(r'[\w\-\./ ]+\.(exe|dll|scr|bat|ps1|js|vbs)', re.IGNORECASE)
-    RE_MZ = re.compile(br'MZ')   # binary search
+    READ_CHUNK = 1 << 20
+    # small parts (e.g. repetitive XML) compress very well, ratio is checked above this size only
+    RATIO_MIN_BYTES = 1 << 20
+    RULE_NAMES = MACRO_RULES + NETWORK_RULES + OBFUSCATION_RULES + EMBEDDED_FILENAME_RULES
+    # embedded_executable
+    MAX_SCORE = 80
     
-    def __init__(self, filename):
+    def __init__(self, filename, options: Optional[AnalysisOptions] = None, source: Optional[DocumentSource] = None,
+                 timings: Optional[Timings] = None, nesting: Optional[Nesting] = None):
         self.filename = filename
+        self.options = options or AnalysisOptions()
+        self.source = source
+        self.timings = timings or Timings(self.options.timings)
+        self.nesting = nesting or Nesting(self.options)
+        # embedded documents can score above the checks of this pipeline
+        self.triage = Triage(self.options.triage, self.nesting.max_score(self.MAX_SCORE))
+        self.pool = StreamPool(self.options, self.timings)
     
     def run(self) -> IocReport:
-        if not os.path.isfile(self.filename):
-            print('ERROR: file not found:', self.filename, file=sys.stderr); sys.exit(2)
-
-        try:
-            streams = self.list_streams_ooxml(self.filename)
-        except Exception as e:
-            print('ERROR reading OOXML file:', e, file=sys.stderr)
-            streams = self.list_streams_fallback(self.filename)
+        if self.source is None and not os.path.isfile(self.filename):
+            raise FileNotFoundError(errno.ENOENT, 'file not found', str(self.filename))
 
         stream_results = []
-        for name, data in streams:
-            res = self.analyze_zip_stream(name, data)
-            stream_results += res
+        with open_source(self.filename, self.source) as source, self.timings.stage('analyze', source.size):
+            self.nesting.enter(source)
+            try:
+                archive = source.zip()
+            except Exception as e:
+                print('ERROR reading OOXML file:', e, file=sys.stderr)
+                archive = None
+
+            if archive is None:
+                for name, data in self.list_streams_fallback(source):
+                    with self.timings.stream(name, len(data)):
+                        stream_results += self.analyze_zip_stream(name, data)
+            else:
+                if self.triage.enabled:
+                    # member names are checked before anything is decompressed
+                    for name in archive.namelist():
+                        stream_results += self.triage.add(self.embedded_object_scan(name))
 
-        report = aggregate_report(stream_results)
+                # members are decompressed and analyzed one at a time (a few per
+                # worker when parallel), so only budget bounded members are held in memory
+                members = self.timings.iterate('extract', self.iter_streams_ooxml(archive), lambda m: len(m[1]))
+                self.pool = StreamPool.for_document(self.options, self.timings, source.size)
+                with self.pool:
+                    analyzed = self.pool.map(self, 'analyze_zip_stream', () if self.triage.done else members,
+                                             lambda m: (m[0], len(m[1]), (m[0], m[1])))
+                    for (name, data, budget_hits), hits in analyzed:
+                        stream_results += self.triage.add(budget_hits)
+                        stream_results += self.triage.add(hits)
+                        # VBA projects are OLE files too, their modules were already scanned
+                        if not self.triage.done and not is_vba_project(name):
+                            with self.timings.stage('nested', len(data)):
+                                stream_results += self.triage.add(self.nesting.scan(name, data))
+                        if self.triage.done:
+                            break
+
+        report = aggregate_report(stream_results, self.triage.enabled, self.options.compact, self.options.max_evidence)
+        if self.timings.enabled:
+            report.timings = self.timings.to_dict()
 
         return report
 
@@ -38,63 +87,118 @@ class OoxmlPipeline(Pipeline):
     def analyze_zip_stream(self, name: str, data: bytes):
         hits = []
 
-        # OLE objects embedded in OOXML
-        if name.lower().startswith(('word/embeddings/', 'xl/embeddings/', 'ppt/embeddings/')):
-            hits.append(IocHit(name='embedded_ole_object', description=f'Embedded OLE: {name}', hits=1, score=50))
+        # in triage names were already checked up front
+        if not self.triage.enabled:
+            hits += self.embedded_object_scan(name)
+
+        rule_names = self.triage.rules(self.RULE_NAMES)
+        text_names = rule_names if name.endswith(('.xml', '.rels', '.txt')) else ()
+        # parts larger than a chunk (and the raw fallback) are read once for all checks below
+        checks = StreamChecks(data, self.pool, (b'MZ',) if self.triage.needed(80) else (), self.triage.needed(10), text_names)
 
         # Binary signature checks (MZ, PK, ELF, etc.)
-        if self.RE_MZ.search(data):
+        if self.triage.needed(80) and checks.signature_count(b'MZ'):
             hits.append(IocHit(name='embedded_executable', description=f'{name} contains MZ executable', hits=1, score=80))
 
         # high entropy
-        ent = entrophy_scan(data)
-        if ent >= OoxmlPipeline.ENTROPY_THRESHHOLD:
-            hit = {}
-            hit['name'] = 'high_entropy'
-            hit['description'] = f'High entropy of {ent} detected in one of OOXML streams which can indicate raw binary data embedded into the document'
-            hit['hits'] = 1
-            hit['score'] = 10
-            hits.append(IocHit(**hit))
+        if self.triage.needed(10):
+            ent = checks.entropy()
+            if ent >= OoxmlPipeline.ENTROPY_THRESHHOLD:
+                hit = {}
+                hit['name'] = 'high_entropy'
+                hit['description'] = f'High entropy of {ent} detected in one of OOXML streams which can indicate raw binary data embedded into the document'
+                hit['hits'] = 1
+                hit['score'] = 10
+                hits.append(IocHit(**hit))
+            elif self.options.entropy_map:
+                hits += checks.entropy_regions(f'OOXML part {name}', OoxmlPipeline.ENTROPY_THRESHHOLD)
         
         # XML text content: decode and process for macro/network/obfuscation
-        if name.endswith(('.xml', '.rels', '.txt')):
-            text = data.decode('utf-8', errors='replace')
-            hits += self.score_stream_texts(text)
+        if text_names:
+            hits += self.score_matches(checks.matches(text_names))
+
+        # macros: module source is decompressed from the project and scanned
+        if rule_names and is_vba_project(name):
+            with self.timings.stage('vba', len(data)):
+                modules = read_vba_project(bytes(data), self.options.max_member_bytes, self.nesting.budget.vba)
+            vba_hits = scan_vba_modules(modules, rule_names, self.timings, self.options.rule_time_budget,
+                                        allowlist_for(self.options))
+            for hit in vba_hits:
+                hit.path = name
+            hits += vba_hits
 
         return hits
 
-    def list_streams_ooxml(self, path: str):
-        streams = []
-        with zipfile.ZipFile(path, 'r') as z:
-            for name in z.namelist():
-                try:
-                    data = z.read(name)
-                except KeyError:
-                    data = b''
-                streams.append((name, data))
-        return streams
+    def embedded_object_scan(self, name: str) -> List[IocHit]:
+        # OLE objects embedded in OOXML
+        if name.lower().startswith(('word/embeddings/', 'xl/embeddings/', 'ppt/embeddings/')):
+            return [IocHit(name='embedded_ole_object', description=f'Embedded OLE: {name}', hits=1, score=50)]
+        return []
+
+    def iter_streams_ooxml(self, archive: zipfile.ZipFile) -> Iterator[Tuple[str, bytearray, List[IocHit]]]:
+        remaining = self.options.max_total_bytes
+        infos = archive.infolist()
+        if self.triage.enabled:
+            infos = sorted(infos, key=lambda info: triage_order(info.filename, info.file_size))
+
+        for index, info in enumerate(infos):
+            if remaining <= 0:
+                skipped = [i.filename for i in infos[index:]]
+                yield '', bytearray(), [budget_hit(
+                    f'Total decompression budget of {self.options.max_total_bytes} bytes exhausted, '
+                    f'{len(skipped)} member(s) not analyzed: {skipped[:10]}'
+                )]
+                return
+
+            data, hits = self.read_member(archive, info, min(self.options.max_member_bytes, remaining))
+            remaining -= len(data)
+            yield info.filename, data, hits
+
+    def read_member(self, archive: zipfile.ZipFile, info: zipfile.ZipInfo, limit: int) -> Tuple[bytearray, List[IocHit]]:
+        """
+        Decompress member in chunks, stopping at the byte limit or when the
+        real compression ratio exceeds the configured maximum (zip bomb).
+        Whatever was read before the stop is still analyzed.
+        """
+        data = bytearray()
+        # ZipExtFile never consumes more than compress_size, so this bounds the true ratio
+        ratio_limit = self.options.max_compression_ratio * max(info.compress_size, 1)
+
+        try:
+            with archive.open(info) as member:
+                while True:
+                    chunk = member.read(min(OoxmlPipeline.READ_CHUNK, limit - len(data) + 1))
+                    if not chunk:
+                        break
+                    data += chunk
+
+                    if len(data) > limit:
+                        del data[limit:]
+                        return data, [budget_hit(
+                            f'{info.filename} exceeds decompression budget of {limit} bytes '
+                            f'(declared size {info.file_size} bytes), analysis truncated'
+                        )]
+                    if len(data) > OoxmlPipeline.RATIO_MIN_BYTES and len(data) > ratio_limit:
+                        return data, [budget_hit(
+                            f'{info.filename} exceeds compression ratio of {self.options.max_compression_ratio} '
+                            f'({info.compress_size} compressed bytes), likely zip bomb, analysis truncated'
+                        )]
+        except (KeyError, zipfile.BadZipFile, zlib.error, EOFError, NotImplementedError) as e:
+            print('ERROR reading OOXML member', info.filename + ':', e, file=sys.stderr)
+
+        return data, []
     
-    def list_streams_fallback(self, path: str):
+    def list_streams_fallback(self, source: DocumentSource):
         # Very limited fallback: returns a single "Raw" stream containing whole file.
-        with open(path, 'rb') as f:
-            data = f.read()
-        return [data]
+        return [('<raw>', source.view)]
 
     
-    def score_stream_texts(self, text: str) -> List[IocHit]:
+    def score_matches(self, matches: Dict[str, RuleMatch]) -> List[IocHit]:
         hits = []
-        hits += macro_scan(text)
-        hits += network_scan(text)
-        hits += obfuscation_scan(text)
-        
-        if OoxmlPipeline.RE_EMBED_EXE.search(text):
-            fnames = list(set(OoxmlPipeline.RE_EMBED_EXE.findall(text)))
-
-            hits.append(IocHit(
-                name='embedded_filename',
-                description=f'Embedded filenames are detected: {fnames}',
-                score=40,
-                hits=len(OoxmlPipeline.RE_EMBED_EXE.findall(text))
-            ))
+        hits += macro_scan(matches)
+        hits += network_scan(matches)
+        hits += obfuscation_scan(matches)
+        hits += embedded_filename_scan(matches)
+        hits += rule_budget_scan(matches, self.options.rule_time_budget)
             
-        return hits
\ No newline at end of file
+        return hits
@@ -0,0 +1,106 @@
+from collections import deque
+from concurrent.futures import Future
+from typing import Callable, Dict, Iterable, Iterator, List, Tuple
+from .. import AnalysisOptions, IocHit
+from ..timings import Timings
+from . import attribute
+from .chunked import chunk_bounds, merge_matches, scan_chunk_task
+from .rules import RuleMatch
+
+def analyze_stream_task(cls, options: AnalysisOptions, method: str, name: str, size: int, args: tuple):
+    # executed inside worker process, the pipeline is created without a source
+    pipeline = cls(None, options)
+    with pipeline.timings.stream(name, size):
+        hits = getattr(pipeline, method)(*args)
+    return hits, pipeline.timings
+
+class StreamPool:
+    """
+    Runs per-stream analysis of one document. When parallel, streams are
+    analyzed by a pool of worker processes and the text of streams above
+    `stream_chunk_bytes` is scanned by the workers in overlapping chunks.
+    Results are collected in stream order, so reports come out exactly as
+    from sequential analysis. Otherwise streams are analyzed in-process one
+    at a time, so the caller can stop early.
+    """
+    def __init__(self, options: AnalysisOptions, timings: Timings, parallel: bool = False):
+        self.options = options
+        self.timings = timings
+        self.executor = None
+        if parallel:
+            # multiprocessing is only imported when a document is analyzed in parallel
+            from concurrent.futures import ProcessPoolExecutor
+            self.executor = ProcessPoolExecutor(max_workers=options.stream_workers)
+
+    @classmethod
+    def for_document(cls, options: AnalysisOptions, timings: Timings, size: int) -> 'StreamPool':
+        # a pool only pays off for documents larger than one chunk, triage needs the streams in order
+        parallel = options.stream_workers > 1 and not options.triage and size > options.stream_chunk_bytes
+        return cls(options, timings, parallel)
+
+    @property
+    def parallel(self) -> bool:
+        return self.executor is not None
+
+    def chunked(self, size: int) -> bool:
+        # whether text of a stream of this size is scanned by `scan`
+        return self.parallel and size > self.options.stream_chunk_bytes
+
+    def map(self, pipeline, method: str, items: Iterable, describe: Callable[..., Tuple[str, int, tuple]]) -> Iterator[Tuple[object, List[IocHit]]]:
+        """
+        Yields (item, hits) for every item in order. `describe` turns an item
+        into (stream name, size, args of `method`). At most a few streams per
+        worker are in flight, so lazily extracted streams stay bounded in memory.
+        """
+        pending = deque()
+        for item in items:
+            name, size, args = describe(item)
+            if not self.parallel or self.chunked(size):
+                # large streams are analyzed here, their text chunks go to the workers
+                with self.timings.stream(name, size):
+                    hits = getattr(pipeline, method)(*args)
+                future = Future()
+                future.set_result((hits, None))
+            else:
+                args = tuple(bytes(a) if isinstance(a, memoryview) else a for a in args)
+                future = self.executor.submit(analyze_stream_task, type(pipeline), self.options, method, name, size, args)
+            pending.append((item, name, future))
+
+            while pending and (not self.parallel or len(pending) > self.options.stream_workers * 2):
+                yield self.result(*pending.popleft())
+
+        while pending:
+            yield self.result(*pending.popleft())
+
+    def result(self, item, name: str, future: Future) -> Tuple[object, List[IocHit]]:
+        hits, timings = future.result()
+        if timings is not None:
+            self.timings.merge(timings)
+        return item, attribute(hits, name)
+
+    def scan(self, data, names: tuple) -> Dict[str, RuleMatch]:
+        """ RULES.scan_bytes of the data, in overlapping chunks on the workers. """
+        futures = []
+        for left, lo, hi, right in chunk_bounds(data, self.options.stream_chunk_bytes, self.options.stream_chunk_overlap):
+            futures.append(self.executor.submit(
+                scan_chunk_task, bytes(data[left:right]), lo - left, hi - left, names, self.options
+            ))
+
+        merged: Dict[str, RuleMatch] = {}
+        for future in futures:
+            matches, timings = future.result()
+            self.timings.merge(timings)
+            merge_matches(merged, matches)
+
+        # same key order as a single RULES.scan
+        return { name: merged[name] for name in names if name in merged }
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown(cancel_futures=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -1,121 +1,380 @@
+import errno
+import math
 import os
-import sys
-from pypdf import PdfReader
-from typing import List, Set
-import re
-from .. import IocHit, IocReport, Pipeline
-from . import aggregate_report, entrophy_scan, js_scan, macro_scan, network_scan, obfuscation_scan
-from pypdf.generic import IndirectObject, StreamObject, DictionaryObject
+from typing import Dict, Iterator, List, Optional, Tuple
+import zlib
+from .. import AnalysisOptions, IocHit, IocReport, Pipeline
+from . import RULES, JS_RULES, NETWORK_RULES, EMBEDDED_FILENAME_RULES
+from . import aggregate_report, budget_hit, decode_error_hit, js_scan, network_scan, rule_budget_scan
+from . import Triage, attribute
+from .chunked import StreamChecks
+from .rules import RuleMatch
+from .nested import Nesting
+from .parallel import StreamPool
+from ..source import DocumentSource, open_source
+from ..timings import Timings
+from pypdf.errors import LimitReachedError
+from pypdf.filters import ASCII85Decode, ASCIIHexDecode, LZWDecode, RunLengthDecode
+from pypdf.generic import DictionaryObject, IndirectObject, StreamObject
+
+# compressed bytes fed to zlib at a time, inflating stops as soon as the budget is reached
+# and a corrupt block only loses the output of its chunk
+INFLATE_CHUNK = 1 << 14
+
+# filters other than Flate, their output never exceeds pypdf's own limits
+DECODERS = {
+    '/ASCIIHexDecode': ASCIIHexDecode, '/AHx': ASCIIHexDecode,
+    '/ASCII85Decode': ASCII85Decode, '/A85': ASCII85Decode,
+    '/LZWDecode': LZWDecode, '/LZW': LZWDecode,
+    '/RunLengthDecode': RunLengthDecode, '/RL': RunLengthDecode,
+}
+# longest predictor row, as pypdf's flate_maximum_row_length
+MAX_PREDICTOR_ROW = 4_000_000
+# image codecs end a filter chain, their input is analyzed as is
+IMAGE_FILTERS = ('/DCTDecode', '/DCT', '/JPXDecode', '/CCITTFaxDecode', '/CCF', '/JBIG2Decode')
+
+def inflate(data, limit: int) -> Tuple[bytes, bool, Optional[str]]:
+    """
+    Flate data decoded up to limit bytes: (data, truncated, error). Output
+    decoded before a corrupt block is kept.
+    """
+    decompressor = zlib.decompressobj()
+    out = bytearray()
+    view = memoryview(data)
+    try:
+        for offset in range(0, len(view), INFLATE_CHUNK):
+            out += decompressor.decompress(view[offset:offset + INFLATE_CHUNK], limit + 1 - len(out))
+            if len(out) > limit:
+                del out[limit:]
+                return bytes(out), True, None
+            if decompressor.eof:
+                break
+    except zlib.error as e:
+        return bytes(out), False, f'zlib: {e}'
+    return bytes(out), False, None
+
+def predictor_parameter(params: DictionaryObject, key: str, default: int) -> int:
+    value = params.get(key, default)
+    value = value.get_object() if isinstance(value, IndirectObject) else value
+    if not isinstance(value, int) or value < 1:
+        raise ValueError(f'{key} must be a positive number, got {value!r}')
+    return value
+
+def unpredict(data: bytes, params: DictionaryObject) -> bytes:
+    """
+    Reverses the TIFF or PNG predictor of Flate /DecodeParms. Rows are
+    un-predicted as arrays, runs of PNG Up rows in one step.
+    """
+    predictor = predictor_parameter(params, '/Predictor', 1)
+    if predictor == 1:
+        return data
+    if predictor != 2 and not 10 <= predictor <= 15:
+        raise NotImplementedError(f'unsupported Flate predictor {predictor}')
+
+    columns = predictor_parameter(params, '/Columns', 1)
+    colors = predictor_parameter(params, '/Colors', 1)
+    bits = predictor_parameter(params, '/BitsPerComponent', 8)
+    if colors > 32 or bits not in (1, 2, 4, 8, 16):
+        raise ValueError(f'unsupported predictor image of {colors} colors and {bits} bits per component')
+    row_length = math.ceil(columns * colors * bits / 8)
+    if row_length > MAX_PREDICTOR_ROW:
+        raise ValueError(f'predictor row of {row_length} bytes exceeds {MAX_PREDICTOR_ROW}')
+    # predictors work on whole bytes of a pixel, or the previous byte below 8 bits per pixel
+    pixel = max(1, colors * bits // 8)
+
+    # numpy is loaded with the entropy engine anyway
+    import numpy as np
+
+    if predictor == 2 and bits != 8:
+        raise NotImplementedError(f'TIFF predictor with {bits} bits per component')
+    if predictor != 2:
+        # a filter type byte starts every PNG row
+        row_length += 1
+    # a partial last row is padded as by pypdf
+    rows = -(-len(data) // row_length)
+    image = np.zeros(rows * row_length, dtype=np.uint8)
+    image[:len(data)] = np.frombuffer(data, dtype=np.uint8)
+
+    if predictor == 2:
+        # TIFF: every byte adds the one a pixel before it in the same row
+        image = np.cumsum(image.reshape(rows, columns, colors), axis=1, dtype=np.uint8)
+        return image.tobytes()[:len(data)]
+
+    image = image.reshape(rows, row_length)
+    filters, out = image[:, 0].copy(), image[:, 1:]
+    unknown = np.setdiff1d(filters, (0, 1, 2, 3, 4))
+    if unknown.size:
+        raise ValueError(f'unsupported PNG filter {unknown[0]}')
+
+    # Sub: running sum of the bytes at the same position of every pixel, rows depend only on themselves
+    sub = filters == 1
+    if sub.any():
+        out[sub] = np.cumsum(out[sub].reshape(int(sub.sum()), -1, pixel), axis=1, dtype=np.uint8).reshape(-1, row_length - 1)
+
+    # Average and Paeth depend on the decoded byte before, they are done one row at a time in between
+    previous = np.zeros(row_length - 1, dtype=np.uint8)
+    start = 0
+    for stop in [*np.flatnonzero(filters >= 3), rows]:
+        png_up(out[start:stop], filters[start:stop] == 2, previous)
+        if stop == rows:
+            break
+        if stop > 0:
+            previous = out[stop - 1]
+        out[stop] = np.frombuffer(png_sequential(out[stop].tobytes(), previous.tobytes(), pixel, filters[stop]), dtype=np.uint8)
+        previous, start = out[stop], stop + 1
+    return out.tobytes()
+
+def png_up(rows, up, previous):
+    """
+    PNG Up rows of a block in place, every other row is decoded already. An
+    Up row is the last decoded row before it plus the running sum of the Up
+    rows up to it, so every run is a difference of one running sum.
+    """
+    import numpy as np
+
+    if len(rows) < 16:
+        # too short to pay for the array operations below
+        for row in np.flatnonzero(up):
+            rows[row] += rows[row - 1] if row else previous
+        return
+    if not up.any():
+        return
+    totals = np.cumsum(rows, axis=0, dtype=np.uint8)
+    # the row every Up row builds on, -1 before the first decoded row of the block
+    base = np.maximum.accumulate(np.where(up, -1, np.arange(len(rows))))
+    before = base < 0
+    base_values = np.where(before[:, None], previous, rows[base])
+    base_totals = np.where(before[:, None], 0, totals[base]).astype(np.uint8)
+    rows[up] = (totals - base_totals + base_values)[up]
+
+def png_sequential(row: bytes, previous: bytes, pixel: int, kind: int) -> bytearray:
+    """ PNG Average (3) or Paeth (4) row, every byte depends on the decoded one a pixel before it. """
+    out = bytearray(row)
+    # the first pixel has no left neighbour, both predict from the byte above
+    for i in range(min(pixel, len(out))):
+        out[i] = (out[i] + (previous[i] // 2 if kind == 3 else previous[i])) & 0xff
+
+    if kind == 3:
+        for i in range(pixel, len(out)):
+            out[i] = (out[i] + ((out[i - pixel] + previous[i]) >> 1)) & 0xff
+        return out
+
+    for i in range(pixel, len(out)):
+        left, up, up_left = out[i - pixel], previous[i], previous[i - pixel]
+        distance_left, distance_up, distance_up_left = abs(up - up_left), abs(left - up_left), abs(left + up - 2 * up_left)
+        if distance_left <= distance_up and distance_left <= distance_up_left:
+            out[i] = (out[i] + left) & 0xff
+        elif distance_up <= distance_up_left:
+            out[i] = (out[i] + up) & 0xff
+        else:
+            out[i] = (out[i] + up_left) & 0xff
+    return out
 
 class PdfPipeline(Pipeline):
     ENTROPY_THRESHOLD = 7.5
-    RE_EMBED_EXE = re.compile(r'[\w\-\./ ]+\.(exe|dll|scr|bat|ps1|js|vbs)', re.IGNORECASE)
-    RE_MZ = re.compile(br'MZ')
+    RULE_NAMES = JS_RULES + NETWORK_RULES + EMBEDDED_FILENAME_RULES
+    # embedded_MZ, js_exec, embedded_filename
+    MAX_SCORE = 40
 
-    def __init__(self, filename):
+    def __init__(self, filename, options: Optional[AnalysisOptions] = None, source: Optional[DocumentSource] = None,
+                 timings: Optional[Timings] = None, nesting: Optional[Nesting] = None):
         self.filename = filename
+        self.options = options or AnalysisOptions()
+        self.source = source
+        self.timings = timings or Timings(self.options.timings)
+        self.nesting = nesting or Nesting(self.options)
+        # embedded documents can score above the checks of this pipeline
+        self.triage = Triage(self.options.triage, self.nesting.max_score(self.MAX_SCORE))
+        self.pool = StreamPool(self.options, self.timings)
 
     def run(self) -> IocReport:
-        if not os.path.isfile(self.filename):
-            print('ERROR: file not found:', self.filename, file=sys.stderr); sys.exit(2)
+        if self.source is None and not os.path.isfile(self.filename):
+            raise FileNotFoundError(errno.ENOENT, 'file not found', str(self.filename))
 
-        streams = self.extract_pdf_streams(self.filename)
         stream_results = []
+        with open_source(self.filename, self.source) as source, self.timings.stage('analyze', source.size):
+            self.nesting.enter(source)
+            # /JavaScript and /OpenAction keys are visible in the raw file without
+            # parsing or decoding a single stream, triage looks there first
+            if self.triage.enabled:
+                with self.timings.stream('<raw>', source.size):
+                    stream_results += self.triage.add(attribute(self.analyze_raw(source), '<raw>'))
+
+            self.pool = StreamPool.for_document(self.options, self.timings, source.size)
+            with self.pool:
+                if not self.triage.done:
+                    with self.timings.stage('extract', source.size):
+                        reader = source.pdf()
+                    streams = self.timings.iterate('extract', self.iter_pdf_streams(reader), lambda s: len(s[1]))
+                    analyzed = self.pool.map(self, 'analyze_stream', streams,
+                                             lambda s: (s[0], len(s[1]), (s[1], self.ENTROPY_THRESHOLD, s[0], s[2])))
+                    for (name, data, scan_text, budget_hits), hits in analyzed:
+                        stream_results += self.triage.add(budget_hits)
+                        stream_results += self.triage.add(hits)
+                        if not self.triage.done:
+                            with self.timings.stage('nested', len(data)):
+                                stream_results += self.triage.add(self.nesting.scan(name, data))
+                        if self.triage.done:
+                            break
 
-        for data in streams:
-            stream_results += self.analyze_stream(data, self.ENTROPY_THRESHOLD)
-            
-        stream_results += self.analyze_raw(self.filename)
+                if not self.triage.enabled:
+                    with self.timings.stream('<raw>', source.size):
+                        stream_results += attribute(self.analyze_raw(source), '<raw>')
 
-        return aggregate_report(stream_results)
+        report = aggregate_report(stream_results, self.triage.enabled, self.options.compact, self.options.max_evidence)
+        if self.timings.enabled:
+            report.timings = self.timings.to_dict()
+        return report
     
-    def recursive_extract(self, obj, reader, streams: List[bytes], visited: Set[tuple]):
+    def iter_pdf_streams(self, reader) -> Iterator[Tuple[str, bytes, bool, List[IocHit]]]:
         """
-        Recursively walk PDF objects, dereference indirects, collect stream bytes,
-        and avoid visiting the same object multiple times.
+        Iteratively walk all objects listed in the xref table and decode their
+        streams one at a time, within the configured object and byte budgets.
+        Yields (label, data, scan_text, budget_hits); images and fonts are not
+        text scanned.
         """
-        # If it's an IndirectObject, check visited
-        if isinstance(obj, IndirectObject):
-            key = (obj.idnum, obj.generation)
-            if key in visited:
+        remaining = self.options.pdf_max_total_bytes
+        keys = sorted((idnum, generation) for generation, ids in reader.xref.items() for idnum in ids)
+
+        for index, (idnum, generation) in enumerate(keys):
+            if index >= self.options.pdf_max_objects:
+                yield '', b'', False, [budget_hit(
+                    f'PDF object budget of {self.options.pdf_max_objects} exhausted, '
+                    f'{len(keys) - index} object(s) not analyzed'
+                )]
                 return
-            visited.add(key)
-            obj = reader.get_object(obj)  # dereference
 
-        if isinstance(obj, StreamObject):
+            label = f'object {idnum} {generation}'
             try:
-                streams.append(obj.get_data())
+                obj = reader.get_object(IndirectObject(idnum, generation, reader))
             except Exception:
-                pass
-            # still recurse into dictionary part of stream
-            obj_dict = DictionaryObject(obj)
-            for k, v in obj_dict.items():
-                self.recursive_extract(v, reader, streams, visited)
-
-        elif isinstance(obj, DictionaryObject):
-            for k, v in obj.items():
-                self.recursive_extract(v, reader, streams, visited)
-
-        elif isinstance(obj, list):
-            for element in obj:
-                self.recursive_extract(element, reader, streams, visited)
-                
-    def extract_pdf_streams(self, path: str) -> List[bytes]:
-        reader = PdfReader(path)
-        list(reader.pages)  # force loading
-        streams: List[bytes] = []
-        visited: Set[int] = set()
-
-        # Work on a snapshot of resolved objects
-        objects = list(reader.resolved_objects.values())
-        for obj in objects:
-            self.recursive_extract(obj, reader, streams, visited)
-            
-        return streams
-
-    def analyze_raw(self, path: str) -> List[IocHit]:
-        with open(path, 'r', encoding="utf-8", errors="replace") as f:
-            data = "\n".join(f.readlines())
-            return self.score_stream_texts(data)
-
-    def analyze_stream(self, data: bytes, threshold: int) -> List[IocHit]:
+                continue
+            if not isinstance(obj, StreamObject):
+                continue
+
+            if remaining <= 0:
+                yield '', b'', False, [budget_hit(
+                    f'PDF decoded stream budget of {self.options.pdf_max_total_bytes} bytes exhausted at {label}'
+                )]
+                return
+
+            limit = min(self.options.pdf_max_stream_bytes, remaining)
+            try:
+                data, truncated, error = self.decode_stream(obj, limit)
+            except Exception as e:
+                data, truncated, error = b'', False, f'{type(e).__name__}: {e}'
+            remaining -= len(data)
+
+            hits = []
+            if truncated:
+                hits.append(budget_hit(f'PDF {label} exceeds decoded stream budget of {limit} bytes, analysis truncated'))
+            if error:
+                hits.append(decode_error_hit(f'PDF {label} could not be decoded ({error}), {len(data)} bytes analyzed'))
+            yield label, data, not self.is_binary_resource(obj), hits
+
+    def decode_stream(self, obj: StreamObject, limit: int) -> Tuple[bytes, bool, Optional[str]]:
+        """
+        Decode stream data up to limit bytes, one filter of the chain at a
+        time. Returns data, whether it was truncated and the error that
+        stopped decoding, if any.
+        """
+        filters = obj.get('/Filter') or []
+        params = obj.get('/DecodeParms') or []
+        if not isinstance(filters, list):
+            filters = [filters]
+        if not isinstance(params, list):
+            params = [params]
+
+        data = obj._data
+        for index, name in enumerate(filters):
+            parms = params[index].get_object() if index < len(params) and params[index] is not None else None
+            if not isinstance(parms, dict):
+                parms = DictionaryObject()
+
+            if name in ('/FlateDecode', '/Fl'):
+                # inflated within the budget, predictors only ever shrink their input
+                data, truncated, error = inflate(data, limit)
+                data = unpredict(data, parms)
+                if truncated or error:
+                    return data[:limit], truncated, error
+            elif name in DECODERS:
+                try:
+                    data = DECODERS[name].decode(data, parms)
+                except LimitReachedError:
+                    return b'', True, None
+            elif name in IMAGE_FILTERS:
+                break
+            elif name != '/Crypt':
+                return data[:limit], False, f'unsupported filter {name}'
+
+            if len(data) > limit:
+                return data[:limit], True, None
+        return data[:limit], False, None
+
+    def is_binary_resource(self, obj: StreamObject) -> bool:
+        # images and embedded font programs, no point in scanning them for text IOCs
+        if obj.get('/Subtype') in ('/Image', '/Type1C', '/CIDFontType0C', '/OpenType'):
+            return True
+        return any(key in obj for key in ('/Length1', '/Length2', '/Length3'))
+
+    def analyze_raw(self, source: DocumentSource) -> List[IocHit]:
+        # decoded straight from the mapped file, no line splitting or re-joining
+        rule_names = self.triage.rules(self.RULE_NAMES)
+        if not rule_names:
+            return []
+        # files larger than a chunk are decoded and scanned chunk by chunk
+        checks = StreamChecks(source.view, self.pool, rule_names=rule_names)
+        return self.score_matches(checks.matches(rule_names))
+
+    def analyze_stream(self, data: bytes, threshold: int, name: str = '', scan_text: bool = True) -> List[IocHit]:
         hits = []
-        if self.RE_MZ.search(data):
+        signatures = tuple(s for s, score in ((b'MZ', 40), (b'PK\x03\x04', 20)) if self.triage.needed(score))
+        rule_names = self.triage.rules(self.RULE_NAMES) if scan_text else ()
+        # streams larger than a chunk are read once for all checks below
+        checks = StreamChecks(data, self.pool, signatures, self.triage.needed(10), rule_names)
+
+        mz_count = checks.signature_count(b'MZ') if self.triage.needed(40) else 0
+        if mz_count:
             hits.append(IocHit(name='embedded_MZ',
                               description='Embedded MZ binary likely present',
-                              hits=len(self.RE_MZ.findall(data)),
+                              hits=mz_count,
                               score=40))
 
-        if b'PK\x03\x04' in data:
+        pk_count = checks.signature_count(b'PK\x03\x04') if self.triage.needed(20) else 0
+        if pk_count:
             hits.append(IocHit(name='embedded_PK_zip',
                               description='Embedded zip (PK) detected',
-                              hits=len(re.compile(b'PK\x03\x04').findall(data)),
+                              hits=pk_count,
                               score=20))
 
-        ent = entrophy_scan(data)
-        if ent >= threshold:
-            hits.append(IocHit(name='high_entropy',
-                              description=f'High entropy {ent} in PDF stream',
-                              hits=1,
-                              score=10))
+        if self.triage.needed(10):
+            ent = checks.entropy()
+            if ent >= threshold:
+                hits.append(IocHit(name='high_entropy',
+                                  description=f'High entropy {ent} in PDF stream',
+                                  hits=1,
+                                  score=10))
+            elif self.options.entropy_map:
+                hits += checks.entropy_regions(f'PDF {name}', threshold)
 
-        try:
-            text = data.decode('utf-8', errors='replace')
-        except Exception:
-            text = data.decode('latin-1', errors='replace')
+        if not rule_names:
+            return hits
 
-        hits += self.score_stream_texts(text)
+        hits += self.score_matches(checks.matches(rule_names))
         return hits
 
-    def score_stream_texts(self, text: str) -> List[IocHit]:
+    def score_matches(self, matches: Dict[str, RuleMatch]) -> List[IocHit]:
         hits = []
-        hits += js_scan(text)
-        hits += network_scan(text)
+        hits += js_scan(matches)
+        hits += network_scan(matches)
 
-        if self.RE_EMBED_EXE.search(text):
-            fnames = set(self.RE_EMBED_EXE.findall(text))
+        if 'embedded_filename' in matches:
+            fnames = set(matches['embedded_filename'].values)
             hits.append(IocHit(name='embedded_filename',
                               description=f'Embedded filenames detected: {fnames}',
-                              score=40,
-                              hits=len(fnames)))
+                              score=RULES['embedded_filename'].score,
+                              hits=len(fnames),
+                              evidence=matches['embedded_filename'].evidence()))
+
+        hits += rule_budget_scan(matches, self.options.rule_time_budget)
         return hits
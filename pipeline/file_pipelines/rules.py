@@ -0,0 +1,148 @@
+from dataclasses import dataclass, field
+from functools import lru_cache
+import re
+from time import perf_counter
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+# ASCII strings stored as UTF-16LE (VBA, OLE property sets, ...), at least 4 characters
+RE_UTF16_STRING = re.compile(rb'(?:[\t\n\r\x20-\x7e]\x00){4,}')
+
+@lru_cache(maxsize=None)
+def binary(pattern: re.Pattern) -> re.Pattern:
+    """ Bytes version of an ASCII str pattern, \\w, \\d, \\s and \\b get their ASCII meaning. """
+    return re.compile(pattern.pattern.encode('ascii'), pattern.flags & ~re.UNICODE)
+
+def pattern_for(pattern: re.Pattern, text) -> re.Pattern:
+    # str patterns for decoded text, their bytes version for any other buffer
+    return pattern if isinstance(text, str) else binary(pattern)
+
+def utf16_strings(data, span: Optional[Tuple[int, int]] = None) -> bytes:
+    """
+    ASCII strings stored as UTF-16LE in data, one per line. With `span` only
+    strings starting inside data[span[0]:span[1]] are kept.
+    """
+    lo, hi = span or (0, len(data))
+    return b'\n'.join(
+        match.group()[::2] for match in RE_UTF16_STRING.finditer(data) if lo <= match.start() < hi
+    )
+
+@dataclass
+class Rule:
+    name: str
+    pattern: re.Pattern
+    score: int
+    # linear time replacement for pattern.finditer, for patterns the backtracking
+    # engine would retry from every start position of a long run
+    finder: Optional[Callable[[str], Iterator[re.Match]]] = None
+    # matches inside allowlisted URLs are dropped
+    allowlisted: bool = False
+
+    def finditer(self, text) -> Iterator[re.Match]:
+        return self.finder(text) if self.finder else pattern_for(self.pattern, text).finditer(text)
+
+    def value(self, match: re.Match):
+        # same shape as re.findall() output for the pattern, used in descriptions
+        if self.pattern.groups == 0:
+            return text_value(match.group(0))
+        if self.pattern.groups == 1:
+            return text_value(match.group(1))
+        return tuple(text_value(group) for group in match.groups())
+
+def text_value(value):
+    # matches on bytes are decoded here, only the matched value is ever decoded
+    if isinstance(value, bytes):
+        return value.decode('utf-8', errors='replace')
+    return value
+
+@dataclass
+class RuleMatch:
+    count: int = 0
+    values: List[str] = field(default_factory=list)
+    # whole matched text of every match, also for patterns with groups
+    matched: List[str] = field(default_factory=list)
+    # scan stopped at the rule time budget, count and values are partial
+    truncated: bool = False
+
+    def unique(self) -> List[str]:
+        # deduplicated values in order of first appearance
+        return list(dict.fromkeys(self.values))
+
+    def evidence(self) -> List[str]:
+        # deduplicated matched text in order of first appearance, e.g. 'dropper.exe' where the value is 'exe'
+        return list(dict.fromkeys(self.matched))
+
+    def merge(self, other: 'RuleMatch'):
+        self.count += other.count
+        self.values += other.values
+        self.matched += other.matched
+        self.truncated = self.truncated or other.truncated
+
+class RuleSet:
+    """
+    All IOC patterns compiled once. `scan` walks every requested rule over the
+    text exactly once and collects count and matched values, so scanners never
+    have to call search()/findall() on the same text again. A rule still
+    matching when its time budget (seconds per text) runs out is cut off and
+    its result marked truncated. With `span` only matches starting inside
+    text[span[0]:span[1]] are collected, the text around it is context.
+    With an `allowlist` matches of allowlisted rules inside known-benign
+    URLs are skipped before they are collected. Text is either decoded str
+    or any bytes-like buffer, see `scan_bytes`.
+    """
+    def __init__(self, rules: Iterable[Rule]):
+        self.rules: Dict[str, Rule] = { rule.name: rule for rule in rules }
+
+    def __getitem__(self, name: str) -> Rule:
+        return self.rules[name]
+
+    def scan(self, text: str, names: Optional[Iterable[str]] = None, timings = None,
+             time_budget: Optional[float] = None, span: Optional[Tuple[int, int]] = None,
+             allowlist = None) -> Dict[str, RuleMatch]:
+        results = {}
+        timed = timings is not None and timings.enabled
+
+        for name in (names if names is not None else self.rules):
+            rule = self.rules[name]
+            result = RuleMatch()
+            allowed = allowlist is not None and rule.allowlisted
+            start = perf_counter()
+            for match in rule.finditer(text):
+                if span and match.start() < span[0]:
+                    continue
+                if span and match.start() >= span[1]:
+                    break
+                if allowed and allowlist.allows(text, match):
+                    continue
+                result.count += 1
+                value = rule.value(match)
+                result.values.append(value)
+                result.matched.append(text_value(match.group(0)) if rule.pattern.groups else value)
+                # re can not be interrupted inside a match, the budget is checked between matches
+                if time_budget and perf_counter() - start > time_budget:
+                    result.truncated = True
+                    break
+            if timed:
+                timings.add_rule(name, perf_counter() - start, len(text))
+            if result.count:
+                results[name] = result
+
+        return results
+
+    def scan_bytes(self, data, names: Optional[Iterable[str]] = None, timings = None,
+                   time_budget: Optional[float] = None, span: Optional[Tuple[int, int]] = None,
+                   allowlist = None) -> Dict[str, RuleMatch]:
+        """
+        `scan` directly on bytes, bytearray, memoryview or mmap without
+        decoding the data, plus the ASCII strings stored in it as UTF-16LE.
+        Patterns keep their ASCII meaning, only matched values are decoded.
+        """
+        names = tuple(names if names is not None else self.rules)
+        results = self.scan(data, names, timings, time_budget, span, allowlist)
+
+        wide = utf16_strings(data, span)
+        if not wide:
+            return results
+        for name, match in self.scan(wide, names, timings, time_budget, None, allowlist).items():
+            results.setdefault(name, RuleMatch()).merge(match)
+        # same key order as a single scan
+        return { name: results[name] for name in names if name in results }
@@ -0,0 +1,226 @@
+from collections import OrderedDict
+import codecs
+from dataclasses import dataclass
+import hashlib
+import io
+import struct
+import sys
+from typing import List, Optional, Tuple
+from .. import IocHit
+from . import RULES, attribute, embedded_filename_scan, network_scan, obfuscation_scan, rule_budget_scan, vba_module_scan
+
+# dir stream record ids (MS-OVBA 2.3.4.2)
+PROJECTCODEPAGE = 0x0003
+PROJECTVERSION = 0x0009
+DIR_TERMINATOR = 0x0010
+MODULENAME = 0x0019
+MODULESTREAMNAME = 0x001A
+MODULE_TERMINATOR = 0x002B
+MODULEOFFSET = 0x0031
+
+# decompressed bytes kept per top-level document
+CACHE_MAX_BYTES = 16 * 1024 * 1024
+
+@dataclass
+class VbaModule:
+    name: str
+    # path of the module stream inside the OLE file
+    stream: str
+    code: str
+
+# literal bytes before the next copy token of a flag byte (its trailing zero bits), 8 for none
+LITERAL_RUN = bytes((flags & -flags).bit_length() - 1 if flags else 8 for flags in range(256))
+# bits of the offset part of a copy token by bytes decompressed so far in the chunk (MS-OVBA 2.4.1.3.19.1)
+OFFSET_BITS = bytes(max((n - 1).bit_length(), 4) for n in range(4097))
+
+def decompress(data: bytes, limit: int) -> bytes:
+    """
+    MS-OVBA 2.4.1 decompression of a CompressedContainer, at most limit bytes
+    of output. Runs of literal bytes and copy tokens are copied as slices.
+    """
+    if not data or data[0] != 0x01:
+        raise ValueError('not a compressed container')
+
+    literal_run, offset_bits = LITERAL_RUN, OFFSET_BITS
+    out = bytearray()
+    pos = 1
+    end = len(data)
+    while pos + 2 <= end and len(out) < limit:
+        header = data[pos] | data[pos + 1] << 8
+        chunk_end = min(pos + (header & 0x0FFF) + 3, end)
+        pos += 2
+        chunk_start = len(out)
+
+        if not header & 0x8000:
+            out += data[pos:chunk_end]
+            pos = chunk_end
+            continue
+
+        while pos < chunk_end:
+            flags = data[pos]
+            pos += 1
+            bit = 0
+            while bit < 8 and pos < chunk_end:
+                run = literal_run[flags >> bit]
+                if run:
+                    if run > 8 - bit:
+                        run = 8 - bit
+                    if run > chunk_end - pos:
+                        run = chunk_end - pos
+                    out += data[pos:pos + run]
+                    pos += run
+                    bit += run
+                    continue
+
+                if pos + 2 > chunk_end:
+                    raise ValueError('truncated copy token')
+                token = data[pos] | data[pos + 1] << 8
+                pos += 2
+                bit += 1
+                # offset/length split of the token depends on the position inside the chunk
+                decompressed = len(out) - chunk_start
+                bits = offset_bits[decompressed] if decompressed <= 4096 else 12
+                length = (token & (0xFFFF >> bits)) + 3
+                offset = (token >> (16 - bits)) + 1
+                if offset > decompressed:
+                    raise ValueError('copy token points before chunk start')
+
+                if offset >= length:
+                    start = len(out) - offset
+                    out += out[start:start + length]
+                else:
+                    # overlapping copy repeats the last `offset` bytes
+                    out += (out[-offset:] * (length // offset + 1))[:length]
+
+    return bytes(out[:limit])
+
+class DecompressCache:
+    """
+    Decompressed containers of one top-level document, keyed by the SHA-256
+    of the compressed data. The same project is often seen by the OOXML
+    member scan and again as an embedded document. Least recently used
+    entries are dropped above `max_bytes` of decompressed data.
+    """
+    def __init__(self, max_bytes: int = CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.entries: OrderedDict = OrderedDict()
+
+    def decompress(self, data: bytes, limit: int) -> bytes:
+        key = (hashlib.sha256(data).digest(), limit)
+        out = self.entries.get(key)
+        if out is not None:
+            self.entries.move_to_end(key)
+            return out
+
+        out = decompress(data, limit)
+        if len(out) <= self.max_bytes:
+            self.entries[key] = out
+            self.size += len(out)
+            while self.size > self.max_bytes:
+                _, dropped = self.entries.popitem(last=False)
+                self.size -= len(dropped)
+        return out
+
+def codec(codepage: int) -> str:
+    try:
+        return codecs.lookup(f'cp{codepage}').name
+    except LookupError:
+        return 'cp1252'
+
+def parse_dir(data: bytes) -> Tuple[str, List[Tuple[str, str, int]]]:
+    """ Encoding and (module name, stream name, source offset) of every module in a decompressed dir stream. """
+    encoding = 'cp1252'
+    modules = []
+    name, stream, offset = None, None, 0
+
+    pos = 0
+    while pos + 6 <= len(data):
+        record, size = struct.unpack_from('<HI', data, pos)
+        pos += 6
+        # the size field of PROJECTVERSION is a reserved constant, 6 bytes of version follow
+        if record == PROJECTVERSION:
+            size = 6
+        value = data[pos:pos + size]
+        pos += size
+
+        if record == PROJECTCODEPAGE and size == 2:
+            encoding = codec(struct.unpack('<H', value)[0])
+        elif record == MODULENAME:
+            name, stream, offset = value.decode(encoding, errors='replace'), None, 0
+        elif record == MODULESTREAMNAME:
+            stream = value.decode(encoding, errors='replace')
+        elif record == MODULEOFFSET and size == 4:
+            offset = struct.unpack('<I', value)[0]
+        elif record == MODULE_TERMINATOR and name is not None:
+            modules.append((name, stream or name, offset))
+            name = None
+        elif record == DIR_TERMINATOR:
+            break
+
+    return encoding, modules
+
+def read_vba_modules(ole, limit: int, cache: Optional[DecompressCache] = None) -> List[VbaModule]:
+    """
+    Source code of every VBA module of every project in an OleFileIO. Only
+    the dir stream and the module streams are read and decompressed.
+    """
+    cache = cache or DecompressCache()
+    modules = []
+    for entry in ole.listdir(streams=True, storages=False):
+        if len(entry) < 2 or entry[-1].lower() != 'dir' or entry[-2].lower() != 'vba':
+            continue
+
+        storage = entry[:-1]
+        try:
+            encoding, records = parse_dir(cache.decompress(ole.openstream(entry).read(), limit))
+        except Exception as e:
+            print('ERROR reading VBA project', '/'.join(storage) + ':', e, file=sys.stderr)
+            continue
+
+        for name, stream, offset in records:
+            path = storage + [stream]
+            try:
+                data = ole.openstream(path).read()
+                code = cache.decompress(data[offset:], limit)
+            except Exception as e:
+                print('ERROR reading VBA module', '/'.join(path) + ':', e, file=sys.stderr)
+                continue
+            modules.append(VbaModule(name, '/'.join(path), code.decode(encoding, errors='replace')))
+
+    return modules
+
+def read_vba_project(data: bytes, limit: int, cache: Optional[DecompressCache] = None) -> List[VbaModule]:
+    """ Modules of a standalone VBA project file (vbaProject.bin of OOXML). """
+    # olefile is only imported when a project is found
+    import olefile
+
+    try:
+        ole = olefile.OleFileIO(io.BytesIO(data))
+    except Exception as e:
+        print('ERROR reading VBA project:', e, file=sys.stderr)
+        return []
+    try:
+        return read_vba_modules(ole, limit, cache)
+    finally:
+        ole.close()
+
+def is_vba_project(name: str) -> bool:
+    return name.lower().endswith('vbaproject.bin')
+
+def scan_vba_modules(modules: List[VbaModule], rule_names, timings, time_budget: float, allowlist = None) -> List[IocHit]:
+    hits = []
+    if not rule_names:
+        return hits
+
+    for module in modules:
+        with timings.stream(f'VBA {module.stream}', len(module.code)):
+            matches = RULES.scan(module.code, rule_names, timings, time_budget, allowlist=allowlist)
+        module_hits = vba_module_scan(module.name, matches)
+        module_hits += network_scan(matches)
+        module_hits += obfuscation_scan(matches)
+        module_hits += embedded_filename_scan(matches)
+        module_hits += rule_budget_scan(matches, time_budget)
+        hits += attribute(module_hits, module.stream)
+
+    return hits
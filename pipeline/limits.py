@@ -0,0 +1,178 @@
+from functools import lru_cache
+import os
+import time
+from typing import Optional
+from . import AnalysisOptions, IocHit, IocReport
+
+# how often the limits of a running analysis are checked
+POLL_INTERVAL = 0.05
+LIMIT_HIT = 'resource_limit_exceeded'
+
+# set inside watchdog workers, analyses there run unsupervised
+IN_WATCHDOG = False
+
+class ResourceLimitExceeded(Exception):
+    def __init__(self, resource: str, limit: str):
+        super().__init__(f'{resource} limit of {limit}')
+        self.resource = resource
+        self.limit = limit
+
+def enforced(options: AnalysisOptions) -> bool:
+    return not IN_WATCHDOG and bool(options.document_time_limit or options.document_memory_limit)
+
+def anonymous_memory(pid: int) -> Optional[int]:
+    """ Resident anonymous memory of a process in bytes (Linux), pages of mapped files are not counted. """
+    try:
+        with open(f'/proc/{pid}/status', 'rb') as f:
+            for line in f:
+                if line.startswith(b'RssAnon:'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError):
+        pass
+    return None
+
+def watchdog_main(conn, parent_conn):
+    global IN_WATCHDOG
+    IN_WATCHDOG = True
+    # a forked worker holds the parent's end too, it would never see the parent go away
+    parent_conn.close()
+    # own process group, so stream workers started by an analysis are killed with it
+    os.setpgrp()
+
+    while True:
+        try:
+            fn, args = conn.recv()
+        except (EOFError, KeyboardInterrupt):
+            return
+        try:
+            result = ('ok', fn(*args))
+        except MemoryError:
+            result = ('memory', None)
+        except BaseException as e:
+            result = ('error', e)
+        try:
+            conn.send(result)
+        except Exception as e:
+            # results are pickled before anything is written, report what could not be
+            conn.send(('error', RuntimeError(f'{type(e).__name__}: {e}')))
+
+class Watchdog:
+    """
+    A worker process that runs analyses sent to it one at a time while the
+    calling process watches wall-clock time and anonymous memory of the
+    worker. A worker over a limit is killed, together with any workers it
+    started, and a fresh one takes the next document, so a parser stuck in
+    a loop or allocating without bound costs one document, not the queue.
+    """
+    def __init__(self, time_limit: Optional[float] = None, memory_limit: Optional[int] = None):
+        # process management is only imported when limits are enforced
+        import threading
+
+        self.time_limit = time_limit
+        self.memory_limit = memory_limit
+        self.process = None
+        self.conn = None
+        self.lock = threading.Lock()
+        self.finalizer = None
+
+    def start(self):
+        import multiprocessing
+        from multiprocessing.util import Finalize
+
+        self.conn, child = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(target=watchdog_main, args=(child, self.conn), name='sdat-watchdog')
+        self.process.start()
+        child.close()
+        if self.finalizer is None:
+            # runs before multiprocessing joins the children of an exiting process
+            self.finalizer = Finalize(None, self.stop, exitpriority=10)
+
+    def stop(self):
+        import signal
+
+        if self.process is None:
+            return
+        try:
+            os.killpg(self.process.pid, signal.SIGKILL)
+        except (AttributeError, OSError):
+            # not yet in its own group
+            self.process.kill()
+        self.process.join()
+        self.conn.close()
+        self.process = self.conn = None
+
+    def run(self, fn, *args):
+        """ fn(*args) in the worker, its exceptions are raised here. """
+        with self.lock:
+            if self.process is None or not self.process.is_alive():
+                self.stop()
+                self.start()
+
+            try:
+                self.conn.send((fn, args))
+                started = time.monotonic()
+                while not self.conn.poll(POLL_INTERVAL):
+                    self.check(started)
+                status, value = self.conn.recv()
+            except EOFError:
+                self.process.join()
+                code = self.process.exitcode
+                self.stop()
+                raise RuntimeError(f'analysis worker exited with code {code}')
+            except BaseException:
+                # interrupted while the worker runs, its result must not reach the next caller
+                self.stop()
+                raise
+
+            if status == 'memory':
+                # the worker may be left fragmented, the next document gets a fresh one
+                self.stop()
+                raise ResourceLimitExceeded('memory', self.describe_memory())
+        if status == 'error':
+            raise value
+        return value
+
+    def check(self, started: float):
+        if self.time_limit and time.monotonic() - started > self.time_limit:
+            self.stop()
+            raise ResourceLimitExceeded('wall-clock', f'{self.time_limit:g}s')
+
+        if self.memory_limit:
+            used = anonymous_memory(self.process.pid)
+            if used is not None and used > self.memory_limit:
+                self.stop()
+                raise ResourceLimitExceeded('memory', self.describe_memory())
+
+    def describe_memory(self) -> str:
+        return f'{self.memory_limit / (1024 * 1024):g} MB' if self.memory_limit else 'available memory'
+
+@lru_cache(maxsize=None)
+def watchdog(time_limit: Optional[float], memory_limit: Optional[int]) -> Watchdog:
+    # one per process and limits, its worker is reused by every document analyzed here
+    return Watchdog(time_limit, memory_limit)
+
+def run_limited(options: AnalysisOptions, fn, *args):
+    """
+    fn(*args) in a watchdog worker bounded by the document limits of the
+    options. An analysis cut off at a limit returns a partial report with a
+    `resource_limit_exceeded` hit instead.
+    """
+    try:
+        return watchdog(options.document_time_limit, options.document_memory_limit).run(fn, *args)
+    except ResourceLimitExceeded as e:
+        return limit_report(e, options)
+
+def limit_report(error: ResourceLimitExceeded, options: AnalysisOptions) -> IocReport:
+    from .file_pipelines import aggregate_report
+
+    hit = IocHit(
+        name=LIMIT_HIT,
+        description=f'Analysis stopped at the {error}, the document may be crafted to stall or exhaust the parsers',
+        score=25,
+        hits=1
+    )
+    return aggregate_report([hit], partial=True, compact=options.compact, max_evidence=options.max_evidence)
+
+def exceeded(report: IocReport) -> bool:
+    # such reports depend on load and limits, they are never cached
+    return any(hit.name == LIMIT_HIT for hit in report.hits)
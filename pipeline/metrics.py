@@ -0,0 +1,169 @@
+from collections import defaultdict
+import json
+import os
+from pathlib import Path
+import tempfile
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+from . import IocReport
+
+# upper bounds of the analysis latency histogram, in seconds
+LATENCY_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0)
+
+class Histogram:
+    def __init__(self, buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        self.buckets = buckets
+        # per bucket, not cumulative, the last one counts values above every bound
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        index = next((i for i, bound in enumerate(self.buckets) if value <= bound), len(self.buckets))
+        self.counts[index] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self) -> List[Tuple[str, int]]:
+        """ (le, count) pairs as exposed by Prometheus, ending with +Inf. """
+        total, pairs = 0, []
+        for bound, count in zip(self.buckets + (None,), self.counts):
+            total += count
+            pairs.append(('+Inf' if bound is None else f'{bound:g}', total))
+        return pairs
+
+def label(value: str) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+class Metrics:
+    """
+    Operational counters of a scan, watch or serve run: documents, bytes and
+    latency per detected type, hits per IOC name, verdicts and errors. Every
+    outcome is recorded by the process collecting results, so counts are
+    exact whatever the number of workers. With a `path` the metrics are
+    written there at most every `interval` seconds and at the end of the
+    run, atomically, as Prometheus text format or as JSON when the file
+    name ends with .json.
+    """
+    def __init__(self, path = None, interval: float = 10.0):
+        self.path = Path(path) if path else None
+        self.interval = interval
+        self.started = time.time()
+        self.flushed = time.monotonic()
+        self.lock = threading.Lock()
+
+        self.documents: Dict[str, int] = defaultdict(int)
+        self.bytes: Dict[str, int] = defaultdict(int)
+        self.latency: Dict[str, Histogram] = defaultdict(Histogram)
+        self.hits: Dict[str, int] = defaultdict(int)
+        # documents with at least one hit of a name, rates per document do not depend on stream counts
+        self.documents_hit: Dict[str, int] = defaultdict(int)
+        self.verdicts: Dict[str, int] = defaultdict(int)
+        self.errors: Dict[str, int] = defaultdict(int)
+
+    def record(self, report: Optional[IocReport], seconds: float, size: int, error: Optional[str] = None):
+        """ Outcome of one document, `error` is the failure as 'ExceptionType: message'. """
+        with self.lock:
+            if error or report is None:
+                self.errors[(error or 'unknown').split(':', 1)[0]] += 1
+            else:
+                file_type = report.file_type or ('allowlisted' if report.allowlisted else 'unknown')
+                self.documents[file_type] += 1
+                self.bytes[file_type] += size
+                self.latency[file_type].observe(seconds)
+                self.verdicts[report.verdict] += 1
+
+                names = set()
+                for hit in report.hits:
+                    self.hits[hit.name] += hit.hits
+                    names.add(hit.name)
+                for name in names:
+                    self.documents_hit[name] += 1
+
+        self.maybe_flush()
+
+    def maybe_flush(self):
+        if self.path and time.monotonic() - self.flushed >= self.interval:
+            self.flush()
+
+    def record_result(self, result):
+        # BatchResult of scan and watch
+        self.record(result.report, result.seconds, result.size, result.error)
+
+    def to_dict(self) -> dict:
+        with self.lock:
+            uptime = max(time.time() - self.started, 1e-9)
+            return {
+                'started': self.started,
+                'uptime_seconds': round(uptime, 3),
+                'documents': {
+                    file_type: {
+                        'count': count,
+                        'per_second': round(count / uptime, 3),
+                        'bytes': self.bytes[file_type],
+                        'latency_seconds': {
+                            'sum': round(self.latency[file_type].sum, 6),
+                            'count': self.latency[file_type].count,
+                            'buckets': dict(self.latency[file_type].cumulative()),
+                        },
+                    } for file_type, count in sorted(self.documents.items())
+                },
+                'hits': dict(sorted(self.hits.items())),
+                'documents_with_hit': dict(sorted(self.documents_hit.items())),
+                'verdicts': dict(sorted(self.verdicts.items())),
+                'errors': dict(sorted(self.errors.items())),
+            }
+
+    def prometheus(self) -> str:
+        """ Prometheus text exposition format, documents/sec is rate(sdat_documents_total). """
+        lines = []
+
+        def family(name: str, kind: str, help: str, samples):
+            # samples are (name suffix, labels, value)
+            lines.append(f'# HELP {name} {help}')
+            lines.append(f'# TYPE {name} {kind}')
+            for suffix, labels, value in samples:
+                rendered = ','.join(f'{key}="{label(v)}"' for key, v in labels)
+                lines.append(f'{name}{suffix}{{{rendered}}} {value}' if rendered else f'{name}{suffix} {value}')
+
+        def counter(name: str, help: str, key: str, values: Dict[str, int]):
+            family(name, 'counter', help, [('', ((key, k),), n) for k, n in sorted(values.items())])
+
+        with self.lock:
+            family('sdat_start_time_seconds', 'gauge', 'Start of the run as unix time.', [('', (), self.started)])
+            counter('sdat_documents_total', 'Documents analyzed, by detected type.', 'type', self.documents)
+            counter('sdat_bytes_total', 'Bytes of analyzed documents, by detected type.', 'type', self.bytes)
+
+            latency = []
+            for file_type, histogram in sorted(self.latency.items()):
+                latency += [('_bucket', (('type', file_type), ('le', le)), n) for le, n in histogram.cumulative()]
+                latency.append(('_sum', (('type', file_type),), f'{histogram.sum:.6f}'))
+                latency.append(('_count', (('type', file_type),), histogram.count))
+            family('sdat_analysis_seconds', 'histogram', 'Wall time of document analysis, by detected type.', latency)
+
+            counter('sdat_hits_total', 'IOC hits, by hit name.', 'name', self.hits)
+            counter('sdat_documents_with_hit_total', 'Documents with at least one hit, by hit name.', 'name', self.documents_hit)
+            counter('sdat_verdicts_total', 'Documents by verdict.', 'verdict', self.verdicts)
+            counter('sdat_errors_total', 'Documents that failed, by exception type.', 'error', self.errors)
+
+        return '\n'.join(lines) + '\n'
+
+    def flush(self):
+        if not self.path:
+            return
+        self.flushed = time.monotonic()
+        if self.path.suffix == '.json':
+            content = json.dumps(self.to_dict(), indent=4) + '\n'
+        else:
+            content = self.prometheus()
+
+        # written aside and renamed, scrapers (e.g. the node_exporter textfile collector) never see a partial file
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=self.path.parent, prefix=f'.{self.path.name}.', suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                f.write(content)
+            os.replace(tmp, self.path)
+        except OSError:
+            Path(tmp).unlink(missing_ok=True)
@@ -1,44 +1,155 @@
-import json
-from . import IocReport, Pipeline
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from functools import lru_cache
 import io
+import json
+import os
+from pathlib import Path
+import sys
+from typing import Iterable, Iterator, List, Optional, Tuple
+from xml.sax.saxutils import escape
+from . import IocReport, Pipeline, output_paths
 from reportlab.lib.pagesizes import A4
-from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, Table, TableStyle, Image
+from reportlab.platypus import Flowable, SimpleDocTemplate, Paragraph, Spacer, Table, TableStyle, Image
 from reportlab.lib.styles import getSampleStyleSheet
 from reportlab.lib import colors
-import matplotlib.pyplot as plt
-from collections import defaultdict
+# object-oriented Agg API, pyplot keeps global state and is not thread safe
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+# rows of the hit table built at once, every chunk is laid out and freed before the next one
+TABLE_CHUNK_ROWS = 100
+# longer descriptions continue in the following rows, a row taller than a page can not be split
+CELL_MAX_CHARS = 1500
+
+SIDE_BY_SIDE_STYLE = TableStyle([
+    ('VALIGN', (0, 0), (-1, -1), 'CENTER'),
+    ('LEFTPADDING', (0, 0), (-1, -1), 0),
+    ('RIGHTPADDING', (0, 0), (-1, -1), 0),
+    ('ALIGN',(1,1),(-1,-1),'LEFT'),
+])
+
+HIT_TABLE_STYLE = TableStyle([
+    ('BACKGROUND', (0,0), (-1,0), colors.grey),
+    ('TEXTCOLOR',(0,0),(-1,0),colors.whitesmoke),
+    ('ALIGN',(1,1),(-1,-1),'LEFT'),
+    ('FONTNAME', (0,0), (-1,0), 'Helvetica-Bold'),
+    ('FONTSIZE', (0,0), (-1,0), 10),
+    ('BOTTOMPADDING', (0,0), (-1,0), 6),
+    ('VALIGN', (0, 1), (-1, -1), 'TOP'),
+    ('GRID', (0,0), (-1,-1), 0.5, colors.black),
+])
+
+HIT_TABLE_HEADER = ['Name', 'Score', 'Hits', 'Description']
+
+@lru_cache(maxsize=1)
+def report_styles():
+    # parsed once per process and shared by every rendered report
+    return getSampleStyleSheet()
+
+@lru_cache(maxsize=64)
+def pie_chart(categories: Tuple[Tuple[str, int], ...]) -> bytes:
+    """ PNG pie chart of hits per category, reports of a batch mostly share their charts. """
+    fig = Figure(figsize=(3,4))
+    FigureCanvasAgg(fig)
+    ax = fig.add_subplot()
+    ax.pie([count for _, count in categories], labels=[label for label, _ in categories], autopct='%1.1f%%', startangle=140)
+    ax.axis('equal')  # Equal aspect ratio
+
+    buf = io.BytesIO()
+    fig.savefig(buf, format='PNG', bbox_inches='tight')
+    return buf.getvalue()
+
+class HitTableChunk(Flowable):
+    """
+    Rows of the hit table as plain strings. Paragraphs and the Table are only
+    created when the chunk is laid out, so a report with a huge number of hits
+    never holds more than one chunk of laid out rows.
+    """
+    def __init__(self, rows: List[Tuple[str, str, str, str]]):
+        super().__init__()
+        # aligned like the Table it stands for
+        self.hAlign = 'CENTER'
+        self.rows = rows
+        self.table = None
+
+    def build(self) -> Table:
+        if self.table is None:
+            body = report_styles()['BodyText']
+            table_data = [HIT_TABLE_HEADER] + [
+                [name, score, hits, Paragraph(description, body)] for name, score, hits, description in self.rows
+            ]
+            self.table = Table(table_data, colWidths=[100, 50, 50, 250], repeatRows=1)
+            self.table.setStyle(HIT_TABLE_STYLE)
+        return self.table
+
+    def wrap(self, availWidth, availHeight):
+        self.width, self.height = self.build().wrap(availWidth, availHeight)
+        return self.width, self.height
+
+    def split(self, availWidth, availHeight):
+        return self.build().split(availWidth, availHeight)
+
+    def draw(self):
+        self.build().drawOn(self.canv, 0, 0)
 
 class GeneratePdfPipeline(Pipeline):
     def __init__(self, output, filename = None, content = None):
         if not filename and not content:
             raise ValueError('Provide either filename or content')
-        
+
         if filename and content:
             raise ValueError('Provide either filename or content')
-        
+
         self.filename = filename
         self.output = output
         self.content = content
-    
+
     def snake_to_friendly(self, snake_str: str) -> str:
         if not snake_str:
             return ''
         words = snake_str.split('_')
         # Capitalize first word, lowercase the rest
         return ' '.join([words[0].capitalize()] + [w.lower() for w in words[1:]])
-    
+
+    def describe(self, hit) -> str:
+        # compact reports keep matched values as evidence instead of in the description
+        description = hit.description if hit.description is not None else ', '.join(map(str, hit.evidence or []))
+        return f'{hit.path}: {description}' if hit.path else description
+
+    def table_rows(self) -> Iterator[Tuple[str, str, str, str]]:
+        for hit in self.content.hits:
+            description = self.describe(hit)
+            name, score, hits = self.snake_to_friendly(hit.name), str(hit.score), str(hit.hits)
+            for start in range(0, max(len(description), 1), CELL_MAX_CHARS):
+                yield name, score, hits, escape(description[start:start + CELL_MAX_CHARS])
+                # continuation rows only repeat the description
+                name, score, hits = '', '', ''
+
+    def hit_table(self) -> List[HitTableChunk]:
+        chunks, rows = [], []
+        for row in self.table_rows():
+            rows.append(row)
+            if len(rows) == TABLE_CHUNK_ROWS:
+                chunks.append(HitTableChunk(rows))
+                rows = []
+        if rows or not chunks:
+            chunks.append(HitTableChunk(rows))
+        return chunks
+
     def run(self) -> IocReport:
         if self.filename:
             with open(self.filename, 'r') as f:
                 self.content = IocReport.from_dict(json.load(f))
-                
+
         doc = SimpleDocTemplate(str(self.output), pagesize=A4)
         elements = []
-        styles = getSampleStyleSheet()
+        styles = report_styles()
 
         # --- Title ---
         elements.append(Paragraph("Analysis Report", styles['Title']))
-        elements.append(Paragraph(str(self.output.resolve()), styles['Heading4']))
+        elements.append(Paragraph(str(Path(self.output).resolve()), styles['Heading4']))
         elements.append(Spacer(1, 12))
 
         # --- Summary ---
@@ -52,59 +163,73 @@ class GeneratePdfPipeline(Pipeline):
         category_counts = defaultdict(int)
         for hit in self.content.hits:
             category_counts[self.snake_to_friendly(hit.name)] += hit.hits
-
-        labels = list(category_counts.keys())
-        sizes = list(category_counts.values())
-
-        # Generate pie chart
-        fig, ax = plt.subplots(figsize=(3,4))
-        ax.pie(sizes, labels=labels, autopct='%1.1f%%', startangle=140)
-        ax.axis('equal')  # Equal aspect ratio
-
-        # Save chart to a bytes buffer
-        buf = io.BytesIO()
-        plt.savefig(buf, format='PNG', bbox_inches='tight')
-        buf.seek(0)
-        plt.close(fig)
+        chart = pie_chart(tuple(category_counts.items()))
 
         # --- Put them side by side using a Table ---
         side_by_side_table = Table([[
-            Paragraph(summary_text, styles['Heading2']), 
-            Image(buf, width=300, height=300
+            Paragraph(summary_text, styles['Heading2']),
+            Image(io.BytesIO(chart), width=300, height=300
         )]], colWidths=[150, 250])
-        side_by_side_table.setStyle(TableStyle([
-            ('VALIGN', (0, 0), (-1, -1), 'CENTER'),
-            ('LEFTPADDING', (0, 0), (-1, -1), 0),
-            ('RIGHTPADDING', (0, 0), (-1, -1), 0),
-            ('ALIGN',(1,1),(-1,-1),'LEFT'),
-        ]))
+        side_by_side_table.setStyle(SIDE_BY_SIDE_STYLE)
 
         elements.append(side_by_side_table)
         elements.append(Spacer(1, 20))  # optional spacing below
 
-        # --- Table of hits ---
-        table_data = [['Name', 'Score', 'Hits', 'Description']]
-        for hit in self.content.hits:
-            table_data.append([
-                self.snake_to_friendly(hit.name), 
-                str(hit.score), 
-                str(hit.hits), 
-                Paragraph(hit.description, styles['BodyText']) 
-            ])
-
-        table = Table(table_data, colWidths=[100, 50, 50, 250])
-        table.setStyle(TableStyle([
-            ('BACKGROUND', (0,0), (-1,0), colors.grey),
-            ('TEXTCOLOR',(0,0),(-1,0),colors.whitesmoke),
-            ('ALIGN',(1,1),(-1,-1),'LEFT'),
-            ('FONTNAME', (0,0), (-1,0), 'Helvetica-Bold'),
-            ('FONTSIZE', (0,0), (-1,0), 10),
-            ('BOTTOMPADDING', (0,0), (-1,0), 6),
-            ('VALIGN', (0, 1), (-1, -1), 'TOP'), 
-            ('GRID', (0,0), (-1,-1), 0.5, colors.black),
-        ]))
-        elements.append(table)
+        # --- Table of hits, in chunks laid out one after another ---
+        elements += self.hit_table()
 
         # --- Build PDF ---
         doc.build(elements)
+        return self.content
+
+@dataclass
+class RenderResult:
+    filename: str
+    output: str
+    error: Optional[str]
+
+def collect_reports(target: str) -> List[Path]:
+    """ JSON reports of a directory (walked recursively) or a single report. """
+    path = Path(target)
+    if path.is_dir():
+        # only the reports written by analyze and scan, not metrics, combined or other JSON files
+        return sorted(p for p in path.rglob('*.report.json') if p.is_file())
+    return [path]
+
+def render_report(filename: Path, output: Path) -> RenderResult:
+    # executed inside worker process, styles and charts are reused by all reports of the worker
+    try:
+        GeneratePdfPipeline(output, filename=filename).run()
+        return RenderResult(str(filename), str(output), None)
+    except Exception as e:
+        return RenderResult(str(filename), str(output), f'{type(e).__name__}: {e}')
+
+class BatchPdfPipeline(Pipeline):
+    """ Converts many JSON reports to PDF in a pool of worker processes. """
+    def __init__(self, reports: Iterable[Path], out_dir = None, workers = None):
+        self.reports = list(reports)
+        self.out_dir = Path(out_dir) if out_dir else None
+        self.workers = workers or os.cpu_count() or 1
+
+    def run(self) -> List[RenderResult]:
+        outputs = self.outputs()
+        results = []
+        for result in self.render(outputs):
+            if result.error:
+                print('ERROR rendering', result.filename + ':', result.error, file=sys.stderr)
+            results.append(result)
+        return results
+
+    def render(self, outputs: List[Path]) -> Iterator[RenderResult]:
+        if self.workers == 1 or len(self.reports) <= 1:
+            for r, o in zip(self.reports, outputs):
+                yield render_report(r, o)
+            return
+
+        chunksize = max(1, min(16, len(self.reports) // (self.workers * 4)))
+        with ProcessPoolExecutor(max_workers=self.workers) as executor:
+            yield from executor.map(render_report, self.reports, outputs, chunksize=chunksize)
 
+    def outputs(self) -> List[Path]:
+        # x.doc.report.json becomes x.doc.report.pdf
+        return output_paths(self.reports, self.out_dir, lambda name: name.removesuffix('.json') + '.pdf')
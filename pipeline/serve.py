@@ -0,0 +1,236 @@
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import errno
+import hashlib
+import importlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import os
+import signal
+import socketserver
+import stat
+import sys
+import threading
+import time
+from typing import Callable, Optional
+from . import AnalysisOptions, IocReport, Pipeline
+from .allowlist import allowlist_for, allowlisted_report
+from .cache import ResultCache
+from .limits import enforced, exceeded, run_limited
+from .metrics import Metrics
+
+def stop_server(signum, frame):
+    raise KeyboardInterrupt
+
+def warm_worker():
+    # import every format pipeline once per worker, so requests never pay
+    # for parser imports or regex compilation
+    for name in ('cfbf', 'ooxml', 'pdf', 'entropy'):
+        importlib.import_module(f'.file_pipelines.{name}', __package__)
+
+def analyze_document(data: bytes, options: AnalysisOptions) -> IocReport:
+    from .analyze import AnalyzePipeline
+    from .source import DocumentSource
+
+    if enforced(options):
+        # every pool worker watches a worker of its own, which is recycled at the limits
+        return run_limited(options, analyze_document, data, options)
+
+    with DocumentSource.from_bytes(data) as source:
+        return AnalyzePipeline(None, None, False, options).analyze_source(source)
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+class AnalysisRequestHandler(BaseHTTPRequestHandler):
+    server_version = 'sdat'
+
+    def address_string(self):
+        # unix socket peers have no address tuple
+        return self.client_address[0] if self.client_address else 'unix'
+
+    def do_GET(self):
+        if self.path == '/metrics':
+            return self.send_text(200, self.server.service.metrics.prometheus())
+        if self.path != '/health':
+            return self.send_json(404, { 'error': 'not found' })
+
+        service = self.server.service
+        self.send_json(200, {
+            'status': 'ok',
+            'workers': service.workers,
+            'in_flight': service.in_flight,
+            'capacity': service.capacity,
+        })
+
+    def do_POST(self):
+        if self.path.split('?')[0] != '/analyze':
+            return self.send_json(404, { 'error': 'not found' })
+
+        service = self.server.service
+        try:
+            length = int(self.headers.get('Content-Length') or 0)
+        except ValueError:
+            return self.send_json(400, { 'error': 'invalid Content-Length' })
+        if length < 0:
+            return self.send_json(400, { 'error': 'invalid Content-Length' })
+        if length == 0:
+            return self.send_json(411, { 'error': 'document body with Content-Length required' })
+        if length > service.max_body:
+            return self.send_json(413, { 'error': f'document exceeds {service.max_body} bytes' })
+
+        # the body is only read once a slot is taken, a full server rejects without buffering it
+        status, body = service.handle(length, self.rfile.read)
+        self.send_json(status, body, retry_after=status == 503)
+
+    def send_text(self, status: int, text: str):
+        payload = text.encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def send_json(self, status: int, body: dict, retry_after: bool = False):
+        payload = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        if retry_after:
+            self.send_header('Retry-After', '1')
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        if self.server.service.verbose:
+            super().log_message(format, *args)
+
+class ServePipeline(Pipeline):
+    """
+    Long running analysis daemon. Requests are accepted over localhost HTTP or
+    a unix socket and analyzed by a pool of warm worker processes. At most
+    `workers` documents are analyzed concurrently and `max_queue` more may
+    wait, anything above is rejected with 503 so callers can back off.
+    Metrics of every analyzed document are served at /metrics.
+    """
+    def __init__(self, host: str = '127.0.0.1', port: int = 8787, socket_path = None, workers = None,
+                 max_queue = None, max_body: int = 64 * 1024 * 1024, options: Optional[AnalysisOptions] = None,
+                 cache: Optional[ResultCache] = None, verbose: bool = False, metrics: Optional[Metrics] = None):
+        self.host = host
+        self.port = port
+        self.socket_path = socket_path
+        self.workers = workers or os.cpu_count() or 1
+        self.capacity = self.workers + (max_queue if max_queue is not None else self.workers * 4)
+        self.max_body = max_body
+        self.options = options or AnalysisOptions()
+        self.cache = cache
+        self.verbose = verbose
+        self.metrics = metrics or Metrics()
+
+        self.slots = threading.BoundedSemaphore(self.capacity)
+        self.in_flight = 0
+        self.lock = threading.Lock()
+        self.executor = None
+        # held while a broken pool is replaced
+        self.executor_lock = threading.Lock()
+
+    def handle(self, length: int, read: Callable[[int], bytes]):
+        """ Status and body of the response to a document of `length` bytes, read by `read` once admitted. """
+        if not self.slots.acquire(blocking=False):
+            return 503, { 'error': 'analysis queue is full, retry later' }
+
+        with self.lock:
+            self.in_flight += 1
+        start = time.perf_counter()
+        report, error = None, None
+        try:
+            data = read(length)
+            if len(data) < length:
+                error = 'EOFError: document body ended early'
+                return 400, { 'error': f'document body ended after {len(data)} of {length} bytes' }
+            allowlist = allowlist_for(self.options)
+            digest = hashlib.sha256(data).hexdigest() if self.cache or (allowlist and allowlist.hashes) else None
+            if allowlist and allowlist.known_clean(digest):
+                report = allowlisted_report()
+                return 200, report.to_dict()
+            report = self.cache.get(digest) if self.cache else None
+            if report is None:
+                report = self.analyze(data)
+                if self.cache and not exceeded(report):
+                    self.cache.put(digest, report)
+            return 200, report.to_dict()
+        except NotImplementedError as e:
+            error = f'{type(e).__name__}: {e}'
+            return 415, { 'error': str(e) }
+        except Exception as e:
+            error = f'{type(e).__name__}: {e}'
+            return 500, { 'error': error }
+        finally:
+            with self.lock:
+                self.in_flight -= 1
+            self.slots.release()
+            self.metrics.record(report, time.perf_counter() - start, length, error)
+
+    def analyze(self, data: bytes) -> IocReport:
+        executor = self.executor
+        try:
+            return executor.submit(analyze_document, data, self.options).result()
+        except BrokenProcessPool:
+            # a worker died (e.g. killed by the OOM killer) and every request in flight on the pool failed with it
+            self.replace_executor(executor)
+
+        # once more in a worker of its own, so a document that kills its worker again fails alone
+        with ProcessPoolExecutor(max_workers=1) as isolated:
+            return isolated.submit(analyze_document, data, self.options).result()
+
+    def start_executor(self) -> ProcessPoolExecutor:
+        executor = ProcessPoolExecutor(max_workers=self.workers, initializer=warm_worker)
+        # start every worker up front instead of on the first requests
+        for future in [executor.submit(os.getpid) for _ in range(self.workers)]:
+            future.result()
+        return executor
+
+    def replace_executor(self, broken: ProcessPoolExecutor):
+        with self.executor_lock:
+            # requests that failed with the same pool replace it once
+            if self.executor is not broken:
+                return
+            print('ERROR analysis worker died, restarting the worker pool', file=sys.stderr)
+            broken.shutdown(wait=False, cancel_futures=True)
+            self.executor = self.start_executor()
+
+    def create_server(self):
+        if self.socket_path:
+            try:
+                mode = os.lstat(self.socket_path).st_mode
+            except FileNotFoundError:
+                mode = None
+            if mode is not None:
+                # a stale socket of a previous run is replaced, any other file is left alone
+                if not stat.S_ISSOCK(mode):
+                    raise FileExistsError(errno.EEXIST, 'exists and is not a socket', str(self.socket_path))
+                os.unlink(self.socket_path)
+            server = UnixHTTPServer(str(self.socket_path), AnalysisRequestHandler)
+        else:
+            server = ThreadingHTTPServer((self.host, self.port), AnalysisRequestHandler)
+            server.daemon_threads = True
+        server.service = self
+        return server
+
+    def run(self):
+        self.executor = self.start_executor()
+        server = self.create_server()
+        address = self.socket_path or f'http://{self.host}:{server.server_address[1]}'
+        print(f'sdat serving on {address} with {self.workers} workers', file=sys.stderr)
+        signal.signal(signal.SIGTERM, stop_server)
+
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            self.executor.shutdown(cancel_futures=True)
+            self.metrics.flush()
+            if self.socket_path and os.path.exists(self.socket_path):
+                os.unlink(self.socket_path)
@@ -0,0 +1,121 @@
+from contextlib import contextmanager
+import io
+import mmap
+from typing import Optional
+
+class MappedStream:
+    """ Seekable file object over a mapping, mmap only has seekable() since Python 3.13. """
+    def __init__(self, mapped: mmap.mmap):
+        self.mapped = mapped
+
+    def seekable(self) -> bool:
+        return True
+
+    def __getattr__(self, name):
+        return getattr(self.mapped, name)
+
+class DocumentSource:
+    """
+    Document content mapped into memory once and shared by the type detector
+    and the file pipelines. Consumers get zero-copy memoryview slices and the
+    parsed zip/OLE/PDF handles are opened lazily and cached, so a file is
+    never read twice. Every handle works on its own mapping of the file to
+    keep independent read positions.
+    """
+    def __init__(self, filename = None, data: Optional[bytes] = None):
+        if (filename is None) == (data is None):
+            raise ValueError('Provide either filename or data')
+
+        self.filename = filename
+        self.file = None
+        self.maps = []
+        self.handles = {}
+
+        if data is not None:
+            self.data = data
+        else:
+            self.file = open(filename, 'rb')
+            self.data = self.map()
+
+        self.view = memoryview(self.data)
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> 'DocumentSource':
+        return cls(data=data)
+
+    @property
+    def size(self) -> int:
+        return len(self.view)
+
+    def header(self, n: int) -> bytes:
+        return bytes(self.view[:n])
+
+    def map(self):
+        try:
+            mapped = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # empty files can not be mapped
+            return b''
+        self.maps.append(mapped)
+        return mapped
+
+    def stream(self):
+        """ New seekable file object over the content. """
+        if self.file is None:
+            # BytesIO shares the buffer of immutable bytes until written to
+            return io.BytesIO(self.data)
+        if not self.size:
+            return io.BytesIO(b'')
+        mapped = self.map()
+        return mapped if hasattr(mapped, 'seekable') else MappedStream(mapped)
+
+    def zip(self):
+        if 'zip' not in self.handles:
+            import zipfile
+            self.handles['zip'] = zipfile.ZipFile(self.stream(), 'r')
+        return self.handles['zip']
+
+    def ole(self):
+        if 'ole' not in self.handles:
+            import olefile
+            self.handles['ole'] = olefile.OleFileIO(self.stream())
+        return self.handles['ole']
+
+    def pdf(self):
+        if 'pdf' not in self.handles:
+            from pypdf import PdfReader
+            self.handles['pdf'] = PdfReader(self.stream())
+        return self.handles['pdf']
+
+    def close(self):
+        for handle in self.handles.values():
+            if hasattr(handle, 'close'):
+                handle.close()
+        self.handles.clear()
+
+        self.view.release()
+        for mapped in self.maps:
+            try:
+                mapped.close()
+            except BufferError:
+                # a consumer still holds a slice, the mapping goes away with it
+                pass
+        self.maps.clear()
+
+        if self.file:
+            self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+@contextmanager
+def open_source(filename, source: Optional[DocumentSource] = None):
+    """ Use the shared source when given, otherwise map the file for the duration. """
+    if source is not None:
+        yield source
+    else:
+        with DocumentSource(filename) as source:
+            yield source
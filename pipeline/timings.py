@@ -0,0 +1,114 @@
+from contextlib import contextmanager
+from dataclasses import dataclass
+from time import perf_counter
+from typing import Callable, Dict, Iterable, Iterator, List
+
+@dataclass
+class StageTiming:
+    seconds: float = 0.0
+    bytes: int = 0
+    calls: int = 0
+
+    def to_dict(self):
+        return {
+            'seconds': round(self.seconds, 6),
+            'bytes': self.bytes,
+            'calls': self.calls
+        }
+
+class Timings:
+    """
+    Wall time and bytes processed by file type detection, stream extraction,
+    every stream and every IOC rule of one analysis. A disabled instance
+    measures nothing, so pipelines can use it unconditionally.
+    """
+    def __init__(self, enabled: bool = True):
+        self.enabled = enabled
+        self.stages: Dict[str, StageTiming] = {}
+        self.streams: List[dict] = []
+        self.rules: Dict[str, StageTiming] = {}
+
+    def add(self, table: Dict[str, StageTiming], name: str, seconds: float, nbytes: int, calls: int = 1):
+        timing = table.setdefault(name, StageTiming())
+        timing.seconds += seconds
+        timing.bytes += nbytes
+        timing.calls += calls
+
+    def merge(self, other: 'Timings'):
+        """ Add timings recorded by a worker process. """
+        if not self.enabled or not other.enabled:
+            return
+        for name, timing in other.stages.items():
+            self.add(self.stages, name, timing.seconds, timing.bytes, timing.calls)
+        for name, timing in other.rules.items():
+            self.add(self.rules, name, timing.seconds, timing.bytes, timing.calls)
+        self.streams += other.streams
+
+    def add_rule(self, name: str, seconds: float, nbytes: int):
+        self.add(self.rules, name, seconds, nbytes)
+
+    @contextmanager
+    def stage(self, name: str, nbytes: int = 0):
+        if not self.enabled:
+            yield
+            return
+
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.add(self.stages, name, perf_counter() - start, nbytes)
+
+    @contextmanager
+    def stream(self, name: str, nbytes: int):
+        if not self.enabled:
+            yield
+            return
+
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.streams.append({ 'name': name, 'seconds': round(perf_counter() - start, 6), 'bytes': nbytes })
+
+    def iterate(self, name: str, iterable: Iterable, size: Callable = len) -> Iterator:
+        """ Pass items of iterable through, timing the work done to produce each of them. """
+        if not self.enabled:
+            yield from iterable
+            return
+
+        iterator = iter(iterable)
+        while True:
+            start = perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self.add(self.stages, name, perf_counter() - start, 0, calls=0)
+                return
+            self.add(self.stages, name, perf_counter() - start, size(item))
+            yield item
+
+    def to_dict(self):
+        return {
+            'stages': { name: timing.to_dict() for name, timing in self.stages.items() },
+            'streams': self.streams,
+            'rules': { name: timing.to_dict() for name, timing in self.rules.items() },
+        }
+
+def format_timings(timings: dict, top: int = 10) -> str:
+    """ Summary table of a report timings section, slowest streams and rules first. """
+    rows = [(f'stage {name}', t) for name, t in timings.get('stages', {}).items()]
+    streams = sorted(timings.get('streams', []), key=lambda s: s['seconds'], reverse=True)
+    rows += [(f'stream {s["name"] or "-"}', dict(s, calls=1)) for s in streams[:top]]
+    rules = sorted(timings.get('rules', {}).items(), key=lambda r: r[1]['seconds'], reverse=True)
+    rows += [(f'rule {name}', t) for name, t in rules]
+
+    lines = [f'{"":<40} {"calls":>6} {"seconds":>10} {"MB":>9} {"MB/s":>9}']
+    for label, t in rows:
+        mb = t['bytes'] / 1024 ** 2
+        rate = f'{mb / t["seconds"]:.2f}' if t['bytes'] and t['seconds'] else '-'
+        lines.append(f'{label[:40]:<40} {t["calls"]:>6} {t["seconds"]:>10.4f} {mb:>9.2f} {rate:>9}')
+    if len(streams) > top:
+        lines.append(f'({len(streams) - top} faster streams not shown)')
+
+    return '\n'.join(lines)
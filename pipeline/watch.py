@@ -0,0 +1,283 @@
+from collections import deque
+from concurrent.futures import BrokenExecutor, Future
+from dataclasses import asdict, dataclass
+import json
+import os
+from pathlib import Path
+import signal
+import sys
+import time
+from typing import Dict, Iterator, Optional, Tuple
+from . import AnalysisOptions, Pipeline
+from .batch import BatchResult, analyze_file, is_report
+from .cache import ResultCache, file_digest
+
+JOURNAL_NAME = '.sdat-journal.jsonl'
+# the journal is rewritten on start once it holds this many times more lines than files
+JOURNAL_COMPACT_RATIO = 2
+
+def stop_watching(signum, frame):
+    raise KeyboardInterrupt
+
+def reset_worker_signals():
+    # executed inside worker process, a broken pool terminates its remaining workers with SIGTERM
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+@dataclass
+class JournalEntry:
+    path: str
+    size: int
+    # st_mtime_ns
+    mtime: int
+    sha256: Optional[str]
+    verdict: Optional[str] = None
+    error: Optional[str] = None
+
+class Journal:
+    """
+    Append-only JSON lines record of processed files, the last entry of a
+    path wins. A file whose size and mtime match its entry is not even
+    hashed again, also after a restart.
+    """
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self.entries: Dict[str, JournalEntry] = {}
+        self.load()
+        self.file = open(self.path, 'a')
+
+    def load(self):
+        lines = 0
+        try:
+            with open(self.path, 'r') as f:
+                for line in f:
+                    lines += 1
+                    try:
+                        entry = JournalEntry(**json.loads(line))
+                    except (ValueError, TypeError):
+                        # torn last line of an interrupted run
+                        continue
+                    self.entries[entry.path] = entry
+        except FileNotFoundError:
+            return
+
+        if lines > JOURNAL_COMPACT_RATIO * max(len(self.entries), 1):
+            self.compact()
+
+    def compact(self):
+        # entries of deleted files are dropped, written aside and renamed so a crash loses nothing
+        self.entries = { path: entry for path, entry in self.entries.items() if os.path.exists(path) }
+        temporary = self.path.with_name(self.path.name + '.tmp')
+        with open(temporary, 'w') as f:
+            for entry in self.entries.values():
+                f.write(json.dumps(asdict(entry), separators=(',', ':')) + '\n')
+        os.replace(temporary, self.path)
+
+    def get(self, path: str) -> Optional[JournalEntry]:
+        return self.entries.get(path)
+
+    def unchanged(self, path: str, stat: os.stat_result) -> bool:
+        entry = self.entries.get(path)
+        return entry is not None and entry.size == stat.st_size and entry.mtime == stat.st_mtime_ns
+
+    def record(self, entry: JournalEntry):
+        self.entries[entry.path] = entry
+        # one line per file as soon as it is done, a restart resumes from here
+        self.file.write(json.dumps(asdict(entry), separators=(',', ':')) + '\n')
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+@dataclass
+class WatchResult:
+    entry: JournalEntry
+    # None when the content matched the journal and the file was not analyzed
+    result: Optional[BatchResult]
+
+def watch_file(filename: Path, output: Path, pdf: bool, options: AnalysisOptions, cache: Optional[ResultCache],
+               known: Optional[JournalEntry]) -> WatchResult:
+    # executed inside worker process, stat and hash are taken here so they describe the analyzed content
+    try:
+        stat = os.stat(filename)
+        digest = file_digest(filename)
+    except OSError as e:
+        error = f'{type(e).__name__}: {e}'
+        return WatchResult(JournalEntry(str(filename), -1, -1, None, error=error), BatchResult(str(filename), None, error))
+
+    entry = JournalEntry(str(filename), stat.st_size, stat.st_mtime_ns, digest)
+    if known is not None and digest == known.sha256:
+        # only touched or copied over with the same content
+        entry.verdict, entry.error = known.verdict, known.error
+        return WatchResult(entry, None)
+
+    result = analyze_file(filename, output, pdf, options, cache)
+    entry.verdict = result.report.verdict if result.report else None
+    entry.error = result.error
+    return WatchResult(entry, result)
+
+def failed_result(filename: Path, error: BaseException) -> WatchResult:
+    # journaled with the current size and mtime, the file is retried once it changes
+    error = f'{type(error).__name__}: {error}'
+    try:
+        stat = os.stat(filename)
+        entry = JournalEntry(str(filename), stat.st_size, stat.st_mtime_ns, None, error=error)
+    except OSError:
+        entry = JournalEntry(str(filename), -1, -1, None, error=error)
+    return WatchResult(entry, BatchResult(str(filename), None, error))
+
+class WatchPipeline(Pipeline):
+    """
+    Analyzes files dropped into a directory as they arrive. The directory
+    is polled every `interval` seconds, files that are new or changed since
+    the journal recorded them are analyzed by a pool of workers and their
+    reports written to `out_dir`. At most `max_queue` files wait for a
+    worker, polling pauses while the queue is full so a burst of arrivals
+    never piles up in memory. Files modified within the last `settle`
+    seconds are still being written and are picked up by a later poll.
+    """
+    def __init__(self, directory, out_dir, journal = None, interval: float = 2.0, settle: float = 1.0,
+                 workers = None, max_queue = None, pdf: bool = False, options: Optional[AnalysisOptions] = None,
+                 cache: Optional[ResultCache] = None, once: bool = False, verbose: bool = False, metrics = None):
+        # journal paths are absolute, so a restart from another directory finds them
+        self.directory = Path(directory).absolute()
+        self.out_dir = Path(out_dir)
+        self.journal_path = Path(journal) if journal else self.out_dir / JOURNAL_NAME
+        self.interval = interval
+        self.settle = settle
+        self.workers = workers or os.cpu_count() or 1
+        self.max_queue = max_queue or self.workers * 4
+        self.pdf = pdf
+        self.options = options or AnalysisOptions()
+        self.cache = cache
+        self.once = once
+        self.verbose = verbose
+        self.metrics = metrics
+        self.executor = None
+
+    def run(self):
+        self.out_dir.mkdir(parents=True, exist_ok=True)
+        journal = Journal(self.journal_path)
+        if self.workers > 1:
+            self.executor = self.start_executor()
+        print(f'sdat watching {self.directory} with {self.workers} workers', file=sys.stderr)
+        signal.signal(signal.SIGTERM, stop_watching)
+
+        pending = deque()
+        try:
+            while True:
+                queued = { str(filename) for filename, *_ in pending }
+                for filename in self.changed(journal, queued):
+                    while len(pending) >= self.max_queue:
+                        self.collect(journal, pending)
+                    pending.append(self.submit(filename, journal))
+
+                if self.once:
+                    while pending:
+                        self.collect(journal, pending)
+                    break
+
+                # finished files are journaled right away, the rest on a later poll
+                while pending and pending[0][1].done():
+                    self.collect(journal, pending)
+                if self.metrics:
+                    self.metrics.maybe_flush()
+                time.sleep(self.interval)
+        except KeyboardInterrupt:
+            # files still in flight are not journaled and get analyzed again on restart
+            pass
+        finally:
+            if self.executor is not None:
+                self.executor.shutdown(cancel_futures=True)
+            journal.close()
+            if self.metrics:
+                self.metrics.flush()
+
+    def changed(self, journal: Journal, queued: set) -> Iterator[Path]:
+        """ Files of the directory to analyze, in a stable order. """
+        now = time.time()
+        for filename, stat in self.walk():
+            path = str(filename)
+            if path in queued or journal.unchanged(path, stat):
+                continue
+            if now - stat.st_mtime < self.settle and not self.once:
+                continue
+            yield filename
+
+    def walk(self) -> Iterator[Tuple[Path, os.stat_result]]:
+        out_dir = self.out_dir.resolve()
+        for root, dirs, files in os.walk(self.directory):
+            # reports and the journal may live inside the watched directory
+            dirs[:] = sorted(d for d in dirs if (Path(root) / d).resolve() != out_dir)
+            for name in sorted(files):
+                filename = Path(root) / name
+                if is_report(filename) or name.startswith(self.journal_path.name):
+                    continue
+                try:
+                    stat = filename.stat()
+                except OSError:
+                    # removed between listing and stat
+                    continue
+                yield filename, stat
+
+    def start_executor(self, workers: Optional[int] = None):
+        # multiprocessing is only imported when files are analyzed in parallel
+        from concurrent.futures import ProcessPoolExecutor
+        return ProcessPoolExecutor(max_workers=workers or self.workers, initializer=reset_worker_signals)
+
+    def arguments(self, filename: Path, journal: Journal) -> tuple:
+        return filename, self.output_for(filename), self.pdf, self.options, self.cache, journal.get(str(filename))
+
+    def submit(self, filename: Path, journal: Journal) -> Tuple[Path, Future, object]:
+        """ Pending entry of the file: (filename, future, executor it was submitted to). """
+        executor = self.executor
+        future = Future()
+        try:
+            if executor is not None:
+                future = executor.submit(watch_file, *self.arguments(filename, journal))
+            else:
+                future.set_result(watch_file(*self.arguments(filename, journal)))
+        except Exception as e:
+            # a broken pool refuses new work, handled like its failed futures
+            future.set_exception(e)
+        return filename, future, executor
+
+    def collect(self, journal: Journal, pending: deque):
+        """ Journals the oldest pending file, waiting for it if needed. """
+        filename, future, executor = pending.popleft()
+        try:
+            watched = future.result()
+        except BrokenExecutor:
+            # a worker died (e.g. killed by the OOM killer) and every file in flight failed with it
+            if executor is not None and executor is self.executor:
+                print('ERROR analysis worker died, restarting the worker pool', file=sys.stderr)
+                executor.shutdown(wait=False, cancel_futures=True)
+                self.executor = self.start_executor()
+            watched = self.retry(filename, journal)
+        except Exception as e:
+            watched = failed_result(filename, e)
+
+        journal.record(watched.entry)
+        if watched.result is None:
+            return
+        if self.metrics:
+            self.metrics.record_result(watched.result)
+        if watched.result.error:
+            print('ERROR analyzing', watched.result.filename + ':', watched.result.error, file=sys.stderr)
+        elif self.verbose:
+            print(f'{filename}: {watched.entry.verdict}', file=sys.stderr)
+
+    def retry(self, filename: Path, journal: Journal) -> WatchResult:
+        # in a worker of its own, so a file that kills its worker again fails alone and is journaled as failed
+        try:
+            with self.start_executor(1) as executor:
+                return executor.submit(watch_file, *self.arguments(filename, journal)).result()
+        except Exception as e:
+            return failed_result(filename, e)
+
+    def output_for(self, filename: Path) -> Path:
+        # mirror the layout below the watched directory
+        suffix = ".report.pdf" if self.pdf else ".report.json"
+        relative = filename.relative_to(self.directory)
+        output = self.out_dir / relative.with_name(relative.name + suffix)
+        output.parent.mkdir(parents=True, exist_ok=True)
+        return output